@@ -0,0 +1,467 @@
+"""
+Benchmarks of the parse, combine and generator hot paths.
+
+The suites follow airspeed velocity (asv): every class is a suite with a
+setup and teardown and every method that starts with time_ is a benchmark.
+Each benchmark is timed a number of times with a fresh setup and run once
+more with tracemalloc to record its peak memory. Nothing is downloaded,
+setup writes the synthetic sources of groundwater_timenet.fixtures in a
+temporary directory.
+
+Run all benchmarks, or those whose name contains a pattern, with:
+
+    python -m groundwater_timenet.benchmark [pattern]
+
+The results are stored as JSON per commit in var/benchmarks. Compare two
+runs with:
+
+    python -m groundwater_timenet.benchmark compare old.json new.json
+"""
+
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from groundwater_timenet import fixtures
+from groundwater_timenet import utils
+from groundwater_timenet.learn import shards
+from groundwater_timenet.learn.generator import (
+    ConvCombinerGenerator, CompactCombinerGenerator)
+from groundwater_timenet.learn.sequence import (
+    ConvolutionalAtrousGenerator, CompactConvolutionalAtrousGenerator)
+from groundwater_timenet.parse.combine import Combiner
+from groundwater_timenet.parse.dino import DinoData
+from groundwater_timenet.parse.geotop import GeotopData
+from groundwater_timenet.parse.knmi import (
+    WeatherStationData, RainData, EvapoTranspirationData)
+from groundwater_timenet.parse.other import Bofek, Irrigation, DrinkingWater
+
+
+logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
+
+BENCHMARK_DIR = os.path.join('var', 'benchmarks')
+REPEAT = 5
+REGRESSION_THRESHOLD = 1.1
+
+# Size of the synthetic sources of groundwater_timenet.fixtures.
+WELLS = 5
+YEARS = 5
+# Dependencies that only the code paths that use them should import.
+HEAVY_MODULES = (
+    'h5py', 'keras', 'matplotlib', 'netCDF4', 'osgeo', 'owslib', 'pandas',
+    'suds', 'tensorflow'
+)
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Suite(object):
+    """Base suite that runs its benchmarks in a temporary directory."""
+
+    def setup(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def teardown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+
+class FixtureSuite(Suite):
+    """Suite that writes the synthetic sources and picks the first well."""
+
+    def setup(self):
+        super().setup()
+        locations = fixtures.write_fixtures(wells=WELLS, years=YEARS)
+        self.x, self.y, self.z = locations[0]
+        self.x, self.y = int(self.x), int(self.y)
+        self.end = fixtures.END
+        self.start = self.end - datetime.timedelta(days=365 * (YEARS - 1))
+
+
+class ReadH5(FixtureSuite):
+
+    def setup(self):
+        super().setup()
+        et = EvapoTranspirationData()
+        tile_x, tile_y, self.row, self.column = et.tile(self.x, self.y)
+        self.filepath = os.path.join(
+            'var', 'data', 'knmi', et.root, str(tile_x), str(tile_y) + '.h5')
+
+    def time_read_h5_pixel(self):
+        utils.read_h5(
+            filepath=self.filepath,
+            dataset_name=("data", "timestamps"),
+            index=((self.row, self.column), ()),
+            many=True
+        )
+
+    def time_read_h5_tile(self):
+        utils.read_h5(self.filepath, "data")
+
+
+class Resample(Suite):
+
+    def setup(self):
+        super().setup()
+        days = fixtures.days(50)
+        self.dataframe = pd.DataFrame(
+            np.random.RandomState(4177).rand(len(days), 3), index=days)
+        self.end = fixtures.END
+        self.start = self.end - datetime.timedelta(days=365 * 10)
+        self.sum = EvapoTranspirationData(
+            timedelta="SM", resample_method="sum")
+        self.first = EvapoTranspirationData(
+            timedelta="SM", resample_method="first")
+
+    def time_resample_sum(self):
+        self.sum._resample(self.dataframe, self.start, self.end)
+
+    def time_resample_first(self):
+        self.first._resample(self.dataframe, self.start, self.end)
+
+
+class Sources(FixtureSuite):
+    """Data.data of every source."""
+
+    def setup(self):
+        super().setup()
+        self.temporal = {
+            source: source(timedelta="SM") for source in
+            (RainData, EvapoTranspirationData, WeatherStationData)
+        }
+        self.meta = {
+            source: source() for source in
+            (GeotopData, Bofek, Irrigation, DrinkingWater)
+        }
+        self.geotop_netcdf = GeotopData(sidecar=None)
+        self.dino = DinoData(timedelta="SM")
+
+    def _temporal(self, source):
+        self.temporal[source].data(self.x, self.y, self.start, self.end)
+
+    def time_rain(self):
+        self._temporal(RainData)
+
+    def time_rain_uncached(self):
+        self.temporal[RainData].tiles.clear()
+        self._temporal(RainData)
+
+    def time_evapotranspiration(self):
+        self._temporal(EvapoTranspirationData)
+
+    def time_weather_station(self):
+        self._temporal(WeatherStationData)
+
+    def time_geotop(self):
+        self.meta[GeotopData].data(self.x, self.y, self.z)
+
+    def time_geotop_netcdf(self):
+        self.geotop_netcdf.data(self.x, self.y, self.z)
+
+    def time_bofek(self):
+        self.meta[Bofek].data(self.x, self.y, self.z)
+
+    def time_irrigation(self):
+        self.meta[Irrigation].data(self.x, self.y, self.z)
+
+    def time_drinking_water(self):
+        self.meta[DrinkingWater].data(self.x, self.y, self.z)
+
+    def time_dino(self):
+        for _ in self.dino('all'):
+            pass
+
+
+class Combine(FixtureSuite):
+    """Combiner.temporal_data and meta_data of a well."""
+
+    def setup(self):
+        super().setup()
+        self.combiner = Combiner(feature_cache=None)
+        (self.x, self.y, self.z, self.start, self.end, self.base_metadata,
+         self.base) = next(self.combiner._base_data('all'))
+
+    def time_temporal_data(self):
+        self.combiner.temporal_data(
+            self.base, self.x, self.y, self.start, self.end)
+
+    def time_meta_data(self):
+        self.combiner.feature_cache.memory.clear()
+        self.combiner.meta_data(self.base_metadata, self.x, self.y, self.z)
+
+    def time_meta_data_cached(self):
+        self.combiner.meta_data(self.base_metadata, self.x, self.y, self.z)
+
+
+class Generator(Suite):
+    generator_class = ConvCombinerGenerator
+    series = 5
+    length = 1200
+
+    def setup(self):
+        super().setup()
+        self.generator = self.generator_class(directory=self.directory.name)
+        random = np.random.RandomState(4177)
+        self.base = random.rand(self.length, 1) + 0.1
+        self.temporal = random.rand(
+            self.length, self.generator.temporal_size) + 0.1
+        self.meta = random.rand(self.generator.meta_size)
+        windows = self.length - self.generator.input_size
+        self.windows = (
+            np.zeros((windows, self.generator.input_size, 1)),
+            random.rand(windows, self.generator.input_size,
+                        self.generator.temporal_size)
+        )
+
+    def time_generate_batch(self):
+        for _ in range(self.series):
+            self.generator.generate_batch(self.base, self.meta, self.temporal)
+
+    def time_pack(self):
+        base, temporal = self.windows
+        for _ in range(self.series):
+            self.generator.pack(base, self.meta, temporal)
+
+    def time_unpack_batches(self):
+        base, temporal = self.windows
+        for _ in range(self.series):
+            self.generator.pack(base, self.meta, temporal)
+        for _ in self.generator.unpack_batches(chunk_size=2):
+            pass
+
+
+class CompactGenerator(Generator):
+    generator_class = CompactCombinerGenerator
+
+
+class GetItem(Suite):
+    """__getitem__ of the generators that feed the network."""
+    generator_class = ConvolutionalAtrousGenerator
+    combiner_generator_class = ConvCombinerGenerator
+    chunk_size = 4
+    batches = 8
+
+    def setup(self):
+        super().setup()
+        combiner_generator = self.combiner_generator_class(
+            chunk_size=self.chunk_size, directory=self.directory.name)
+        random = np.random.RandomState(4177)
+        length = (
+            self.chunk_size * combiner_generator.batch_size +
+            combiner_generator.input_size
+        )
+        combiner_generator.generate_batch(
+            random.rand(length, 1) + 0.1,
+            random.rand(combiner_generator.meta_size),
+            random.rand(length, combiner_generator.temporal_size) + 0.1
+        )
+        chunk = next(iter(
+            combiner_generator.unpack_batches(chunk_size=self.chunk_size)))
+        self.write(os.path.join(self.directory.name, '1.h5'), chunk)
+        self.generator = self.generator_class(
+            directory=self.directory.name, chunk_size=self.chunk_size)
+
+    def write(self, filepath, chunk):
+        input_data, output_data = chunk
+        with h5py.File(filepath, 'w') as h5_file:
+            for i in range(self.chunk_size):
+                h5_file['input_' + str(i)] = input_data[i]
+                h5_file['output_' + str(i)] = output_data[i]
+
+    def time_getitem(self):
+        for i in range(self.batches):
+            inputs, outputs = self.generator[i]
+            inputs[()], outputs[()]
+
+
+class CompactGetItem(GetItem):
+    generator_class = CompactConvolutionalAtrousGenerator
+    combiner_generator_class = CompactCombinerGenerator
+
+    def write(self, filepath, chunk):
+        temporal, output, meta_index, meta = chunk
+        with h5py.File(filepath, 'w') as h5_file:
+            h5_file['meta'] = meta
+            for i in range(self.chunk_size):
+                h5_file['temporal_' + str(i)] = temporal[i]
+                h5_file['meta_index_' + str(i)] = meta_index[i]
+                h5_file['output_' + str(i)] = output[i]
+
+    def time_getitem(self):
+        for i in range(self.batches):
+            self.generator[i]
+
+
+class MemmapGetItem(GetItem):
+    """__getitem__ of memory-mapped .npy shards."""
+
+    def write(self, filepath, chunk):
+        directory, filename = os.path.split(filepath)
+        shards.ShardWriter(directory).write(
+            os.path.splitext(filename)[0], *chunk)
+
+    def time_getitem(self):
+        for i in range(self.batches):
+            inputs, outputs = self.generator[i % len(self.generator)]
+            np.array(inputs), np.array(outputs)
+
+
+def _python(code):
+    """Runs code in a fresh interpreter and returns what it prints."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, (PACKAGE_ROOT, env.get('PYTHONPATH'))))
+    return subprocess.check_output(
+        [sys.executable, '-c', code], env=env).decode('utf8')
+
+
+def heavy_imports(module):
+    """:return: sorted names of the HEAVY_MODULES that importing module
+    loads."""
+    return json.loads(_python(
+        "import json, sys\n"
+        "import {}\n"
+        "print(json.dumps(sorted({{name.split('.')[0] for name in "
+        "sys.modules}} & set({!r}))))".format(module, HEAVY_MODULES)
+    ))
+
+
+class Import(Suite):
+    """
+    Startup time of a fresh interpreter that imports a module. Use
+    python -X importtime -c "import <module>" to see where it goes.
+    """
+
+    def time_import_parse_combine(self):
+        _python("import groundwater_timenet.parse.combine")
+
+    def time_import_generator(self):
+        _python("import groundwater_timenet.learn.generator")
+
+    def time_import_package(self):
+        _python("import groundwater_timenet.parse")
+
+
+def benchmarks(pattern=None):
+    """Generator of (name, suite class, method name) of all benchmarks."""
+    suites = (
+        Import, ReadH5, Resample, Sources, Combine, Generator,
+        CompactGenerator, GetItem, CompactGetItem, MemmapGetItem
+    )
+    for suite in suites:
+        for method in sorted(dir(suite)):
+            name = suite.__name__ + '.' + method
+            if method.startswith('time_') and (
+                    pattern is None or pattern in name):
+                yield name, suite, method
+
+
+def _call(suite_class, method, function):
+    suite = suite_class()
+    try:
+        suite.setup()
+        return function(getattr(suite, method))
+    finally:
+        suite.teardown()
+
+
+def _timed(benchmark):
+    start = time.perf_counter()
+    benchmark()
+    return time.perf_counter() - start
+
+
+def _traced(benchmark):
+    tracemalloc.start()
+    try:
+        benchmark()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(suite_class, method, repeat=REPEAT):
+    """
+    :return: dictionary with the minimum and median duration in seconds and
+        the peak traced memory in bytes of a benchmark.
+    """
+    timings = [
+        _call(suite_class, method, _timed) for _ in range(repeat)]
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'repeat': repeat,
+        'peak_memory': _call(suite_class, method, _traced)
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(pattern=None, repeat=REPEAT, target_dir=BENCHMARK_DIR):
+    """Runs the benchmarks and stores the results of this commit as JSON."""
+    results = {}
+    for name, suite_class, method in benchmarks(pattern):
+        results[name] = measure(suite_class, method, repeat)
+        logger.info(
+            "%s: %.4f s, %d bytes", name, results[name]['median'],
+            results[name]['peak_memory'])
+    commit_hash = commit()
+    filepath = os.path.join(target_dir, commit_hash + '.json')
+    utils.mkdirs(filepath)
+    with open(filepath, 'w') as results_file:
+        json.dump({
+            'commit': commit_hash,
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.node(),
+            'max_rss': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'results': results
+        }, results_file, indent=4, sort_keys=True)
+    logger.info("Stored benchmark results in %s", filepath)
+    return filepath
+
+
+def compare(old_filepath, new_filepath, threshold=REGRESSION_THRESHOLD):
+    """
+    :return: list of (name, measure, old, new) of benchmarks that got slower
+        or use more memory than threshold times the old value.
+    """
+    with open(old_filepath) as old_file, open(new_filepath) as new_file:
+        old = json.load(old_file)['results']
+        new = json.load(new_file)['results']
+    return [
+        (name, key, old[name][key], new[name][key])
+        for name in sorted(set(old) & set(new))
+        for key in ('median', 'peak_memory')
+        if new[name][key] > threshold * old[name][key]
+    ]
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['compare']:
+        regressions = compare(*sys.argv[2:4])
+        for name, key, old, new in regressions:
+            logger.info("%s %s regressed from %s to %s", name, key, old, new)
+        sys.exit(1 if regressions else 0)
+    run(*sys.argv[1:2])
@@ -1,3 +1,19 @@
-from . import dino
-from . import geotop
-from . import knmi
+"""
+The submodules are imported when they are first used, as in
+groundwater_timenet.collect.dino, so importing one of them does not load
+the dependencies of the others.
+"""
+import importlib
+
+SUBMODULES = ('dino', 'geotop', 'knmi')
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(SUBMODULES))
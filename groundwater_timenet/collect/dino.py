@@ -1,14 +1,23 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.etree import ElementTree
+import argparse
+import datetime
+import io
+import json
 import os
-from tempfile import NamedTemporaryFile
-from time import sleep
+import threading
+import time
 
 import h5py
 import numpy as np
-from osgeo import ogr
+import requests
+import urllib3
 from owslib.wfs import WebFeatureService
 from suds.client import Client as SoapClient
 
 import groundwater_timenet.geo_utils
+from groundwater_timenet import http_utils
 from groundwater_timenet import utils
 
 
@@ -17,15 +26,104 @@ logger = utils.setup_logging(__name__, utils.HARVEST_LOG, "INFO")
 
 WFS_URL = 'http://www.broinspireservices.nl/wfs/osgegmw-a-v1.0'
 WFS_LAYER_NAME = 'gdn:Grondwateronderzoek'
+WSDL_URL = "http://www.dinoservices.nl/gwservices/gws-v11?wsdl"
+BACKOFF_BASE = 10.0
 FILENAME_BASE = "dino"
 NAN_VALUE = -9999999
+# First year of the measurements requested for a well without data yet.
+FIRST_YEAR = 1900
 
 
-def get_features(wfs, layer_name, minx, miny, maxx, maxy):
+class GmlFeature(dict):
+    """Feature fields parsed from GML, with the GetField of an OGR feature."""
+
+    def GetField(self, fieldname):
+        try:
+            return self[fieldname]
+        except KeyError:
+            raise ValueError("Unknown field {}".format(fieldname))
+
+
+def _gml_value(text):
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+FEATURE_MEMBERS = ('member', 'featureMember', 'featureMembers')
+
+
+def parse_gml_features(gml):
+    """
+    Incrementally parses a WFS GML response into GmlFeatures.
+
+    Features are yielded as soon as they are parsed and cleared afterwards,
+    so only one feature at a time is kept in memory. Nested fields are named
+    by their path joined with '|' and repeated fields become lists, as with
+    the OGR GML driver.
+
+    :param gml: file-like object with the GML response
+    """
+    path = []
+    fields = GmlFeature()
+    root = None
+    for event, element in ElementTree.iterparse(gml, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            path.append(_local_name(element.tag))
+            continue
+        depth = len(path) - 1
+        if depth < 2 or path[1] not in FEATURE_MEMBERS:
+            pass
+        elif depth == 2:
+            yield fields
+            fields = GmlFeature()
+            root.clear()
+        elif len(element) == 0 and element.text is not None:
+            name = '|'.join(path[3:])
+            value = _gml_value(element.text.strip())
+            if name not in fields:
+                fields[name] = value
+            elif isinstance(fields[name], list):
+                fields[name].append(value)
+            else:
+                fields[name] = [fields[name], value]
+        path.pop()
+
+
+def _open_gml(wfs, layer_name, bbox, http_session=None):
+    """
+    :return: file-like object with the GML of the features within bbox.
+
+    With an http_session the response is streamed, so iterparse reads it
+    in chunks. The response of OWSLib is read at once: it is buffered
+    anyway and the read of its ResponseWrapper takes no size.
+    """
+    if http_session is not None and hasattr(wfs, 'getGETGetFeatureRequest'):
+        response = http_session.get(
+            wfs.getGETGetFeatureRequest(typename=layer_name, bbox=bbox),
+            stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw
+    return io.BytesIO(wfs.getfeature(typename=layer_name, bbox=bbox).read())
+
+
+def get_features(wfs, layer_name, minx, miny, maxx, maxy, http_session=None):
     """
     Generator that iterates over layer features for a certain bounding box.
 
-    :param layer: osr layer
+    :param wfs: owslib WebFeatureService
+    :param http_session: requests session to stream the GetFeature
+        response with, see _open_gml.
     :param minx: bounding box min x coordinate
     :param miny: bounding box min y coordinate
     :param maxx: bounding box max x coordinate
@@ -43,28 +141,22 @@ def get_features(wfs, layer_name, minx, miny, maxx, maxy):
          'Grondwaterstand|end_date')
     """
     logger.info("Bounding Box: %d %d %d %d", minx, miny, maxx, maxy)
-    resp = wfs.getfeature(typename=layer_name,
-                          bbox=(minx, miny, maxx, maxy))
-    with NamedTemporaryFile('w') as temporary_file:
-        with open(temporary_file.name, 'w') as gmlfile:
-            gmlfile.write(resp.read())
-        driver = ogr.GetDriverByName('GML')
-        gml = driver.Open(temporary_file.name)
-        layer = gml.GetLayer()
-        if layer is not None:
-            logger.debug("Got %d features.", layer.GetFeatureCount())
-            for feature in layer:
-                yield (
-                    try_get_field(feature, 'dino_nr', 1)[0],
-                    try_get_field(feature, 'x_rd_crd', 1)[0],
-                    try_get_field(feature, 'y_rd_crd', 1)[0],
-                    try_get_field(feature, 'Grondwaterstand|start_date', 1)[0],
-                    try_get_field(feature, 'Grondwaterstand|end_date', 1)[0],
-                    try_get_field(feature, 'top_depth_mv', 2),
-                    try_get_field(feature, 'bottom_depth_mv', 2),
-                    try_get_field(feature, 'top_height_nap', 2),
-                    try_get_field(feature, 'bottom_height_mv', 2),
-                )
+    gml = _open_gml(wfs, layer_name, (minx, miny, maxx, maxy), http_session)
+    count = 0
+    for feature in parse_gml_features(gml):
+        count += 1
+        yield (
+            try_get_field(feature, 'dino_nr', 1)[0],
+            try_get_field(feature, 'x_rd_crd', 1)[0],
+            try_get_field(feature, 'y_rd_crd', 1)[0],
+            try_get_field(feature, 'Grondwaterstand|start_date', 1)[0],
+            try_get_field(feature, 'Grondwaterstand|end_date', 1)[0],
+            try_get_field(feature, 'top_depth_mv', 2),
+            try_get_field(feature, 'bottom_depth_mv', 2),
+            try_get_field(feature, 'top_height_nap', 2),
+            try_get_field(feature, 'bottom_height_mv', 2),
+        )
+    logger.debug("Got %d features.", count)
 
 
 def try_get_field(feature, fieldname, n, default=""):
@@ -81,11 +173,21 @@ def try_get_field(feature, fieldname, n, default=""):
     return [value] + [default] * (n - 1)
 
 
-def load_station_data(nitg_nr):
-    soap_client = SoapClient(
-        "http://www.dinoservices.nl/gwservices/gws-v11?wsdl")
-    periods = [(1900, 2017)]
+def load_station_data(nitg_nr, soap_client=None, attempts=8,
+                      sleep=time.sleep, backoff_base=BACKOFF_BASE,
+                      start_year=FIRST_YEAR, end_year=None):
+    """
+    Loads the measurement series of a well over SOAP from start_year up to
+    end_year, which defaults to this year.
+
+    When the service fails the query period is broken in two and retried
+    after an exponential backoff with jitter. After `attempts` failures the
+    last error is raised.
+    """
+    soap_client = soap_client or SoapClient(WSDL_URL)
+    periods = [(start_year, end_year or datetime.date.today().year)]
     meetreeksen = []
+    failures = 0
     while len(periods) > 0:
         start_year, end_year = periods.pop()
         try:
@@ -97,14 +199,21 @@ def load_station_data(nitg_nr):
                     UNIT='SFL'
                 )
             )
-        except:
+        except Exception:
+            failures += 1
+            if failures >= attempts:
+                raise
+            delay = http_utils.backoff(failures - 1, base=backoff_base)
             logger.exception(
-                "Suds client is unavailable for well %s, waiting for 10 "
-                "minutes, breaking query period in two", nitg_nr)
-            sleep(600)
+                "Suds client is unavailable for well %s, waiting for %.1f "
+                "seconds, breaking query period in two", nitg_nr, delay)
+            sleep(delay)
             halfway = int(start_year + (end_year - start_year) / 2)
-            periods.append((start_year, halfway))
-            periods.append((halfway, end_year))
+            if halfway == start_year:
+                periods.append((start_year, end_year))
+            else:
+                periods.append((start_year, halfway))
+                periods.append((halfway, end_year))
     return (
         (
             meetreeks.WELL_NITG_NR, meetreeks.WELL_TUBE_NR,
@@ -116,109 +225,350 @@ def load_station_data(nitg_nr):
     )
 
 
-def load_dino_grid_cell(features):
-    for (
+def load_well(feature, soap_client=None, **kwargs):
+    """
+    Loads the measurements of all tubes of the well of a WFS feature.
+
+    :return: list with a (metadata, well_data) tuple for each tube.
+    """
+    (
         well, x, y, start, end,
         (top_depth_mv_up, top_depth_mv_down),
         (bottom_depth_mv_up, bottom_depth_mv_down),
         (top_height_up, top_height_down),
         (bottom_height_up, bottom_height_down)
-    ) in features:
-        try:
-            data = load_station_data(well)
-            for well_nr, tube_nr, well_data in data:
-                yield ([well, tube_nr, x, y, start, end, top_depth_mv_up,
-                        top_depth_mv_down, bottom_depth_mv_up,
-                        bottom_depth_mv_down, top_height_up, top_height_down,
-                        bottom_height_up, bottom_height_down], well_data)
-        except AttributeError:
-            logger.info("Well %s doesn't contain values", well)
+    ) = feature
+    try:
+        return [
+            ([well, tube_nr, x, y, start, end, top_depth_mv_up,
+              top_depth_mv_down, bottom_depth_mv_up,
+              bottom_depth_mv_down, top_height_up, top_height_down,
+              bottom_height_up, bottom_height_down], well_data)
+            for well_nr, tube_nr, well_data in
+            load_station_data(well, soap_client, **kwargs)
+        ]
+    except AttributeError:
+        logger.info("Well %s doesn't contain values", well)
+        return []
+
+
+def load_dino_grid_cell(features):
+    for feature in features:
+        for metadata, well_data in load_well(feature):
+            yield metadata, well_data
 
 
 def load_dino_groundwater(skip=0, url=WFS_URL, layer_name=WFS_LAYER_NAME):
     wfs = WebFeatureService(url=url, version='2.0.0')
+    http_session = http_utils.session()
     sliding_window = groundwater_timenet.geo_utils.sliding_geom_window('NederlandRegion.json')
     [next(sliding_window) for _ in range(skip)]
     for minx, miny, maxx, maxy in sliding_window:
-        features = get_features(wfs, layer_name, minx, miny, maxx, maxy)
+        features = get_features(
+            wfs, layer_name, minx, miny, maxx, maxy, http_session)
         yield load_dino_grid_cell(features), minx, miny
 
 
-def download_hdf5(skip=0, filename_base=FILENAME_BASE):
-    dino_data = load_dino_groundwater(skip)
-    skip_filepath = os.path.join(utils.DATA, filename_base, "skip_count.txt")
-    total_count = 0
-    for grid_cell, minx, miny, in dino_data:
-        filepath = utils.parse_filepath(minx, miny, filename_base)
-        h5_file = h5py.File(filepath, "w", libver='latest')
-        meta_data = []
-        changed = False
-        for metadata, well_data in grid_cell:
-            # cast to float and handle faulty data.
-            data_ = [
-                [np.datetime64(d, 's').astype('f4'), v]
-                for d, v, f in well_data if f is None and v is not None
-            ]
-            if len(data_) == 0:
-                logger.info("Well %s %s doesn't contain data",
-                            metadata[0], metadata[1])
+class Checkpoint(object):
+    """
+    Append-only log of harvested wells and grid cells.
+
+    Every finished well is written as a json line together with the metadata
+    of its tubes, so an interrupted harvest never fetches it again. A
+    truncated last line (from a crash while writing) is ignored.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.cells = set()
+        self.wells = {}
+        utils.mkdirs(filepath)
+        try:
+            with open(filepath, 'r') as checkpoint_file:
+                for line in checkpoint_file:
+                    try:
+                        self._add(json.loads(line))
+                    except ValueError:
+                        logger.warn("Skipped corrupt checkpoint line %s", line)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _key(minx, miny):
+        return "{}_{}".format(minx, miny)
+
+    def _add(self, record):
+        key = self._key(*record["cell"])
+        if record.get("done"):
+            self.cells.add(key)
+        else:
+            self.wells.setdefault(key, {})[record["well"]] = record["metadata"]
+
+    def _append(self, record):
+        with open(self.filepath, 'a') as checkpoint_file:
+            checkpoint_file.write(json.dumps(record) + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        self._add(record)
+
+    def cell_done(self, minx, miny):
+        return self._key(minx, miny) in self.cells
+
+    def well_done(self, minx, miny, well):
+        return well in self.wells.get(self._key(minx, miny), {})
+
+    def metadata(self, minx, miny):
+        return [
+            record for records in
+            self.wells.get(self._key(minx, miny), {}).values()
+            for record in records
+        ]
+
+    def add_well(self, minx, miny, well, metadata):
+        self._append(
+            {"cell": [minx, miny], "well": well, "metadata": metadata})
+
+    def add_cell(self, minx, miny):
+        self._append({"cell": [minx, miny], "done": True})
+
+
+def _prefetch(executor, function, items, ahead):
+    """
+    Maps function over items in executor, keeping at most `ahead` calls in
+    flight, and yields (item, result) tuples in the order of items.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= ahead:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def _store_well(h5_file, metadata, well_data, append=False):
+    """
+    Stores the measurements of a tube in a dataset named after its well and
+    tube.
+
+    :param append: add the measurements after the last one in an existing
+        dataset to it, instead of replacing the dataset.
+    :return: whether the tube has data.
+    """
+    # cast to float and handle faulty data.
+    data_ = [
+        [np.datetime64(d, 's').astype('f4'), v]
+        for d, v, f in well_data if f is None and v is not None
+    ]
+    name = metadata[0] + str(metadata[1])
+    if append and name in h5_file:
+        return _append_well(h5_file[name], data_)
+    if len(data_) == 0:
+        logger.info("Well %s %s doesn't contain data",
+                    metadata[0], metadata[1])
+        return False
+    data = np.array(data_)
+    logger.info(
+        "Got Feature: %s, size: %s", str(metadata), data.shape[0]
+    )
+    if name in h5_file:
+        del h5_file[name]
+        logger.warn("%s %s ALREADY EXISTS! Deleted.",
+                    metadata[0], str(metadata[1]))
+    dataset = h5_file.create_dataset(
+        name,
+        data.shape,
+        maxshape=(None, 2),
+        dtype='f4')
+    dataset[...] = data
+    return True
+
+
+def _append_well(dataset, data_):
+    """Appends the rows of data_ after the last timestamp of dataset."""
+    data = np.array(data_, dtype='f4').reshape(-1, 2)
+    if dataset.shape[0]:
+        data = data[data[:, 0] > dataset[:, 0].max()]
+    if data.shape[0]:
+        length = dataset.shape[0]
+        dataset.resize(length + data.shape[0], axis=0)
+        dataset[length:] = data
+        logger.info("Appended %d measurements to %s", data.shape[0],
+                    dataset.name)
+    return True
+
+
+def _last_years(filepath):
+    """
+    :return: dictionary with the year of the oldest last measurement of the
+        tubes of each well in an existing cell file.
+    """
+    if not os.path.exists(filepath):
+        return {}
+    years = {}
+    with h5py.File(filepath, "r", libver='latest') as h5_file:
+        for record in h5_file.get("metadata", []):
+            well, tube = (v.decode('utf8') for v in record[:2])
+            dataset = h5_file.get(well + tube)
+            if dataset is None or not dataset.shape[0]:
                 continue
-            data = np.array(data_)
-            logger.info(
-                "Got Feature: %s, size: %s", str(metadata), data.shape[0]
-            )
-            try:
-                dataset = h5_file.create_dataset(
-                    metadata[0] + str(metadata[1]),
-                    data.shape,
-                    maxshape=(None, 2),
-                    dtype='f4')
-            except RuntimeError:
-                del h5_file[metadata[0] + str(metadata[1])]
-                dataset = h5_file.create_dataset(
-                    metadata[0] + str(metadata[1]),
-                    data.shape,
-                    maxshape=(None, 2),
-                    dtype='f4')
-                logger.warn("%s %s ALREADY EXISTS! Deleted.",
-                            metadata[0], str(metadata[1]))
-            if dataset.shape != data.shape:
-                dataset.resize(data.shape)
-                logger.warn("%s %s HAS WRONG SHAPE! Resized.",
-                            metadata[0], str(metadata[1]))
-            dataset[...] = data
-            meta_data.append([str(x) for x in metadata])
-            changed = True
-        if changed:
-            meta_data_array = np.array([[u.encode('utf8') for u in record]
-                                        for record in meta_data])
-            try:
-                meta_dataset = h5_file.create_dataset(
-                    "metadata", meta_data_array.shape,
-                    dtype=str(meta_data_array.dtype)
+            year = int(str(
+                dataset[:, 0].max().astype('int64').astype('datetime64[s]')
+            )[:4])
+            years[well] = min(years.get(well, year), year)
+    return years
+
+
+def _read_metadata(h5_file):
+    return [
+        [v.decode('utf8') for v in record]
+        for record in h5_file.get("metadata", [])
+    ]
+
+
+def _store_metadata(h5_file, meta_data):
+    meta_data_array = np.array([[u.encode('utf8') for u in record]
+                                for record in meta_data])
+    if "metadata" in h5_file:
+        del h5_file["metadata"]
+    meta_dataset = h5_file.create_dataset(
+        "metadata", meta_data_array.shape,
+        dtype=str(meta_data_array.dtype)
+    )
+    meta_dataset[...] = meta_data_array
+
+
+def download_hdf5(skip=0, filename_base=FILENAME_BASE, wfs_workers=2,
+                  soap_workers=4, url=WFS_URL, layer_name=WFS_LAYER_NAME,
+                  wfs_factory=None, soap_factory=None, sliding_window=None,
+                  update=False, wfs_attempts=5, sleep=time.sleep,
+                  **load_kwargs):
+    """
+    Harvests all DINO wells to one HDF5 file per sliding window grid cell.
+
+    WFS requests for the next grid cells and SOAP requests for the wells
+    within a grid cell run concurrently in bounded thread pools. Each
+    finished well is stored and checkpointed right away, so a rerun after a
+    crash resumes with the unfinished wells of the unfinished grid cells.
+
+    :param update: update the files of an earlier harvest. Only the years
+        from the last measurement of a well are requested and the new
+        measurements are appended to its series. An update has a
+        checkpoint per day.
+    :param wfs_attempts: number of attempts of the WFS request and the
+        parsing of its features of a grid cell, with an exponential backoff
+        with jitter in between.
+    :param wfs_factory: creates a WFS client, one per thread.
+    :param soap_factory: creates a SOAP client, one per thread.
+    :param sliding_window: iterable with (minx, miny, maxx, maxy) grid
+        cells, defaults to the sliding window over the Netherlands.
+    """
+    wfs_factory = wfs_factory or (
+        lambda: WebFeatureService(url=url, version='2.0.0'))
+    soap_factory = soap_factory or (lambda: SoapClient(WSDL_URL))
+    clients = threading.local()
+
+    def client(name, factory):
+        if not hasattr(clients, name):
+            setattr(clients, name, factory())
+        return getattr(clients, name)
+
+    def features(cell):
+        minx, miny, maxx, maxy = cell
+        # a broken stream fails in iterparse, with a urllib3 error or
+        # truncated XML.
+        return http_utils.retry(
+            lambda: list(get_features(
+                client('wfs', wfs_factory), layer_name, minx, miny, maxx,
+                maxy, client('http', http_utils.session))),
+            attempts=wfs_attempts,
+            exceptions=(
+                requests.RequestException, urllib3.exceptions.HTTPError,
+                ElementTree.ParseError),
+            base=BACKOFF_BASE, sleep=sleep)
+
+    def well(feature, start_year=FIRST_YEAR):
+        return load_well(
+            feature, client('soap', soap_factory), start_year=start_year,
+            sleep=sleep, **load_kwargs)
+
+    checkpoint = Checkpoint(os.path.join(
+        utils.DATA, filename_base,
+        "update_{:%Y%m%d}.jsonl".format(datetime.date.today()) if update
+        else "checkpoint.jsonl"
+    ))
+    if sliding_window is None:
+        sliding_window = groundwater_timenet.geo_utils.sliding_geom_window(
+            'NederlandRegion.json')
+    cells = (
+        cell for i, cell in enumerate(sliding_window)
+        if i >= skip and not checkpoint.cell_done(*cell[:2])
+    )
+    total_count = 0
+    with ThreadPoolExecutor(max_workers=wfs_workers) as wfs_executor, \
+            ThreadPoolExecutor(max_workers=soap_workers) as soap_executor:
+        for (minx, miny, _, _), cell_features in _prefetch(
+                wfs_executor, features, cells, wfs_workers):
+            filepath = utils.parse_filepath(minx, miny, filename_base)
+            start_years = _last_years(filepath) if update else {}
+            futures = {
+                soap_executor.submit(
+                    well, feature, start_years.get(feature[0], FIRST_YEAR)
+                ): feature[0]
+                for feature in cell_features
+                if not checkpoint.well_done(minx, miny, feature[0])
+            }
+            errors = []
+            with h5py.File(filepath, "a", libver='latest') as h5_file:
+                for future in as_completed(futures):
+                    try:
+                        tubes = future.result()
+                    except Exception as e:
+                        # keep storing the other wells before giving up.
+                        logger.exception("Failed to load well %s",
+                                         futures[future])
+                        errors.append(e)
+                        continue
+                    meta_data = [
+                        [str(x) for x in metadata]
+                        for metadata, well_data in tubes
+                        if _store_well(
+                            h5_file, metadata, well_data, append=update)
+                    ]
+                    h5_file.flush()
+                    checkpoint.add_well(minx, miny, futures[future], meta_data)
+                meta_data = checkpoint.metadata(minx, miny)
+                if update:
+                    # keep the tubes that are no longer in the WFS.
+                    updated = {tuple(record[:2]) for record in meta_data}
+                    meta_data += [
+                        record for record in _read_metadata(h5_file)
+                        if tuple(record[:2]) not in updated
+                    ]
+                if meta_data:
+                    _store_metadata(h5_file, meta_data)
+            if errors:
+                raise errors[0]
+            if meta_data:
+                count = len(meta_data)
+                total_count += count
+                logger.info(
+                    'Downloaded %d wells to %s. Total count: %d.',
+                    count, filepath, total_count
                 )
-            except RuntimeError:
-                meta_dataset = h5_file.get("metadata")
-            meta_dataset[...] = meta_data_array
-            count = len(meta_data)
-            total_count += count
-            logger.info(
-                'Downloaded %d wells to %s. Total count: %d, next time, skip '
-                '%d valid grid cells.', count, filepath, total_count, skip
-            )
-        if not changed:
-            os.remove(filepath)
-        skip += 1
-        with open(skip_filepath, 'w') as skip_file:
-            skip_file.write(str(skip))
+            else:
+                os.remove(filepath)
+            checkpoint.add_cell(minx, miny)
 
 
 if __name__ == "__main__":
-    skip_filepath = os.path.join(utils.DATA, FILENAME_BASE, "skip_count.txt")
-    utils.mkdirs(skip_filepath)
-    try:
-        with open(skip_filepath, 'r') as skip_file:
-            skip = int(skip_file.read())
-    except OSError:
-        skip = 0
-    download_hdf5(skip, FILENAME_BASE)
+    parser = argparse.ArgumentParser(
+        description="Harvests the DINO groundwater wells.")
+    parser.add_argument(
+        "--update", action="store_true",
+        help="only request the measurements after the last stored one of "
+             "each well and append them")
+    download_hdf5(
+        filename_base=FILENAME_BASE, update=parser.parse_args().update)
@@ -1,30 +1,208 @@
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import base64
+import hashlib
+import json
 import os
 
+import requests
+
+from groundwater_timenet import http_utils
 from groundwater_timenet import utils
 
 
 logger = utils.setup_logging(__name__, utils.HARVEST_LOG)
 GEOTOP_URL = "http://www.dinodata.nl/opendap/GeoTOP/geotop.nc"
 CHUNK = 16 * 1024
+SEGMENT = 64 * 1024 * 1024
+
+
+class RangesIgnored(Exception):
+    """The server sent the whole file in reply to a Range request."""
 
 
-def download_large_file(url, filepath):
+def _stream_file(http_session, url, filepath):
     """
     Stackoverflow is your friend:
     https://stackoverflow.com/questions/1517616/
         stream-large-binary-files-with-urllib2-to-file#answer-1517728
     Kudos to Alex Martelli.
     """
-    response = urlopen(url)
-    with open(filepath, 'wb') as f:
-        while True:
-            chunk = response.read(CHUNK)
-            if not chunk:
-                break
-            f.write(chunk)
+    with http_session.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(filepath, 'wb') as f:
+            for chunk in response.iter_content(CHUNK):
+                f.write(chunk)
+
+
+def _read_journal(journal_filepath, url, size, etag, segment_size):
+    """Returns the finished segments of a previous download, if any."""
+    try:
+        with open(journal_filepath, 'r') as journal_file:
+            journal = json.load(journal_file)
+    except (OSError, ValueError):
+        return set()
+    if (journal.get('url'), journal.get('size'), journal.get('etag'),
+            journal.get('segment_size')) != (url, size, etag, segment_size):
+        logger.info("Remote file changed, discarding journal %s",
+                    journal_filepath)
+        return set()
+    return set(journal.get('done', []))
+
+
+def _write_journal(journal_filepath, url, size, etag, segment_size, done):
+    with open(journal_filepath + '.tmp', 'w') as journal_file:
+        json.dump({
+            'url': url,
+            'size': size,
+            'etag': etag,
+            'segment_size': segment_size,
+            'done': sorted(done)
+        }, journal_file)
+    os.replace(journal_filepath + '.tmp', journal_filepath)
+
+
+def _download_segment(http_session, url, fd, start, end):
+    response = http_session.get(
+        url, headers={'Range': 'bytes={}-{}'.format(start, end)},
+        stream=True, timeout=60)
+    with response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangesIgnored("Server ignored range request for " + url)
+        offset = start
+        for chunk in response.iter_content(CHUNK):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    if offset != end + 1:
+        raise IOError("Incomplete segment {}-{} of {}: got {} bytes".format(
+            start, end, url, offset - start))
+
+
+def _remove(filepath):
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def file_checksum(filepath, algorithm='sha256'):
+    checksum = hashlib.new(algorithm)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(SEGMENT), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def download_large_file(url, filepath, workers=4, segment_size=SEGMENT,
+                        checksum=None, http_session=None, attempts=5):
+    """
+    Downloads a large file in HTTP Range segments that are fetched
+    concurrently and written in place in a preallocated file.
+
+    Finished segments are recorded in a journal next to the file, so a
+    broken download resumes with the missing segments. Servers without
+    Range support, or that answer the Range requests with the whole file,
+    get a plain streamed download.
+
+    Every segment is checked to have its full size. The file as a whole is
+    only verified when a checksum is known.
+
+    :param checksum: expected (algorithm, hexdigest) of the file. When it is
+        not given the Content-MD5 header of the server is used, if any.
+    """
+    http_session = http_session or http_utils.session(pool_size=workers)
+    head = http_session.head(url, allow_redirects=True, timeout=60)
+    head.raise_for_status()
+    size = head.headers.get('Content-Length')
+    if head.headers.get('Accept-Ranges') != 'bytes' or size is None:
+        logger.info("%s does not support ranges, streaming it.", url)
+        _stream_file(http_session, url, filepath)
+        return
+    size = int(size)
+    if checksum is None and 'Content-MD5' in head.headers:
+        checksum = (
+            'md5', base64.b64decode(head.headers['Content-MD5']).hex())
+    etag = head.headers.get('ETag')
+    partial_filepath = filepath + '.part'
+    journal_filepath = filepath + '.journal'
+    segments = [
+        (start, min(start + segment_size, size) - 1)
+        for start in range(0, size, segment_size)
+    ]
+    done = _read_journal(journal_filepath, url, size, etag, segment_size)
+    if not os.path.exists(partial_filepath):
+        done = set()
+    utils.mkdirs(partial_filepath)
+    fd = os.open(partial_filepath, os.O_RDWR | os.O_CREAT)
+    errors = []
+    try:
+        os.ftruncate(fd, size)
+        todo = [i for i in range(len(segments)) if i not in done]
+        logger.info("Downloading %d of %d segments of %s.",
+                    len(todo), len(segments), url)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # the first segment is fetched on its own, it tells whether the
+            # server serves ranges at all.
+            for batch in (todo[:1], todo[1:]):
+                futures = {
+                    executor.submit(
+                        http_utils.retry,
+                        lambda i=i: _download_segment(
+                            http_session, url, fd, *segments[i]),
+                        attempts=attempts,
+                        exceptions=(requests.RequestException, IOError)
+                    ): i for i in batch
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except (requests.RequestException, IOError) as e:
+                        # keep journaling the other segments before giving
+                        # up.
+                        errors.append(e)
+                        continue
+                    done.add(futures[future])
+                    _write_journal(
+                        journal_filepath, url, size, etag, segment_size, done)
+        os.fsync(fd)
+        ranges = True
+    except RangesIgnored:
+        ranges = False
+    finally:
+        os.close(fd)
+    if not ranges:
+        logger.info("%s ignores range requests, streaming it.", url)
+        _remove(journal_filepath)
+        _stream_file(http_session, url, partial_filepath)
+    if errors:
+        raise errors[0]
+    if checksum is not None:
+        algorithm, expected = checksum
+        actual = file_checksum(partial_filepath, algorithm)
+        if actual != expected.lower():
+            _remove(journal_filepath)
+            raise IOError("{} checksum of {} is {}, expected {}".format(
+                algorithm, url, actual, expected))
+    os.replace(partial_filepath, filepath)
+    _remove(journal_filepath)
 
 
-def download(filename='geotop.nc'):
+def download(filename='geotop.nc', sha256=None):
+    """
+    :param sha256: expected SHA-256 hexdigest of the file. Without it the
+        file is only verified when the server sends a Content-MD5 header.
+    """
     filepath = os.path.join(utils.DATA, 'geotop', filename)
-    download_large_file(GEOTOP_URL, filepath)
+    download_large_file(
+        GEOTOP_URL, filepath,
+        checksum=None if sha256 is None else ('sha256', sha256))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Downloads the national GeoTOP netCDF.")
+    parser.add_argument(
+        "--sha256", metavar="DIGEST",
+        help="verify the downloaded file against this SHA-256 hexdigest")
+    download(sha256=parser.parse_args().sha256)
@@ -1,11 +1,15 @@
-import io
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed)
 import os
 import re
 import zipfile
 
-import requests
+import h5py
 import numpy as np
+import pandas as pd
+import requests
 
+from groundwater_timenet import http_utils
 from groundwater_timenet import utils
 
 
@@ -47,41 +51,128 @@ def download_measurementstation_metadata():
         f.write(response.text)
 
 
-def load_knmi_measurement_data(target_dir='var/data/knmi_measurementstations'):
-    """Downloads all knmi measurementstation data to target_dir."""
-    urls = ((code, STATION_URL.format(code=code)) for code in STATION_CODES)
-    utils.mkdirs(target_dir)
-    for code, url in urls:
-        response = requests.get(url)
-        zf = zipfile.ZipFile(io.BytesIO(response.content))
-        zf.extractall(path=target_dir)
-        logger.debug("Collected measurement data for station %s", code)
-
-
-def _measurement_stations(directory):
-    for filename in os.listdir(directory):
-        if 'etmgeg' in filename:
-            id_ = filename.replace('etmgeg_', '').replace('.txt', '')
-            path = os.path.join(directory, filename)
-            with open(path, 'r') as f:
-                data = f.read().split(HEADER)[1]
-                data_lines = data.split('\n')
-                yield (id_, [
-                    [utils.int_or_nan(l) for l in line.split(',')]
-                    for line in data_lines
-                    if line
-                    ])
+def _download_station(http_session, url, filepath, validators):
+    downloaded, validators = http_utils.conditional_download(
+        http_session, url, filepath, validators)
+    if downloaded:
+        try:
+            with zipfile.ZipFile(filepath) as zf:
+                broken = zf.testzip()
+        except zipfile.BadZipFile:
+            broken = filepath
+        if broken is not None:
+            os.remove(filepath)
+            raise IOError("Corrupt zip {} ({})".format(url, broken))
+    return downloaded, validators
+
+
+def load_knmi_measurement_data(
+        target_dir='var/data/knmi_measurementstations', workers=8,
+        station_codes=STATION_CODES, station_url=STATION_URL,
+        http_session=None, attempts=5):
+    """
+    Downloads all knmi measurementstation data to target_dir.
+
+    Stations are downloaded concurrently by at most `workers` threads that
+    share one pooled session. The zips are streamed to target_dir and only
+    extracted when they changed since the previous run.
+
+    A failed download, or a corrupt zip, is tried `attempts` times with
+    exponential backoff. The default session does not retry on its own.
+    """
+    validators_filepath = os.path.join(target_dir, 'validators.json')
+    validators = http_utils.read_validators(validators_filepath)
+    http_session = http_session or http_utils.session(
+        pool_size=workers, retries=0)
+    utils.mkdirs(validators_filepath)
+
+    def download(code):
+        url = station_url.format(code=code)
+        filepath = os.path.join(target_dir, 'etmgeg_{}.zip'.format(code))
+        return http_utils.retry(
+            lambda: _download_station(
+                http_session, url, filepath, validators.get(url)),
+            attempts=attempts,
+            exceptions=(requests.RequestException, IOError)
+        ) + (url, filepath)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download, code): code for code in station_codes}
+        for future in as_completed(futures):
+            code = futures[future]
+            downloaded, url_validators, url, filepath = future.result()
+            validators[url] = url_validators
+            if not downloaded:
+                logger.debug("Measurement data for station %s unchanged", code)
+                continue
+            with zipfile.ZipFile(filepath) as zf:
+                zf.extractall(path=target_dir)
+            http_utils.write_validators(validators, validators_filepath)
+            logger.debug("Collected measurement data for station %s", code)
+
+
+def parse_etmgeg(path):
+    """
+    Parses an etmgeg_*.txt file with daily measurement station data.
+
+    The file is streamed: the preamble is skipped line by line up to the
+    HEADER and the remainder is read by the pandas C parser.
+
+    :return: tuple with an int32 array of values and a boolean array that is
+        True where values are missing.
+    """
+    with open(path, 'r') as f:
+        line = f.readline()
+        while line and line != HEADER:
+            line = f.readline()
+        if not line:
+            raise ValueError("No header found in {}".format(path))
+        data = pd.read_csv(
+            f, header=None, skipinitialspace=True, dtype=np.float64,
+            na_values=[''], engine='c'
+        ).values
+    mask = np.isnan(data)
+    values = np.where(mask, 0, data).astype('int32')
+    return values, mask
+
+
+def _parse_station(path):
+    values, mask = parse_etmgeg(path)
+    data = values.astype('float64')
+    data[mask] = np.nan
+    return data
+
+
+def _measurement_stations(directory, workers=None):
+    paths = {
+        filename.replace('etmgeg_', '').replace('.txt', ''):
+            os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if 'etmgeg' in filename and filename.endswith('.txt')
+    }
+    with utils.worker_logging() as logging_kwargs, ProcessPoolExecutor(
+            max_workers=workers, **logging_kwargs) as executor:
+        futures = {
+            executor.submit(_parse_station, path): id_
+            for id_, path in paths.items()
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
 
 def cache_measurement_station_data(
-        directory='var/data/knmi_measurementstations'):
-    station_data = dict(_measurement_stations(directory))
-    utils.store_h5(
-        data=[np.array(d) for d in station_data.values()],
-        dataset_name=[str(k) for k in station_data.keys()],
-        target_h5="var/data/knmi/measurementstations.h5",
-        many=True
-    )
+        directory='var/data/knmi_measurementstations',
+        target_h5="var/data/knmi/measurementstations.h5", workers=None):
+    """
+    Parses the stations in parallel and writes each station to its dataset
+    as soon as it is parsed.
+    """
+    utils.mkdirs(target_h5)
+    with h5py.File(target_h5, "w", libver='latest') as h5_file:
+        for id_, data in _measurement_stations(directory, workers):
+            h5_file.create_dataset(str(id_), data=data)
+            logger.debug("Cached measurement data for station %s", id_)
 
 
 def reshape_rasters(root, grid_size=50):
@@ -7,6 +7,8 @@ distributions can be found in exploration/distributions and the charts in
 exploration/images.
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
 import json
 import os
 
@@ -22,7 +24,75 @@ from groundwater_timenet.utils import raster_filenames
 from abc import abstractproperty, abstractmethod, ABCMeta
 
 
+logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
+
+
+class Histogram(object):
+    """
+    Counts of integer values as an array of counts that starts at offset.
+    Masked values are counted separately.
+    """
+
+    def __init__(self, offset=0, counts=None, masked=0):
+        self.offset = offset
+        self.counts = np.zeros(0, dtype='int64') if counts is None else counts
+        self.masked = masked
+
+    @classmethod
+    def of(cls, values):
+        values = np.ma.asarray(values)
+        masked = int(np.ma.count_masked(values))
+        data = values.compressed().astype('int64')
+        if data.size == 0:
+            return cls(masked=masked)
+        offset = int(data.min())
+        return cls(offset, np.bincount(data - offset), masked)
+
+    def __add__(self, other):
+        masked = self.masked + other.masked
+        if not other.counts.size:
+            return Histogram(self.offset, self.counts, masked)
+        if not self.counts.size:
+            return Histogram(other.offset, other.counts, masked)
+        offset = min(self.offset, other.offset)
+        end = max(self.offset + self.counts.size,
+                  other.offset + other.counts.size)
+        counts = np.zeros(end - offset, dtype='int64')
+        for histogram in (self, other):
+            start = histogram.offset - offset
+            counts[start:start + histogram.counts.size] += histogram.counts
+        return Histogram(offset, counts, masked)
+
+    def to_json(self):
+        return {
+            "offset": self.offset,
+            "counts": self.counts.tolist(),
+            "masked": self.masked
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["offset"], np.array(data["counts"], dtype='int64'),
+            data["masked"])
+
+    def to_dict(self):
+        counts = {
+            str(self.offset + int(i)): int(self.counts[i])
+            for i in np.flatnonzero(self.counts)
+        }
+        if self.masked:
+            counts["--"] = self.masked
+        return counts
+
+
+def _slab_histogram(counts_class, key, slab):
+    return counts_class.slab_histogram(key, slab)
+
+
 class Counts(dict, metaclass=ABCMeta):
+    # number of processes that count the slabs, None uses all cpus.
+    workers = None
 
     def __init__(self, cache_json=False, use_cache=True, count=False):
         self._cache = cache_json
@@ -48,19 +118,112 @@ class Counts(dict, metaclass=ABCMeta):
     def json_filepath(self):
         return os.path.join("exploration", "distributions", self.json_filename)
 
+    def slabs(self, key):
+        """
+        Picklable descriptions of the parts of a dataset that are counted by
+        slab_histogram in a worker process. Without slabs dataset_generator is
+        counted in this process. Counts with slabs define a read_slab class
+        method, or override slab_histogram.
+        """
+        return []
+
+    @classmethod
+    def slab_histogram(cls, key, slab):
+        return cls.histogram(cls.read_slab(key, slab))
+
+    @staticmethod
+    def histogram(dataset):
+        return Histogram.of(dataset)
+
+    @property
+    def checkpoint_filepath(self):
+        return os.path.join(
+            utils.DATA, "cache", "partial_" + self.json_filename)
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_filepath, 'r') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_checkpoint(self, checkpoint):
+        utils.mkdirs(self.checkpoint_filepath)
+        with open(self.checkpoint_filepath + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(self.checkpoint_filepath + '.tmp', self.checkpoint_filepath)
+
+    def slab_version(self, key, slab):
+        """
+        Description of the content of a slab, which changes when the data
+        it reads changes.
+        """
+        return repr(slab)
+
+    def _slab_id(self, key, slab):
+        return hashlib.md5(
+            self.slab_version(key, slab).encode('utf8')).hexdigest()
+
+    def _reduce_slabs(self, key, slabs):
+        """
+        Counts the slabs in worker processes and merges their histograms.
+
+        The merged histogram, the slabs and the finished slabs are
+        checkpointed after every slab, so an interrupted count resumes with
+        the remaining slabs. When the slabs changed since, such as when
+        files were added, the count starts over instead of counting slabs
+        twice.
+        """
+        slab_ids = [self._slab_id(key, slab) for slab in slabs]
+        checkpoint = self._read_checkpoint()
+        partial = checkpoint.get(key, {})
+        if partial and partial.get("slabs") != slab_ids:
+            logger.warn(
+                "The slabs of %s changed since the checkpoint, counting "
+                "all slabs again", key)
+            partial = {}
+        histogram = Histogram.from_json(partial) if partial else Histogram()
+        done = set(partial.get("done", []))
+        todo = {
+            slab_id: slab for slab_id, slab in zip(slab_ids, slabs)
+            if slab_id not in done
+        }
+        logger.info(
+            "Counting %d of %d slabs of %s", len(todo), len(slabs), key)
+        with utils.worker_logging() as logging_kwargs, ProcessPoolExecutor(
+                max_workers=self.workers, **logging_kwargs) as executor:
+            futures = {
+                executor.submit(_slab_histogram, type(self), key, slab):
+                    slab_id for slab_id, slab in todo.items()
+            }
+            errors = []
+            for future in as_completed(futures):
+                try:
+                    histogram += future.result()
+                except Exception as e:
+                    # keep checkpointing the other slabs before giving up.
+                    logger.exception("Failed to count slab of %s", key)
+                    errors.append(e)
+                    continue
+                done.add(futures[future])
+                checkpoint[key] = dict(
+                    histogram.to_json(), done=sorted(done), slabs=slab_ids)
+                self._write_checkpoint(checkpoint)
+        if errors:
+            raise errors[0]
+        return histogram
+
     def _unique_counts(self, key):
-        # we iterate over the file in 100-size steps over the j-axis since the
-        # file is to large to handle at once in memory
-        all_unique = [
-            (str(value), counts[ii]) for values, counts in [
-                np.unique(dataset, return_counts=True) for dataset in
-                self.dataset_generator(key)
-            ] for ii, value in enumerate(values)
-        ]
-        unique_counts = {}
-        for k, v in all_unique:
-            unique_counts[k] = unique_counts.get(k, 0) + v
-        return unique_counts
+        slabs = self.slabs(key)
+        if slabs:
+            histogram = self._reduce_slabs(key, slabs)
+        else:
+            histogram = sum(
+                (self.histogram(dataset) for dataset in
+                 self.dataset_generator(key)),
+                Histogram()
+            )
+        return histogram.to_dict()
 
     def count(self):
         """
@@ -75,6 +238,8 @@ class Counts(dict, metaclass=ABCMeta):
         })
         if self._cache:
             self.cache()
+        if os.path.exists(self.checkpoint_filepath):
+            os.remove(self.checkpoint_filepath)
 
     def cache(self):
         """
@@ -156,14 +321,32 @@ class Geotop(Plots):
     dataset_names = parse.geotop.RELEVANT_VARIABLES
     png_base = 'geotop'
 
+    filepath = os.path.join(utils.DATA, 'geotop', "geotop.nc")
+    slab_size = 100
+
     def __init__(self, *args, **kwargs):
+        self.geotop = Dataset(self.filepath, "r")
         super(Geotop, self).__init__(*args, **kwargs)
-        filepath = os.path.join(utils.DATA, 'geotop', "geotop.nc")
-        self.geotop = Dataset(filepath, "r")
 
     def dataset_generator(self, key):
-        for j in range(0, self.geotop[key].shape[1], 100):
-            yield self.geotop[key][:, j:j + 100, :]
+        for slab in self.slabs(key):
+            yield self.read_slab(key, slab)
+
+    def slabs(self, key):
+        # we iterate over the file in 100-size steps over the j-axis since the
+        # file is to large to handle at once in memory
+        return [
+            (j, j + self.slab_size) for j in
+            range(0, self.geotop[key].shape[1], self.slab_size)
+        ]
+
+    def slab_version(self, key, slab):
+        return utils.files_version([self.filepath]) + repr(slab)
+
+    @classmethod
+    def read_slab(cls, key, slab):
+        with Dataset(cls.filepath, "r") as geotop:
+            return geotop[key][:, slab[0]:slab[1], :]
 
     def plot(self):
         self.percent_plot(tuple('kans_' + str(j + 1) for j in range(9)))
@@ -188,17 +371,42 @@ class Knmi(Plots):
     fraction = {'et': 10, 'rain': 0.01}
     png_base = 'knmi'
 
+    files_per_slab = 50
+
     def __init__(self, *args, **kwargs):
-        super(Knmi, self).__init(*args, **kwargs)
         self.filenames = {
             'et': raster_filenames(root='et'),
             'rain': raster_filenames(root='rain'),
         }
+        super(Knmi, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def read_raster(cls, key, filepath):
+        return (utils.read_h5(filepath, cls.subdataset_name[key]) *
+                cls.fraction[key]).astype('int')
 
     def dataset_generator(self, key):
         for filepath in self.filenames[key]:
-            yield (utils.read_h5(filepath, self.subdataset_name[key]) *
-                   self.fraction[key]).astype('int')
+            yield self.read_raster(key, filepath)
+
+    def slabs(self, key):
+        filenames = self.filenames[key]
+        return [
+            tuple(filenames[i:i + self.files_per_slab]) for i in
+            range(0, len(filenames), self.files_per_slab)
+        ]
+
+    def slab_version(self, key, slab):
+        return utils.files_version(slab)
+
+    @classmethod
+    def slab_histogram(cls, key, slab):
+        # rasters are counted one by one to keep the worker memory bounded.
+        return sum(
+            (cls.histogram(cls.read_raster(key, filepath))
+             for filepath in slab),
+            Histogram()
+        )
 
     def plot(self):
         for key in self.dataset_names:
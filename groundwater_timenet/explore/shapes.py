@@ -3,9 +3,11 @@ This gives a feel for the shape of the rasters the dino data and how they
 intersect with the sliding window.
 """
 
+import itertools
+import os
 import shutil
 
-from osgeo import ogr, osr, gdal
+from osgeo import ogr, osr
 import h5py
 import numpy as np
 import pandas as pd
@@ -13,14 +15,37 @@ import pandas as pd
 import groundwater_timenet.utils
 from groundwater_timenet.utils import mkdirs
 from groundwater_timenet.utils import cache_h5
-from groundwater_timenet.geo_utils import transform, point, bbox2polygon, sliding_geom_window
+from groundwater_timenet.geo_utils import (
+    transform, transform_many, apply_geo_transform, point, points,
+    bbox2polygon, sliding_geom_window)
 from groundwater_timenet.parse import dino
 from groundwater_timenet.parse import knmi
 
 
+SHAPE_DRIVERS = {"ESRI Shapefile": ".shp", "GPKG": ".gpkg"}
+BATCH_SIZE = 50000
+
+
+def _transaction(layer, method):
+    error = getattr(layer, method)()
+    if error != ogr.OGRERR_NONE:
+        raise RuntimeError("{} of layer {} failed with OGR error {}".format(
+            method, layer.GetName(), error))
+
+
 def make_shape(filepath, fields, features, geometry_type, layername="data",
-               bboxgeom=None):
-    driver = ogr.GetDriverByName("ESRI Shapefile")
+               bboxgeom=None, driver_name="ESRI Shapefile",
+               batch_size=BATCH_SIZE):
+    """
+    Writes features to a new data source. Features are written in layer
+    transactions of batch_size features when the driver supports them,
+    such as GPKG. Shapefiles are written without transactions.
+
+    :param driver_name: "ESRI Shapefile" or the faster "GPKG" (GeoPackage).
+        The extension of filepath is changed to match the driver.
+    """
+    driver = ogr.GetDriverByName(driver_name)
+    filepath = os.path.splitext(filepath)[0] + SHAPE_DRIVERS[driver_name]
     data_source = driver.CreateDataSource(filepath)
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(28992)
@@ -34,38 +59,43 @@ def make_shape(filepath, fields, features, geometry_type, layername="data",
     for name, field_defn in fields:
         field_name = ogr.FieldDefn(name, field_defn)
         layer.CreateField(field_name)
-    for geom, values in features:
-        feature = ogr.Feature(layer.GetLayerDefn())
-        for i, (name, _) in enumerate(fields):
-            feature.SetField(name, values[i])
-        feature.SetGeometry(geom)
+    layer_definition = layer.GetLayerDefn()
+    field_indexes = range(len(fields))
+    transactions = layer.TestCapability(ogr.OLCTransactions)
+    if transactions:
+        _transaction(layer, "StartTransaction")
+    for count, (geom, values) in enumerate(features, 1):
+        feature = ogr.Feature(layer_definition)
+        for i in field_indexes:
+            feature.SetField(i, values[i])
+        feature.SetGeometryDirectly(geom)
         layer.CreateFeature(feature)
-        feature = None
+        if transactions and not count % batch_size:
+            _transaction(layer, "CommitTransaction")
+            _transaction(layer, "StartTransaction")
+    if transactions:
+        _transaction(layer, "CommitTransaction")
+    feature = None
     data_source = None
 
 
-def sliding_window():
+def sliding_window(driver_name="ESRI Shapefile"):
     filepath = "var/data/shapes/slidinggeom/slide.shp"
     features = (
         (bbox2polygon(*coords), coords) for coords in sliding_geom_window())
     geometry_type = ogr.wkbMultiPolygon
     layername = "windows"
     fields = [(name, ogr.OFTReal) for name in ("minx", "miny", "maxx", "maxy")]
-    make_shape(filepath, fields, features, geometry_type, layername)
+    make_shape(filepath, fields, features, geometry_type, layername,
+               driver_name=driver_name)
 
 
 def points_array(example_file):
     h5file = h5py.File(example_file, 'r', libver='latest')
     lat = h5file.get('lat')
     lon = h5file.get('lon')
-    return np.array([
-        [
-            p.GetPoint() for p in (
-                point(float(lon[x, y]), float(lat[x, y])) for x in
-                range(350)
-            ) if not transform(p)
-        ] for y in range(300)
-    ])
+    xs, ys = transform_many(lon[:350, :300].T, lat[:350, :300].T)
+    return np.stack([xs, ys, np.zeros_like(xs)], axis=-1)
 
 
 def points_list(ex_et_file, source_netcdf="var/data/cache/et_points.h5"):
@@ -80,38 +110,44 @@ def points_list(ex_et_file, source_netcdf="var/data/cache/et_points.h5"):
     ]
 
 
-def knmi_et_point_cloud():
+def knmi_et_point_cloud(driver_name="ESRI Shapefile"):
     filepath = "var/data/shapes/knmi/et_pointcloud.shp"
     et_files = groundwater_timenet.utils.raster_filenames(root="et")
-    et_points = points_list(et_files[6])
-    features = ((j, None) for i in et_points for j in i)
+    array = cache_h5(
+        points_array, "var/data/cache/et_points.h5",
+        example_file=et_files[6],
+    )
+    features = zip(
+        points(array[..., 0].ravel(), array[..., 1].ravel()),
+        itertools.repeat(())
+    )
     geometry_type = ogr.wkbPoint
     fields = ()
     layername = "et"
-    make_shape(filepath, fields, features, geometry_type, layername)
+    make_shape(filepath, fields, features, geometry_type, layername,
+               driver_name=driver_name)
 
 
-def knmi_rain_point_cloud():
+def knmi_rain_point_cloud(driver_name="ESRI Shapefile"):
     filepath = "var/data/shapes/knmi/rain_pointcloud.shp"
-    rain_proj = osr.SpatialReference(osr.GetUserInputAsWKT(
-        '+proj=stere +lat_0=90 +lon_0=0 +lat_ts=60 +a=6378.14 +b=6356.75 '
-        '+x_0=0 y_0=0'))
-    rd_proj = osr.SpatialReference(osr.GetUserInputAsWKT('epsg:28992'))
-    coord_transform = osr.CoordinateTransformation(rain_proj, rd_proj)
     affine = (0.0, 1.0, 0, -3649.9802, 0, -1.0)
-    features = [
-        (point(*coord_transform.TransformPoint(
-            *gdal.ApplyGeoTransform(affine, column, row))[:2]), (row, column))
-        for column in range(700) for row in range(765)
-    ]
+    columns, rows = (
+        a.ravel() for a in np.meshgrid(np.arange(700), np.arange(765)))
+    rd_xs, rd_ys = transform_many(
+        *apply_geo_transform(affine, columns, rows),
+        src=knmi.RAIN_PROJECTION, dst=28992
+    )
+    features = zip(points(rd_xs, rd_ys), zip(rows.tolist(), columns.tolist()))
     geometry_type = ogr.wkbPoint
     fields = (("row", ogr.OFTReal), ("column", ogr.OFTReal))
     layername = "rain"
-    bbox = transform(bbox2polygon(0.0, 48.9, 10.86, 55.97))
-    make_shape(filepath, fields, features, geometry_type, layername, bbox)
+    bbox = bbox2polygon(0.0, 48.9, 10.86, 55.97)
+    transform(bbox)
+    make_shape(filepath, fields, features, geometry_type, layername, bbox,
+               driver_name=driver_name)
 
 
-def dino_point_cloud():
+def dino_point_cloud(driver_name="ESRI Shapefile"):
     filepath = "var/data/shapes/dino/dino.shp"
     dino_data = dino.list_metadata()
     OGR_TYPES = {
@@ -137,15 +173,20 @@ def dino_point_cloud():
             OGR_TYPES[dino_data[column].dtype.kind]
         ) for column in dino_data.columns
     ]
-    features = [
-        [
-            point(int(metadata.x), int(metadata.y)),
-            [str(x) if isinstance(x, pd.Timestamp) else x for x in metadata]
-        ] for _, metadata in dino_data.iterrows()
+    columns = [
+        (dino_data[column].astype(str) if dino_data[column].dtype.kind == 'M'
+         else dino_data[column]).tolist()
+        for column in dino_data.columns
     ]
+    features = zip(
+        points(dino_data.x.values.astype(float),
+               dino_data.y.values.astype(float)),
+        zip(*columns)
+    )
     geometry_type = ogr.wkbPoint
     layername = "dino"
-    make_shape(filepath, fields, features, geometry_type, layername)
+    make_shape(filepath, fields, features, geometry_type, layername,
+               driver_name=driver_name)
 
 
 def geotop_point_cloud():
@@ -166,10 +207,10 @@ def os_clean_mkdir(delete_all=True):
         mkdirs(filepath)
 
 
-def create_shapes():
+def create_shapes(driver_name="ESRI Shapefile"):
     os_clean_mkdir()
-    dino_point_cloud()
-    sliding_window()
-    knmi_et_point_cloud()
-    knmi_rain_point_cloud()
+    dino_point_cloud(driver_name)
+    sliding_window(driver_name)
+    knmi_et_point_cloud(driver_name)
+    knmi_rain_point_cloud(driver_name)
     geotop_point_cloud()
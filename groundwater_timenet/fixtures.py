@@ -0,0 +1,299 @@
+"""
+Synthetic stand-ins for the source data.
+
+Writes small files in the formats of the DINO, KNMI, GeoTOP, BOFEK and DANK
+sources to the paths under var/data the parse modules read from, so the
+pipeline from parse to generator runs without the (many gigabyte) archive
+and without network. Run it in an empty working directory:
+
+    python -m groundwater_timenet.fixtures [scale]
+
+The number of wells grows with scale, the years of data and the extent of
+the area they are in can be set with write_fixtures.
+"""
+
+import datetime
+import os
+import sys
+
+from osgeo import gdal, ogr, osr
+import h5py
+import numpy as np
+import pandas as pd
+
+from groundwater_timenet import geo_utils
+from groundwater_timenet import utils
+from groundwater_timenet.collect import dino as collect_dino
+from groundwater_timenet.parse import geotop
+from groundwater_timenet.parse import other
+from groundwater_timenet.parse.knmi import (
+    WeatherStationData, RainData, EvapoTranspirationData)
+
+
+logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
+
+WELLS = 25
+YEARS = 10
+# 50 by 50 km around Utrecht (minx, miny, maxx, maxy) in RD New.
+EXTENT = (120000, 430000, 170000, 480000)
+END = datetime.date(2017, 12, 31)
+# Sliding window cell size of the DINO harvest.
+DINO_CELL_SIZE = 10000
+# Measurement interval of the DINO wells in days.
+DINO_STEP = 14
+# Dimensions of the national GeoTOP grid of 100 x 100 x 0.5 m voxels.
+GEOTOP_SHAPE = (2650, 2700, 312)
+# Number of BOFEK classes, the metadata size of the network depends on it.
+BOFEK_CLASSES = 74
+BOFEK_CELL_SIZE = 2500
+DRINKING_WATER_CELL_SIZE = 250
+
+
+def days(years=YEARS, end=END):
+    return pd.date_range(end - datetime.timedelta(days=365 * years), end,
+                         freq='D')
+
+
+def well_locations(count, extent=EXTENT, random=None):
+    """
+    :return: array with count rows of RD x, y and the NAP height of the top
+        of the filter.
+    """
+    random = random or np.random.RandomState(4177)
+    minx, miny, maxx, maxy = extent
+    return np.column_stack([
+        random.randint(minx, maxx, count),
+        random.randint(miny, maxy, count),
+        random.uniform(-20, 5, count).round(2)
+    ])
+
+
+def write_dino(wells, timestamps, random=None):
+    """
+    Writes one HDF5 file per sliding window cell with the well metadata and
+    a series per well, newest measurement first as DINO delivers them.
+    """
+    random = random or np.random.RandomState(4177)
+    measurements = timestamps[::-DINO_STEP]
+    seconds = measurements.values.astype('datetime64[s]').astype('f4')
+    cells = {}
+    for i, (x, y, z) in enumerate(wells):
+        cell = (int(x // DINO_CELL_SIZE * DINO_CELL_SIZE),
+                int(y // DINO_CELL_SIZE * DINO_CELL_SIZE))
+        cells.setdefault(cell, []).append((i, int(x), int(y), z))
+    for (minx, miny), cell_wells in cells.items():
+        filepath = utils.parse_filepath(
+            minx, miny, filename_base=collect_dino.FILENAME_BASE)
+        metadata = []
+        with h5py.File(filepath, "w") as h5_file:
+            for i, x, y, z in cell_wells:
+                wellcode = 'B{:07d}'.format(i)
+                levels = (
+                    random.normal(0, 3, len(seconds)).cumsum() +
+                    random.uniform(-300, 100)
+                )
+                metadata.append([
+                    wellcode, '001', str(x), str(y),
+                    str(measurements[-1].date()), str(measurements[0].date()),
+                    '1.0', '1.0', '2.0', '2.0',
+                    str(z), str(z), str(z - 1), str(z - 1)
+                ])
+                collect_dino._store_well(
+                    h5_file, metadata[-1], [
+                        (d, v, None) for d, v in zip(
+                            measurements.values, levels.astype('f4'))
+                    ])
+            collect_dino._store_metadata(h5_file, metadata)
+    logger.info("Wrote %d DINO wells in %d files", len(wells), len(cells))
+
+
+def write_knmi_tiles(source, coordinates, timestamps, dtype, nan,
+                     random=None):
+    """Writes the tiles of source that hold the coordinates."""
+    random = random or np.random.RandomState(4177)
+    source.build_lookup(coordinates[:, 0], coordinates[:, 1])
+    tiles = {tuple(source.tile(x, y)[:2]) for x, y in coordinates[:, :2]}
+    stamps = np.column_stack(
+        [timestamps.year, timestamps.month, timestamps.day])
+    for tile_x, tile_y in tiles:
+        data = random.randint(
+            0, 2000, (source.grid_size, source.grid_size, len(timestamps))
+        ).astype(dtype)
+        data[random.rand(*data.shape) < 0.01] = nan
+        utils.store_h5(
+            data=[data, stamps],
+            dataset_name=["data", "timestamps"],
+            target_h5=os.path.join(
+                'var', 'data', 'knmi', source.root, str(tile_x),
+                str(tile_y) + '.h5'),
+            many=True
+        )
+    logger.info("Wrote %d %s tiles", len(tiles), source.root)
+
+
+def write_weather_stations(timestamps, random=None):
+    """Writes all stations with the columns of the KNMI etmgeg files."""
+    random = random or np.random.RandomState(4177)
+    filepath = os.path.join(
+        'var', 'data', 'knmi', WeatherStationData.root + '.h5')
+    utils.mkdirs(filepath)
+    dates = timestamps.year * 10000 + timestamps.month * 100 + timestamps.day
+    with h5py.File(filepath, "w", libver='latest') as h5_file:
+        for code, _ in WeatherStationData.STATION_META:
+            data = random.randint(0, 500, (len(timestamps), 41)).astype(float)
+            data[:, 0] = int(code)
+            data[:, 1] = dates
+            h5_file.create_dataset(code, data=data)
+
+
+def write_geotop(coordinates, random=None):
+    """
+    Writes a GeoTOP netCDF with the dimensions of the national grid, of
+    which only the voxel columns under the coordinates are filled.
+    """
+    random = random or np.random.RandomState(4177)
+    filepath = os.path.join(utils.DATA, geotop.GeotopData.root, 'geotop.nc')
+    utils.mkdirs(filepath)
+    x_size, y_size, z_size = GEOTOP_SHAPE
+    rootgrp = geotop.netCDF4.Dataset(filepath, 'w')
+    for name, size in zip(('x', 'y', 'z'), GEOTOP_SHAPE):
+        rootgrp.createDimension(name, size)
+    rootgrp.createVariable('x', 'f8', ('x', ))[:] = (
+        13600 + 100 * np.arange(x_size))
+    rootgrp.createVariable('y', 'f8', ('y', ))[:] = (
+        358000 + 100 * np.arange(y_size))
+    rootgrp.createVariable('z', 'f8', ('z', ))[:] = (
+        -50 + 0.5 * np.arange(z_size))
+    strat = np.array([int(code) for code in geotop.STRAT_CLASSES
+                      if code not in ('--', '-32767')])
+    variables = {
+        name: rootgrp.createVariable(
+            name, 'i2', ('x', 'y', 'z'), fill_value=-127,
+            chunksizes=(1, 1, z_size))
+        for name in geotop.RELEVANT_VARIABLES
+    }
+    for x, y in coordinates[:, :2]:
+        rd_x, rd_y = geotop._grid_index(x, y)
+        for name, variable in variables.items():
+            if name == 'strat':
+                variable[rd_x, rd_y, :] = random.choice(strat, z_size)
+            else:
+                variable[rd_x, rd_y, :] = random.randint(0, 100, z_size)
+    rootgrp.close()
+    geotop.build_sidecar(coordinates=coordinates[:, :2].tolist())
+
+
+def _spatial_reference():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(28992)
+    return srs
+
+
+def _vector_layer(driver_name, filepath, layer_name, geometry_type, fields):
+    utils.mkdirs(filepath)
+    driver = ogr.GetDriverByName(driver_name)
+    data_source = driver.CreateDataSource(filepath)
+    layer = data_source.CreateLayer(
+        layer_name, _spatial_reference(), geometry_type)
+    for name in fields:
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger))
+    return data_source, layer
+
+
+def write_bofek(extent=EXTENT):
+    """
+    Writes a grid of BOFEK polygons over extent. It is written as a file
+    geodatabase when GDAL can, otherwise as a GeoPackage at the same path.
+    """
+    driver_name = other.Bofek.spatial_driver
+    driver = ogr.GetDriverByName(driver_name)
+    if driver is None or not driver.TestCapability(
+            ogr.ODrCCreateDataSource):
+        driver_name = "GPKG"
+    data_source, layer = _vector_layer(
+        driver_name, other.Bofek.spatial_source_filepath, "BOFEK2012",
+        ogr.wkbPolygon, ("BOFEK2012", )
+    )
+    minx, miny, maxx, maxy = extent
+    cells = [
+        (x, y) for x in range(minx, maxx, BOFEK_CELL_SIZE)
+        for y in range(miny, maxy, BOFEK_CELL_SIZE)
+    ]
+    layer.StartTransaction()
+    for i, (x, y) in enumerate(cells):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField(0, 101 + i % BOFEK_CLASSES)
+        feature.SetGeometry(geo_utils.bbox2polygon(
+            x, y, x + BOFEK_CELL_SIZE, y + BOFEK_CELL_SIZE))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    data_source = None
+
+
+def write_irrigation(coordinates, random=None, per_well=10):
+    """Writes irrigation locations within a kilometer around the wells."""
+    random = random or np.random.RandomState(4177)
+    data_source, layer = _vector_layer(
+        "ESRI Shapefile", other.Irrigation.spatial_source_filepath,
+        "irrigation", ogr.wkbPoint, ("GRID_CODE", )
+    )
+    xs = np.repeat(coordinates[:, 0], per_well) + random.uniform(
+        -1000, 1000, len(coordinates) * per_well)
+    ys = np.repeat(coordinates[:, 1], per_well) + random.uniform(
+        -1000, 1000, len(coordinates) * per_well)
+    codes = random.randint(0, 2, len(xs)).tolist()
+    for geometry, code in zip(geo_utils.points(xs, ys), codes):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField(0, code)
+        feature.SetGeometryDirectly(geometry)
+        layer.CreateFeature(feature)
+    data_source = None
+
+
+def write_drinking_water(extent=EXTENT, random=None):
+    """Writes a GeoTIFF with drinking water classes over extent."""
+    random = random or np.random.RandomState(4177)
+    filepath = other.DrinkingWater.spatial_source_filepath
+    utils.mkdirs(filepath)
+    minx, miny, maxx, maxy = extent
+    columns = (maxx - minx) // DRINKING_WATER_CELL_SIZE
+    rows = (maxy - miny) // DRINKING_WATER_CELL_SIZE
+    raster = gdal.GetDriverByName('GTiff').Create(
+        filepath, columns, rows, 1, gdal.GDT_UInt16)
+    raster.SetGeoTransform((
+        minx, DRINKING_WATER_CELL_SIZE, 0,
+        maxy, 0, -DRINKING_WATER_CELL_SIZE
+    ))
+    raster.SetProjection(_spatial_reference().ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(random.choice(
+        other.DrinkingWater.classes["drinkingwater"], (rows, columns)))
+    raster = None
+
+
+def write_fixtures(scale=1, wells=WELLS, years=YEARS, extent=EXTENT,
+                   seed=4177):
+    """
+    Writes all sources for wells * scale wells with years of data within
+    extent to var/data in the current working directory.
+    """
+    random = np.random.RandomState(seed)
+    timestamps = days(years)
+    locations = well_locations(wells * scale, extent, random)
+    write_dino(locations, timestamps, random)
+    write_knmi_tiles(
+        RainData(), locations, timestamps, 'uint16', RainData.nan, random)
+    write_knmi_tiles(
+        EvapoTranspirationData(), locations, timestamps, 'float32',
+        EvapoTranspirationData.nan, random)
+    write_weather_stations(timestamps, random)
+    write_geotop(locations, random)
+    write_bofek(extent)
+    write_irrigation(locations, random)
+    write_drinking_water(extent, random)
+    logger.info("Wrote fixtures for %d wells and %d years", len(locations),
+                years)
+    return locations
+
+
+if __name__ == '__main__':
+    write_fixtures(*[int(arg) for arg in sys.argv[1:2]])
@@ -2,23 +2,74 @@
 Library with common geo functions.
 """
 
+import functools
 import os
 from math import ceil
 
-from osgeo import ogr
-from osgeo import osr
 import numpy as np
 
-from groundwater_timenet.utils import cache_h5
+from groundwater_timenet.utils import cache_h5, lazy_import
+
+ogr = lazy_import('osgeo.ogr')
+osr = lazy_import('osgeo.osr')
+
+
+@functools.lru_cache(maxsize=None)
+def spatial_reference(srs):
+    """
+    :param srs: EPSG code or any other user input OSR understands, such as a
+        proj4 string or WKT.
+    """
+    reference = osr.SpatialReference()
+    if isinstance(srs, int):
+        reference.ImportFromEPSG(srs)
+    else:
+        reference.SetFromUserInput(srs)
+    return reference
+
+
+@functools.lru_cache(maxsize=None)
+def coordinate_transformation(src, dst):
+    """Cached transformation between two spatial references."""
+    return osr.CoordinateTransformation(
+        spatial_reference(src), spatial_reference(dst))
 
 
 def transform(geom, source_epsg=4326, target_epsg=28992):
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(source_epsg)
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(target_epsg)
-    transformation = osr.CoordinateTransformation(source, target)
-    geom.Transform(transformation)
+    geom.Transform(coordinate_transformation(source_epsg, target_epsg))
+
+
+def transform_many(xs, ys, src=4326, dst=28992):
+    """
+    Transforms arrays of x and y coordinates from src to dst in a single
+    call to OSR.
+
+    :param src: EPSG code or other user input accepted by spatial_reference
+    :param dst: EPSG code or other user input accepted by spatial_reference
+    :return: tuple of arrays of transformed x and y coordinates with the
+        shape of xs
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if not xs.size:
+        return xs.copy(), ys.copy()
+    transformed = np.array(
+        coordinate_transformation(src, dst).TransformPoints(
+            np.column_stack([xs.ravel(), ys.ravel()]).tolist()))
+    return (
+        transformed[:, 0].reshape(xs.shape),
+        transformed[:, 1].reshape(xs.shape)
+    )
+
+
+def apply_geo_transform(affine, xs, ys):
+    """gdal.ApplyGeoTransform for arrays of coordinates."""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    return (
+        affine[0] + xs * affine[1] + ys * affine[2],
+        affine[3] + xs * affine[4] + ys * affine[5]
+    )
 
 
 def point(x, y):
@@ -27,6 +78,25 @@ def point(x, y):
     return p
 
 
+def points(xs, ys):
+    """
+    Generator of point geometries for arrays of x and y coordinates. The
+    well known binary of all points is built at once with numpy.
+    """
+    wkb = np.empty(len(xs), dtype=[
+        ('byte_order', 'u1'), ('type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+    wkb['byte_order'] = 1  # little endian
+    wkb['type'] = ogr.wkbPoint
+    wkb['x'] = xs
+    wkb['y'] = ys
+    buffer = wkb.tobytes()
+    size = wkb.dtype.itemsize
+    return (
+        ogr.CreateGeometryFromWkb(buffer[i:i + size])
+        for i in range(0, len(buffer), size)
+    )
+
+
 def multipoint(points):
     mp = ogr.Geometry(ogr.wkbMultiPoint)
     for x, y in points:
@@ -0,0 +1,129 @@
+"""
+Library with common functions for harvesting data over HTTP.
+"""
+
+import json
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from groundwater_timenet import utils
+
+
+logger = utils.setup_logging(__name__, utils.HARVEST_LOG)
+
+CHUNK = 64 * 1024
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def session(pool_size=8, retries=5, backoff_factor=1.0):
+    """
+    Creates a requests session with a connection pool of pool_size
+    connections per host that retries failed requests with exponential
+    backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    http_session = requests.Session()
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    return http_session
+
+
+def backoff(attempt, base=1.0, maximum=600.0):
+    """Exponential backoff with full jitter in seconds for an attempt."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def retry(function, attempts=5, exceptions=(Exception, ), base=1.0,
+          maximum=600.0, sleep=time.sleep):
+    """
+    Calls function until it succeeds, sleeping with exponential backoff and
+    jitter in between failures. The last exception is raised when all
+    attempts fail.
+    """
+    for attempt in range(attempts):
+        try:
+            return function()
+        except exceptions:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff(attempt, base, maximum)
+            logger.exception(
+                "Attempt %d of %d failed, retrying in %.1f seconds.",
+                attempt + 1, attempts, delay)
+            sleep(delay)
+
+
+def read_validators(filepath):
+    """Reads the ETag and Last-Modified headers stored per url."""
+    try:
+        with open(filepath, 'r') as validators_file:
+            return json.load(validators_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_validators(validators, filepath):
+    utils.mkdirs(filepath)
+    with open(filepath, 'w') as validators_file:
+        json.dump(validators, validators_file, indent=4, sort_keys=True)
+
+
+def conditional_download(http_session, url, filepath, validators=None,
+                         timeout=60):
+    """
+    Streams url to filepath unless the remote file did not change since the
+    previous download according to its ETag or Last-Modified validators.
+
+    The file is first written next to filepath and only moved in place when
+    its size matches the Content-Length, so a broken download never replaces
+    a good file.
+
+    :return: tuple with a boolean whether the file was downloaded and the
+        validators of the remote file.
+    """
+    validators = validators or {}
+    headers = {}
+    if os.path.exists(filepath):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last-modified'):
+            headers['If-Modified-Since'] = validators['last-modified']
+    response = http_session.get(
+        url, headers=headers, stream=True, timeout=timeout)
+    with response:
+        if response.status_code == 304:
+            logger.debug("%s did not change, skipped.", url)
+            return False, validators
+        response.raise_for_status()
+        partial_filepath = filepath + '.part'
+        utils.mkdirs(partial_filepath)
+        size = 0
+        with open(partial_filepath, 'wb') as partial_file:
+            for chunk in response.iter_content(CHUNK):
+                partial_file.write(chunk)
+                size += len(chunk)
+        expected = response.headers.get('Content-Length')
+        if (expected is not None and
+                'Content-Encoding' not in response.headers and
+                int(expected) != size):
+            os.remove(partial_filepath)
+            raise IOError(
+                "Incomplete download of {}: got {} of {} bytes.".format(
+                    url, size, expected))
+        os.replace(partial_filepath, filepath)
+        return True, {
+            key: response.headers[header] for key, header in (
+                ('etag', 'ETag'), ('last-modified', 'Last-Modified'))
+            if header in response.headers
+        }
@@ -1,15 +1,17 @@
+import argparse
 import datetime
-import sys
 import pickle
 
 import matplotlib.pyplot as plt
 from keras import metrics
 from keras.models import Sequential
 from keras.layers import Conv1D, MaxPooling1D
-from keras.callbacks import EarlyStopping, TensorBoard, ReduceLROnPlateau
+from keras.callbacks import (
+    Callback, EarlyStopping, TensorBoard, ReduceLROnPlateau)
 
+from groundwater_timenet import memory
 from groundwater_timenet.learn.settings import *
-from groundwater_timenet.learn.generator import ConvolutionalAtrousGenerator
+from groundwater_timenet.learn.sequence import ConvolutionalAtrousGenerator
 from groundwater_timenet.utils import setup_logging, LEARN_LOG
 
 
@@ -69,7 +71,27 @@ def plot_history(history):
     plt.show()
 
 
-def main(directory=None, epochs=EPOCHS):
+class MemoryProfileCallback(Callback):
+    """Samples a memory.MemoryProfiler every N training batches."""
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+        self.step = 0
+        self.epoch = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        self.profiler.sample(self.step, epoch=self.epoch, batch=batch)
+        self.step += 1
+
+
+def main(directory=None, epochs=EPOCHS, profiler=None):
+    """
+    :param profiler: a memory.MemoryProfiler to sample during training.
+    """
     start = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
 
     try:
@@ -103,11 +125,14 @@ def main(directory=None, epochs=EPOCHS):
     # launch TensorBoard from the command line:
     # tensorboard --logdir=/full_path_to_your_logs
 
+    callbacks = [early_stopping, tensor_board, ReduceLROnPlateau()]
+    if profiler is not None:
+        callbacks.append(MemoryProfileCallback(profiler))
     history = model.fit_generator(
         train_generator,
         validation_data=validation_generator,
         epochs=epochs,
-        callbacks=[early_stopping, tensor_board, ReduceLROnPlateau()]
+        callbacks=callbacks
     )
 
     plot_history(history)
@@ -121,8 +146,25 @@ def main(directory=None, epochs=EPOCHS):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Trains the convolutional model.")
+    parser.add_argument(
+        "directory", nargs="?", default="neuralnet",
+        help="directory with the train and validation files of the combiner")
+    parser.add_argument(
+        "--profile-memory", metavar="FILE",
+        help="trace memory during training and write a timeline report to "
+             "FILE")
+    parser.add_argument(
+        "--profile-every", type=int, default=100, metavar="N",
+        help="sample RSS and the top allocators every N batches")
+    args = parser.parse_args()
+    profiler = None
+    if args.profile_memory:
+        profiler = memory.MemoryProfiler(
+            args.profile_memory, every=args.profile_every).start()
     try:
-        directory = sys.argv[0]
-        main(directory)
-    except IndexError:
-        main()
\ No newline at end of file
+        main(args.directory, profiler=profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop()
\ No newline at end of file
@@ -1,10 +1,17 @@
+"""
+Generators that pack the combined sources into training batches.
+
+The keras Sequences that read the packed files live in
+groundwater_timenet.learn.sequence, so the combiner does not import keras.
+They can still be imported from this module.
+"""
+import importlib
 import os
-from collections import Generator
+from collections.abc import Generator
 
-import h5py
 import numpy as np
-from keras.utils import Sequence
 
+from groundwater_timenet import metrics
 from groundwater_timenet import utils
 from groundwater_timenet.learn.settings import *
 
@@ -18,8 +25,9 @@ class BaseGenerator(Generator):
                  batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE,
                  meta_size=META_SIZE, temporal_size=TEMPORAL_SIZE,
                  input_size=INPUT_SIZE, output_size=OUTPUT_SIZE,
-                 directory=None):
+                 directory=None, dtype=None):
         directory = directory or os.path.join(utils.DATA, base, data_type)
+        self.directory = directory
         self.__length = None
         try:
             self.h5files = [
@@ -38,6 +46,7 @@ class BaseGenerator(Generator):
         self.output_size = output_size
         self.chunk_size = chunk_size
         self.batch_size = batch_size
+        self.dtype = utils.DTYPE if dtype is None else dtype
         self.input_data, self.output_data = self.empty_input_output()
         self.dataset_names = tuple(
             name + "_" + str(i) for name in ("base", "temporal", "meta")
@@ -48,6 +57,7 @@ class BaseGenerator(Generator):
     def send(self, _):
         return next(self.__generator)
 
+    @metrics.timed("generate_batch", per_source=True)
     def generate_batch(self, base_data, meta_data, temporal_data):
         take = base_data != 0
         if take.sum() <= self.input_size:
@@ -68,7 +78,8 @@ class BaseGenerator(Generator):
             shift=self.input_size
         )
         base = np.zeros(
-            condense_base.shape[0] * self.input_size).reshape(
+            condense_base.shape[0] * self.input_size, dtype=self.dtype
+        ).reshape(
             condense_base.shape[0], self.input_size, 1
         )
         try:
@@ -83,9 +94,10 @@ class BaseGenerator(Generator):
     def empty_input_output(self):
         return (
             np.empty(
-                shape=(0, self.input_size, self.temporal_size + self.meta_size)
+                shape=(0, self.input_size, self.temporal_size + self.meta_size),
+                dtype=self.dtype
             ),
-            np.empty(shape=(0, self.input_size, 1))
+            np.empty(shape=(0, self.input_size, 1), dtype=self.dtype)
         )
 
     def _datasets(self, filepath):
@@ -104,12 +116,27 @@ class BaseGenerator(Generator):
             for i in range(dataset.shape[0] - cutoff - period_length + 1)
         ])
 
+    @staticmethod
+    def assemble(temporal, meta):
+        """
+        Broadcasts metadata over all timesteps of the temporal windows.
+
+        :param temporal: array of shape (windows, input_size, temporal_size)
+        :param meta: a single metadata vector of shape (meta_size, ) or one
+            vector per window of shape (windows, meta_size)
+        :return: input array of shape
+            (windows, input_size, temporal_size + meta_size)
+        """
+        metadata = np.broadcast_to(
+            meta[..., np.newaxis, :], temporal.shape[:2] + meta.shape[-1:])
+        return np.concatenate([temporal, metadata], axis=2)
+
+    @metrics.timed("pack", per_source=True)
     def pack(self, base, meta, temporal):
+        base, meta, temporal = (
+            utils.as_dtype(a, self.dtype) for a in (base, meta, temporal))
         self.output_data = np.concatenate([self.output_data, base])
-        metadata = np.repeat(
-            meta.reshape(1, -1), temporal.shape[0] * self.input_size, axis=0
-        ).reshape(temporal.shape[0], self.input_size, self.meta_size)
-        input_data = np.concatenate([temporal, metadata], axis=2)
+        input_data = self.assemble(temporal, meta)
         self.input_data = np.concatenate([self.input_data, input_data])
 
     def unpack_batches(self, chunk_size=1):
@@ -143,59 +170,92 @@ class ConvCombinerGenerator(BaseGenerator):
         pass
 
 
-class CompressedConvolutionalAtrousGenerator(BaseGenerator, Sequence):
+class CompactCombinerGenerator(ConvCombinerGenerator):
+    """
+    Packs series without repeating the metadata for every timestep.
 
-    def _generate(self):
-        # continue for ever:
-        while True:
-            for filepath in self.h5files:
-                datasets = dict(self._datasets(filepath))
-                for i in range(self.chunk_size):
-                    meta = datasets["meta_" + str(i)]
-                    base = datasets["base_" + str(i)]
-                    temporal = datasets["temporal_" + str(i)]
-                    self.generate_batch(base, meta, temporal)
-                    for batch in self.unpack_batches():
-                        yield batch
-
-    def __len__(self):
-        if self.__length is None:
-            model_length = INPUT_SIZE + OUTPUT_SIZE
-            self.__length = 0
-            for f in self.h5files:
-                datasets = self._datasets(f)
-                self.__length += sum([
-                    dataset.shape[0] - model_length for name, dataset in
-                    datasets if name.startswith('base')
-                ])
-        return self.__length
-
-    def __getitem__(self, index):
-        return self.send(index)
-
-
-class ConvolutionalAtrousGenerator(BaseGenerator, Sequence):
+    The input data only holds the temporal windows. Every window points to a
+    row in the metadata table, which holds each metadata vector once per
+    series. The metadata is broadcast with `assemble` when a batch is read.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.dataset_names = tuple(
-            name + "_" + str(i) for name in ("input", "output")
-            for i in range(self.chunk_size)
+        self.meta_table = np.empty(
+            shape=(0, self.meta_size), dtype=self.dtype)
+        self.meta_index = np.empty(shape=(0, ), dtype='int64')
+
+    def empty_input_output(self):
+        return (
+            np.empty(
+                shape=(0, self.input_size, self.temporal_size),
+                dtype=self.dtype
+            ),
+            np.empty(shape=(0, self.input_size, 1), dtype=self.dtype)
         )
-        self.__length = len(self.h5files) * self.chunk_size
 
-    def _generate(self):
-        # continue for ever:
-        while True:
-            for filepath in self.h5files:
-                datasets = h5py.File(filepath, 'r')
-                for i in range(CHUNK_SIZE):
-                    input = datasets['input_' + str(i)]
-                    output = datasets['output_' + str(i)]
-                    yield input, output
-
-    def __len__(self):
-        return self.__length
-
-    def __getitem__(self, index):
-        return self.send(index)
+    @metrics.timed("pack", per_source=True)
+    def pack(self, base, meta, temporal):
+        base, meta, temporal = (
+            utils.as_dtype(a, self.dtype) for a in (base, meta, temporal))
+        self.output_data = np.concatenate([self.output_data, base])
+        self.input_data = np.concatenate([self.input_data, temporal])
+        self.meta_index = np.concatenate([
+            self.meta_index,
+            np.full(temporal.shape[0], self.meta_table.shape[0], dtype='int64')
+        ])
+        self.meta_table = np.concatenate(
+            [self.meta_table, meta.reshape(1, -1)])
+
+    def unpack_batches(self, chunk_size=1):
+        """
+        Returns a generator of chunks of (temporal, output, meta_index, meta)
+        where meta_index refers to the rows in meta, which only contains the
+        metadata of the series in that chunk.
+        """
+        chunk_length = self.batch_size * chunk_size
+        length = self.input_data.shape[0] - (
+            self.input_data.shape[0] % chunk_length)
+        inputs = self.input_data[:length]
+        outputs = self.output_data[:length]
+        meta_index = self.meta_index[:length]
+        meta_table = self.meta_table
+        self.input_data = self.input_data[length:]
+        self.output_data = self.output_data[length:]
+        remaining, self.meta_index = np.unique(
+            self.meta_index[length:], return_inverse=True)
+        self.meta_table = meta_table[remaining]
+        return (
+            self._compact_chunk(
+                inputs[start:start + chunk_length],
+                outputs[start:start + chunk_length],
+                meta_index[start:start + chunk_length],
+                meta_table,
+                chunk_size
+            ) for start in range(0, length, chunk_length)
+        )
+
+    def _compact_chunk(self, inputs, outputs, meta_index, meta_table,
+                       chunk_size):
+        used, local_index = np.unique(meta_index, return_inverse=True)
+        return (
+            inputs.reshape(chunk_size, self.batch_size, *inputs.shape[1:]),
+            outputs.reshape(chunk_size, self.batch_size, 1, self.input_size),
+            local_index.reshape(chunk_size, self.batch_size),
+            meta_table[used]
+        )
+
+
+SEQUENCES = (
+    'CompressedConvolutionalAtrousGenerator',
+    'ConvolutionalAtrousGenerator',
+    'CompactConvolutionalAtrousGenerator',
+)
+
+
+def __getattr__(name):
+    if name in SEQUENCES:
+        module = importlib.import_module('groundwater_timenet.learn.sequence')
+        return getattr(module, name)
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,98 @@
+"""
+Keras Sequences that feed the files written by the combiners to the network.
+"""
+import h5py
+from keras.utils import Sequence
+
+from groundwater_timenet.learn import shards
+from groundwater_timenet.learn.generator import BaseGenerator
+from groundwater_timenet.learn.settings import *
+
+
+class CompressedConvolutionalAtrousGenerator(BaseGenerator, Sequence):
+
+    def _generate(self):
+        # continue for ever:
+        while True:
+            for filepath in self.h5files:
+                datasets = dict(self._datasets(filepath))
+                for i in range(self.chunk_size):
+                    meta = datasets["meta_" + str(i)]
+                    base = datasets["base_" + str(i)]
+                    temporal = datasets["temporal_" + str(i)]
+                    self.generate_batch(base, meta, temporal)
+                    for batch in self.unpack_batches():
+                        yield batch
+
+    def __len__(self):
+        if self.__length is None:
+            model_length = INPUT_SIZE + OUTPUT_SIZE
+            self.__length = 0
+            for f in self.h5files:
+                datasets = self._datasets(f)
+                self.__length += sum([
+                    dataset.shape[0] - model_length for name, dataset in
+                    datasets if name.startswith('base')
+                ])
+        return self.__length
+
+    def __getitem__(self, index):
+        return self.send(index)
+
+
+class ConvolutionalAtrousGenerator(BaseGenerator, Sequence):
+    """
+    Reads the files of the UncompressedCombiner. When the directory holds
+    .npy shards (see learn.shards) batches are served by index as slices of
+    memory-mapped arrays instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dataset_names = tuple(
+            name + "_" + str(i) for name in ("input", "output")
+            for i in range(self.chunk_size)
+        )
+        self.shards = None
+        if shards.has_shards(self.directory):
+            self.shards = shards.Shards(self.directory)
+            self.__length = len(self.shards)
+        else:
+            self.__length = len(self.h5files) * self.chunk_size
+
+    def _generate(self):
+        # continue for ever:
+        while True:
+            for filepath in self.h5files:
+                datasets = h5py.File(filepath, 'r')
+                for i in range(self.chunk_size):
+                    input = datasets['input_' + str(i)]
+                    output = datasets['output_' + str(i)]
+                    yield input, output
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, index):
+        if self.shards is not None:
+            return self.shards.batch(index)
+        return self.send(index)
+
+
+class CompactConvolutionalAtrousGenerator(ConvolutionalAtrousGenerator):
+    """
+    Reads files written by the CompactCombiner and broadcasts the metadata
+    over the timesteps when a batch is assembled.
+    """
+
+    def _generate(self):
+        # continue for ever:
+        while True:
+            for filepath in self.h5files:
+                with h5py.File(filepath, 'r') as datasets:
+                    meta = datasets['meta'][()]
+                    for i in range(self.chunk_size):
+                        temporal = datasets['temporal_' + str(i)][()]
+                        meta_index = datasets['meta_index_' + str(i)][()]
+                        output = datasets['output_' + str(i)][()]
+                        yield self.assemble(temporal, meta[meta_index]), output
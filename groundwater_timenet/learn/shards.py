@@ -0,0 +1,190 @@
+"""
+Training data as memory-mapped .npy shards.
+
+A shard directory holds one input and one output .npy file per shard with
+a fixed number of batches of fixed shape, and a manifest.json that lists
+the shards:
+
+    {
+        "version": 1,
+        "dtype": "float32",
+        "batch_size": 100,
+        "input_shape": [100, 15, 80],
+        "output_shape": [100, 1, 15],
+        "shards": [
+            {"name": "12", "input": "12_input.npy",
+             "output": "12_output.npy", "batches": 5},
+            ...
+        ]
+    }
+
+The shards are opened with np.load(mmap_mode='r'), so a batch is a slice of
+a np.memmap that is read from the page cache of the OS. Repeated epochs and
+training processes on the same node share the pages instead of each
+reading and copying the HDF5 datasets.
+
+Convert the HDF5 files of the UncompressedCombiner with:
+
+    python -m groundwater_timenet.learn.shards var/data/neuralnet/train
+"""
+import bisect
+import json
+import os
+import sys
+
+import numpy as np
+
+from groundwater_timenet import utils
+
+
+logger = utils.setup_logging(__name__, utils.LEARN_LOG, "INFO")
+h5py = utils.lazy_import('h5py')
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("version") != VERSION:
+        raise ValueError(
+            "Unsupported shard manifest version {} in {}".format(
+                manifest.get("version"), directory))
+    return manifest
+
+
+def has_shards(directory):
+    return os.path.exists(os.path.join(directory, MANIFEST))
+
+
+def _save(filepath, array):
+    # a reader never maps a half written shard.
+    with open(filepath + '.tmp', 'wb') as npy_file:
+        np.save(npy_file, array)
+    os.replace(filepath + '.tmp', filepath)
+
+
+class ShardWriter(object):
+    """Writes chunks of batches as .npy shards and keeps the manifest."""
+
+    def __init__(self, directory, dtype=None):
+        self.directory = directory
+        self.dtype = utils.DTYPE if dtype is None else dtype
+        self.manifest = {
+            "version": VERSION,
+            "dtype": np.dtype(self.dtype).name,
+            "batch_size": None,
+            "input_shape": None,
+            "output_shape": None,
+            "shards": []
+        }
+
+    def write(self, name, input_data, output_data):
+        """
+        :param input_data: array of (batches, batch size, ...) inputs.
+        :param output_data: array of (batches, batch size, ...) outputs.
+        """
+        input_data = utils.as_dtype(input_data, self.dtype)
+        output_data = utils.as_dtype(output_data, self.dtype)
+        if input_data.shape[0] != output_data.shape[0]:
+            raise ValueError(
+                "Shard {} has {} input and {} output batches".format(
+                    name, input_data.shape[0], output_data.shape[0]))
+        shapes = [list(input_data.shape[1:]), list(output_data.shape[1:])]
+        if self.manifest["input_shape"] is None:
+            self.manifest["batch_size"] = input_data.shape[1]
+            self.manifest["input_shape"] = shapes[0]
+            self.manifest["output_shape"] = shapes[1]
+        expected = [self.manifest["input_shape"],
+                    self.manifest["output_shape"]]
+        if shapes != expected:
+            raise ValueError(
+                "Batches of shard {} have shapes {}, not {}".format(
+                    name, shapes, expected))
+        utils.mkdirs(os.path.join(self.directory, MANIFEST))
+        shard = {
+            "name": str(name),
+            "input": "{}_input.npy".format(name),
+            "output": "{}_output.npy".format(name),
+            "batches": input_data.shape[0]
+        }
+        _save(os.path.join(self.directory, shard["input"]), input_data)
+        _save(os.path.join(self.directory, shard["output"]), output_data)
+        self.manifest["shards"] = [
+            s for s in self.manifest["shards"] if s["name"] != shard["name"]
+        ] + [shard]
+        self.write_manifest()
+
+    def write_manifest(self):
+        filepath = os.path.join(self.directory, MANIFEST)
+        with open(filepath + '.tmp', 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=4)
+        os.replace(filepath + '.tmp', filepath)
+
+
+class Shards(object):
+    """Batches of a shard directory as slices of memory-mapped arrays."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        self.shards = self.manifest["shards"]
+        self._offsets = np.cumsum(
+            [0] + [shard["batches"] for shard in self.shards]).tolist()
+        self._arrays = {}
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def _open(self, i):
+        try:
+            return self._arrays[i]
+        except KeyError:
+            shard = self.shards[i]
+            arrays = self._arrays[i] = tuple(
+                np.load(os.path.join(self.directory, shard[key]),
+                        mmap_mode='r')
+                for key in ("input", "output")
+            )
+            return arrays
+
+    def batch(self, index):
+        """:return: the (input, output) memmap slices of a batch."""
+        if not 0 <= index < len(self):
+            raise IndexError("Batch {} out of range".format(index))
+        i = bisect.bisect_right(self._offsets, index) - 1
+        inputs, outputs = self._open(i)
+        offset = index - self._offsets[i]
+        return inputs[offset], outputs[offset]
+
+
+def export_h5(source_directory, target_directory=None, dtype=None):
+    """
+    Writes the input_i and output_i datasets of the HDF5 files of the
+    UncompressedCombiner in source_directory as shards, one per file.
+    """
+    target_directory = target_directory or source_directory
+    writer = ShardWriter(target_directory, dtype)
+    filenames = sorted(
+        (f for f in os.listdir(source_directory) if f.endswith('.h5')),
+        key=lambda f: (len(f), f)
+    )
+    for filename in filenames:
+        with h5py.File(os.path.join(source_directory, filename), 'r') as \
+                h5_file:
+            count = sum(1 for name in h5_file if name.startswith('input_'))
+            writer.write(
+                filename[:-len('.h5')],
+                np.stack([h5_file['input_' + str(i)][()]
+                          for i in range(count)]),
+                np.stack([h5_file['output_' + str(i)][()]
+                          for i in range(count)])
+            )
+    logger.info("Exported %d files from %s to shards in %s", len(filenames),
+                source_directory, target_directory)
+    return writer.manifest
+
+
+if __name__ == '__main__':
+    export_h5(*sys.argv[1:3])
@@ -0,0 +1,161 @@
+"""
+Memory profiling of combine and training runs.
+
+The MemoryProfiler records the growth of traced memory per stage (such as
+the temporal data, metadata and batch generation of the combiner) and
+every N series or batches a sample with the resident set size and the top
+allocators according to tracemalloc. The timeline report is rewritten as
+JSON with every sample, so it survives a run that gets OOM-killed.
+
+Tracing slows a run down, the NullProfiler is used when profiling is off.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+from groundwater_timenet import utils
+
+
+logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss():
+    """Current resident set size in bytes, or the peak if unknown."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class NullProfiler(object):
+    """Profiler that does nothing, used when memory profiling is off."""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def sample(self, step, **info):
+        pass
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+
+class MemoryProfiler(NullProfiler):
+
+    def __init__(self, filepath, every=100, top=10, frames=1):
+        """
+        :param filepath: JSON file the timeline report is written to.
+        :param every: take a sample every `every` steps (series or batches).
+        :param top: number of top allocators per sample.
+        :param frames: number of frames tracemalloc keeps per allocation.
+        """
+        self.filepath = filepath
+        self.every = every
+        self.top = top
+        self.frames = frames
+        self.stages = {}
+        self.timeline = []
+        self._start_time = None
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self._start_time = time.time()
+        return self
+
+    @contextmanager
+    def stage(self, name):
+        """Records the peak traced memory growth while in a stage."""
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            stage = self.stages.setdefault(
+                name, {'calls': 0, 'peak_growth': 0, 'retained': 0})
+            stage['calls'] += 1
+            stage['peak_growth'] = max(stage['peak_growth'], peak - current)
+            stage['retained'] += after - current
+
+    def sample(self, step, **info):
+        """
+        Samples RSS and the top allocators when step is a multiple of
+        `every`.
+
+        :param info: extra values to record, such as the number of rows held
+            by a generator.
+        """
+        if step % self.every:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        )).statistics('lineno')
+        self.timeline.append(dict(
+            step=step,
+            seconds=time.time() - self._start_time,
+            rss=rss(),
+            peak_rss=peak_rss(),
+            traced=current,
+            traced_peak=peak,
+            top=[
+                {'location': str(statistic.traceback),
+                 'size': statistic.size, 'count': statistic.count}
+                for statistic in statistics[:self.top]
+            ],
+            **info
+        ))
+        logger.info("Step %d: RSS %.1f MB, traced %.1f MB", step,
+                    self.timeline[-1]['rss'] / 2 ** 20, current / 2 ** 20)
+        self.write()
+
+    def report(self):
+        return {
+            'peak_rss': peak_rss(),
+            'stages': self.stages,
+            'timeline': self.timeline
+        }
+
+    def write(self):
+        report = self.report()
+        utils.mkdirs(self.filepath)
+        with open(self.filepath + '.tmp', 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+        os.replace(self.filepath + '.tmp', self.filepath)
+        return report
+
+    def stop(self):
+        """Writes the report and stops tracing."""
+        report = self.write()
+        tracemalloc.stop()
+        logger.info("Wrote memory profile to %s", self.filepath)
+        return report
+
+
+def profiled(profiler, name, iterable):
+    """Iterates over iterable, producing each item in the stage name."""
+    iterator = iter(iterable)
+    while True:
+        with profiler.stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,216 @@
+"""
+Timers, counters and latency histograms of the stages of a run.
+
+Instrumentation is disabled by default, timed functions then only check a
+flag before they are called. Enable it and export at the end of a run:
+
+    from groundwater_timenet import metrics
+    metrics.enable("var/log/combine.prom", interval=60)
+    ...
+    metrics.export()
+
+Files ending in .prom or .txt are written in the Prometheus text format,
+other files as JSON. With an interval, export_periodically writes the file
+at most once per interval during the run.
+"""
+
+from collections import defaultdict
+from functools import wraps
+import bisect
+import json
+import os
+import threading
+import time
+
+
+PREFIX = "groundwater_timenet"
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0
+)
+PROMETHEUS_EXTENSIONS = ('.prom', '.txt')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Tuples of (upper bound, count) with cumulative counts."""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {
+                ('+Inf' if bound == float('inf') else repr(bound)): count
+                for bound, count in self.cumulative()
+            }
+        }
+
+
+class Registry(object):
+    """Holds the histograms per (stage, source) and counters per name."""
+
+    def __init__(self):
+        self.enabled = False
+        self.filepath = None
+        self.interval = None
+        self._last_export = 0.0
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = defaultdict(int)
+
+    def enable(self, filepath=None, interval=None):
+        """
+        :param filepath: file export writes to by default.
+        :param interval: minimum number of seconds between the exports of
+            export_periodically.
+        """
+        self.enabled = True
+        self.filepath = filepath
+        self.interval = interval
+        self._last_export = time.time()
+
+    def disable(self):
+        self.enabled = False
+        self.filepath = None
+
+    def observe(self, stage, source, seconds):
+        with self._lock:
+            try:
+                histogram = self.histograms[(stage, source)]
+            except KeyError:
+                histogram = self.histograms[(stage, source)] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, source=None, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[(name, source)] += value
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'stages': [
+                    dict(stage=stage, source=source, **histogram.to_dict())
+                    for (stage, source), histogram in
+                    sorted(self.histograms.items(), key=_key)
+                ],
+                'counters': [
+                    {'name': name, 'source': source, 'value': value}
+                    for (name, source), value in
+                    sorted(self.counters.items(), key=_key)
+                ]
+            }
+
+    def to_prometheus(self):
+        name = PREFIX + "_stage_seconds"
+        lines = ["# TYPE {} histogram".format(name)]
+        with self._lock:
+            for (stage, source), histogram in sorted(
+                    self.histograms.items(), key=_key):
+                labels = _labels(stage=stage, source=source)
+                for bound, count in histogram.cumulative():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels,
+                        '+Inf' if bound == float('inf') else repr(bound),
+                        count
+                    ))
+                lines.append('{}_sum{{{}}} {!r}'.format(
+                    name, labels, histogram.sum))
+                lines.append('{}_count{{{}}} {}'.format(
+                    name, labels, histogram.count))
+            for counter in sorted({n for n, _ in self.counters}):
+                lines.append(
+                    "# TYPE {}_{}_total counter".format(PREFIX, counter))
+                for (name, source), value in sorted(
+                        self.counters.items(), key=_key):
+                    if name == counter:
+                        lines.append('{}_{}_total{{{}}} {}'.format(
+                            PREFIX, name, _labels(source=source), value))
+        return "\n".join(lines) + "\n"
+
+    def export(self, filepath=None):
+        """Writes all metrics to filepath, or the file given to enable."""
+        filepath = filepath or self.filepath
+        if filepath is None:
+            return
+        if filepath.endswith(PROMETHEUS_EXTENSIONS):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_json(), indent=4)
+        dirname = os.path.dirname(filepath)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # replace the file at once, so a scraper never reads half of it.
+        with open(filepath + '.tmp', 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(filepath + '.tmp', filepath)
+        self._last_export = time.time()
+
+    def export_periodically(self):
+        if (self.enabled and self.interval is not None and
+                time.time() - self._last_export >= self.interval):
+            self.export()
+
+
+def _key(item):
+    return tuple(str(k) for k in item[0])
+
+
+def _labels(**labels):
+    return ",".join(
+        '{}="{}"'.format(key, value) for key, value in sorted(labels.items())
+        if value is not None
+    )
+
+
+REGISTRY = Registry()
+enable = REGISTRY.enable
+disable = REGISTRY.disable
+count = REGISTRY.count
+export = REGISTRY.export
+export_periodically = REGISTRY.export_periodically
+
+
+def timed(stage, per_source=False):
+    """
+    Decorator that records the duration of each call in the histogram of a
+    stage when metrics are enabled.
+
+    :param per_source: record the calls of methods per class of the
+        instance, such as the RainData source.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                REGISTRY.observe(
+                    stage, type(args[0]).__name__ if per_source else None,
+                    time.perf_counter() - start
+                )
+        return wrapper
+    return decorator
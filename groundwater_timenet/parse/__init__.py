@@ -1,6 +1,20 @@
-from . import base
-from . import combine
-from . import dino
-from . import geotop
-from . import knmi
-from . import other
+"""
+The submodules are imported when they are first used, as in
+groundwater_timenet.parse.base, so importing one of them does not load
+the dependencies of the others.
+"""
+import importlib
+
+SUBMODULES = ('base', 'cache', 'combine', 'dino', 'geotop', 'knmi', 'other',
+              'sharding')
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(SUBMODULES))
@@ -1,11 +1,18 @@
 from abc import ABCMeta, abstractmethod
 import datetime
+import os
 import random
 import operator
 
-from osgeo import ogr, gdal
 import numpy as np
-import pandas as pd
+
+from groundwater_timenet import metrics
+from groundwater_timenet import utils
+from groundwater_timenet.parse import sharding
+
+gdal = utils.lazy_import('osgeo.gdal')
+ogr = utils.lazy_import('osgeo.ogr')
+pd = utils.lazy_import('pandas')
 
 
 class Data(object, metaclass=ABCMeta):
@@ -17,8 +24,9 @@ class Data(object, metaclass=ABCMeta):
     nan = None
     classes = {}
 
-    def __init__(self, nan_to_num=np.nan_to_num, *args, **kwargs):
+    def __init__(self, nan_to_num=np.nan_to_num, dtype=None, *args, **kwargs):
         self._nan_to_num = nan_to_num
+        self.dtype = utils.DTYPE if dtype is None else dtype
 
     def classify(self, class_type, class_name):
         classes = self.classes[class_type]
@@ -47,20 +55,45 @@ class Data(object, metaclass=ABCMeta):
     def _transform(self, x, y):
         return x, y
 
+    @property
+    def source_paths(self):
+        """Files and directories the source is read from."""
+        return (os.path.join(utils.DATA, self.root), )
+
+    def _is_source_file(self, filepath):
+        """Whether a file under source_paths is part of the version."""
+        return True
+
+    def version(self):
+        """
+        Fingerprint of the path, size and modification time of the files
+        under source_paths, which changes when the source is harvested or
+        parsed again.
+        """
+        return utils.files_version(
+            filepath for path in self.source_paths
+            for filepath in ([path] if os.path.isfile(path) else (
+                os.path.join(directory, filename)
+                for directory, _, filenames in os.walk(path)
+                for filename in filenames
+            )) if self._is_source_file(filepath)
+        )
+
+    @metrics.timed("data", per_source=True)
     def data(self, x, y, z=0):
         x_offset, y_offset = self._transform(x, y)
-        return self._nan_to_num(
+        return utils.as_dtype(self._nan_to_num(
             self._normalize(
                 self._convert_to_nans(
                     self._data(x_offset, y_offset, z)
                 )
             )
-        )
+        ), self.dtype)
 
     def _convert_to_nans(self, array):
         if self.nan is not None:
             if isinstance(array, np.ndarray):
-                data = array.astype("float64")
+                data = array.astype(self.dtype)
                 data[data == self.nan] = np.nan
                 return data
             else:
@@ -80,9 +113,18 @@ class SpatialVectorData(Data, metaclass=ABCMeta):
     def spatial_driver(self):
         return ""
 
+    @property
+    def source_paths(self):
+        return (self.spatial_source_filepath, )
+
     def _use_layer(self, method, index):
         driver = ogr.GetDriverByName(self.spatial_driver)
-        source = driver.Open(self.spatial_source_filepath, 0)
+        # Fall back to any driver that can read the file, such as the
+        # GeoPackage stand-ins of groundwater_timenet.fixtures.
+        source = (
+            driver.Open(self.spatial_source_filepath, 0) or
+            ogr.Open(self.spatial_source_filepath, 0)
+        )
         return method(source.GetLayerByIndex(index))
 
     def _layer_data(self, field_name, geom, index=0):
@@ -108,6 +150,10 @@ class SpatialRasterData(Data, metaclass=ABCMeta):
     def spatial_source_filepath(self):
         return ""
 
+    @property
+    def source_paths(self):
+        return (self.spatial_source_filepath, )
+
     def __init__(self, *args, **kwargs):
         super(SpatialRasterData, self).__init__(*args, **kwargs)
         source = gdal.Open(self.spatial_source_filepath)
@@ -143,9 +189,10 @@ class TemporalData(Data, metaclass=ABCMeta):
     def _data(self, x, y, start=None, end=None):
         return np.array([])
 
+    @metrics.timed("data", per_source=True)
     def data(self, x, y, start=None, end=None):
         x_offset, y_offset = self._transform(x, y)
-        return self._nan_to_num(
+        return utils.as_dtype(self._nan_to_num(
             self._normalize(
                 self._convert_to_nans(
                     self._resample(
@@ -154,8 +201,9 @@ class TemporalData(Data, metaclass=ABCMeta):
                     )
                 )
             )
-        )
+        ), self.dtype)
 
+    @metrics.timed("resample", per_source=True)
     def _resample(self, data, start=None, end=None):
         if self.resample_method == 'first':
             data = data.resample(self.timedelta).first()
@@ -265,7 +313,16 @@ class BaseData(SelectorMixin, TemporalData, metaclass=ABCMeta):
 
     def __init__(
             self, seed=4177, train_percentage=70, validation_percentage=20,
-            test_percentage=10, selection="", *args, **kwargs):
+            test_percentage=10, selection="", shard=None,
+            cells=sharding.window_cells, order=None, *args, **kwargs):
+        """
+        :param shard: (i, n) to only read the wells of shard i of n, see
+            parse.sharding.
+        :param cells: function that maps the x and y of the wells to the
+            cells that are kept together in a shard.
+        :param order: function like cells to read the wells cell by cell,
+            such as the tiles of a KNMI grid, instead of longest first.
+        """
         assert(
             test_percentage + validation_percentage + train_percentage == 100)
         super(BaseData, self).__init__(*args, **kwargs)
@@ -274,6 +331,9 @@ class BaseData(SelectorMixin, TemporalData, metaclass=ABCMeta):
         self._meta_length = len(self._all_metadata)
         self.selection = selection
         self.seed = seed
+        self.shard = shard
+        self.cells = cells
+        self.order = order
         self._parts = {
             "all": slice(None),
             "train": self._pct_to_index(0, train_percentage),
@@ -290,6 +350,24 @@ class BaseData(SelectorMixin, TemporalData, metaclass=ABCMeta):
             int(self._meta_length * to_pct / 100.0)
         )
 
+    def _in_shard(self, metadata):
+        """:return: the rows of metadata of the wells in this shard."""
+        if self.shard is None:
+            return metadata
+        i, n = self.shard
+        shards = sharding.assign(
+            self.cells(metadata.x.values, metadata.y.values), n)
+        return metadata[shards == i]
+
+    def _in_order(self, metadata):
+        if self.order is None:
+            return metadata
+        return metadata.iloc[sharding.cell_order(
+            self.order(metadata.x.values, metadata.y.values))]
+
+    def part_metadata(self, part):
+        return self._in_shard(self._all_metadata[self._parts[part]])
+
     @abstractmethod
     def _data(self, slice_):
         yield
@@ -311,13 +389,16 @@ class BaseData(SelectorMixin, TemporalData, metaclass=ABCMeta):
             x, y, z, meta_row, metadata, dataframe = next(self._iterator)
             start = meta_row.start.to_pydatetime().date()
             end = meta_row.end.to_pydatetime().date()
+            if len(dataframe):
+                # measurements appended after the metadata was listed.
+                end = max(end, dataframe.index[-1].date())
             return (
-                x, y, z, start, end, metadata,
-                self._nan_to_num(
+                x, y, z, start, end, utils.as_dtype(metadata, self.dtype),
+                utils.as_dtype(self._nan_to_num(
                     self._normalize(
                         self._convert_to_nans(
                             self._resample(dataframe, start, end)
-                        ))))
+                        ))), self.dtype))
         raise StopIteration
 
     def __call__(self, part):
@@ -0,0 +1,197 @@
+"""
+Caches of the features the Combiner reads per well.
+
+The metadata sources (GeoTOP, BOFEK, irrigation and drinking water) only
+depend on the location of a well, and many DINO wells have several filters
+at the same location. The FeatureCache keeps the metadata vector per
+(x, y, z) in an LRU in memory and in an SQLite database on disk, under a
+version of the sources. A combine that runs again, or another part of the
+same run, skips the spatial lookups of the wells it has seen before. The
+version changes when a source is harvested or parsed again, which makes
+the old vectors unreachable.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from groundwater_timenet import metrics
+from groundwater_timenet import utils
+
+
+logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
+
+FEATURE_CACHE = os.path.join("var", "data", "cache", "metadata_features.db")
+# Key of a missing coordinate, NaN never equals itself and SQLite stores it
+# as NULL.
+MISSING = -9999.0
+
+
+class LRU(object):
+    """
+    Least recently used cache with a maximum weight, such as the number of
+    items or their size in bytes.
+    """
+
+    def __init__(self, maxweight, weigh=lambda value: 1):
+        """
+        :param maxweight: the least recently used items are evicted when the
+            weight of all items exceeds maxweight.
+        :param weigh: function that returns the weight of a value.
+        """
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._items[key]
+        except KeyError:
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        weight = self.weigh(value)
+        if key in self._items:
+            self.weight -= self._items.pop(key)[1]
+        if weight > self.maxweight:
+            return
+        self._items[key] = (value, weight)
+        self.weight += weight
+        while self.weight > self.maxweight:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.weight -= evicted
+
+    def clear(self):
+        self._items.clear()
+        self.weight = 0
+
+
+class FeatureCache(object):
+    """Metadata vectors per (x, y, z) in memory and in SQLite on disk."""
+
+    def __init__(self, filepath=FEATURE_CACHE, version="", dtype=None,
+                 maxsize=100000, commit_every=1000):
+        """
+        :param filepath: SQLite database, or None to only cache in memory.
+        :param version: version of the sources the vectors are computed
+            from, see version_of.
+        :param maxsize: number of vectors kept in memory.
+        :param commit_every: commit the vectors written to disk every
+            commit_every vectors, and at flush.
+        """
+        self.filepath = filepath
+        self.version = version
+        self.dtype = np.dtype(utils.DTYPE if dtype is None else dtype)
+        self.commit_every = commit_every
+        self.memory = LRU(maxsize)
+        self.stats = {'memory': 0, 'disk': 0, 'misses': 0}
+        self._uncommitted = 0
+        self._connection = None
+
+    @staticmethod
+    def version_of(sources, dtype):
+        """:return: hash of the class and version of every source."""
+        return hashlib.sha256(json.dumps({
+            'dtype': np.dtype(dtype).name,
+            'sources': [
+                [type(source).__name__, source.version()]
+                for source in sources
+            ]
+        }, sort_keys=True).encode('utf8')).hexdigest()
+
+    @property
+    def connection(self):
+        if self._connection is None and self.filepath is not None:
+            utils.mkdirs(self.filepath)
+            self._connection = sqlite3.connect(self.filepath, timeout=60)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS features ("
+                "version TEXT, x REAL, y REAL, z REAL, vector BLOB, "
+                "PRIMARY KEY (version, x, y, z))"
+            )
+        return self._connection
+
+    def _read(self, key):
+        if self.connection is None:
+            return None
+        row = self.connection.execute(
+            "SELECT vector FROM features WHERE version = ? AND x = ? AND "
+            "y = ? AND z = ?", (self.version, ) + key
+        ).fetchone()
+        if row is not None:
+            return np.frombuffer(row[0], dtype=self.dtype)
+
+    def _write(self, key, vector):
+        if self.connection is None:
+            return
+        self.connection.execute(
+            "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)",
+            (self.version, ) + key + (vector.tobytes(), )
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.flush()
+
+    def get(self, x, y, z, compute):
+        """
+        :param compute: function of (x, y, z) that computes the vector when
+            it is not cached.
+        :return: the metadata vector of the location, read only.
+        """
+        key = tuple(
+            MISSING if np.isnan(c) else c for c in map(float, (x, y, z)))
+        vector = self.memory.get(key)
+        if vector is not None:
+            self._count('memory')
+            return vector
+        vector = self._read(key)
+        if vector is not None:
+            self._count('disk')
+        else:
+            self._count('misses')
+            vector = np.ascontiguousarray(compute(x, y, z), dtype=self.dtype)
+            vector.setflags(write=False)
+            self._write(key, vector)
+        self.memory.put(key, vector)
+        return vector
+
+    def _count(self, layer):
+        self.stats[layer] += 1
+        if layer == 'misses':
+            metrics.count("feature_cache_misses")
+        else:
+            metrics.count("feature_cache_hits", source=layer)
+
+    def hit_rate(self):
+        """:return: the fraction of lookups served from memory or disk."""
+        total = sum(self.stats.values())
+        if not total:
+            return 0.0
+        return (self.stats['memory'] + self.stats['disk']) / total
+
+    def flush(self):
+        if self._connection is not None:
+            self._connection.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        logger.info(
+            "Metadata feature cache: %d memory hits, %d disk hits, "
+            "%d misses (hit rate %.2f)", self.stats['memory'],
+            self.stats['disk'], self.stats['misses'], self.hit_rate())
@@ -1,16 +1,25 @@
 from itertools import chain
+import argparse
 import datetime
-import time
+import hashlib
+import json
 
 import numpy as np
 
+from . import sharding
 from .base import Data
+from .cache import FeatureCache, FEATURE_CACHE
 from .geotop import GeotopData
-from .knmi import WeatherStationData, RainData, EvapoTranspirationData
+from .knmi import (
+    WeatherStationData, KnmiData, RainData, EvapoTranspirationData)
 from .dino import DinoData
 from .other import Bofek, Irrigation, DrinkingWater
+from groundwater_timenet import memory
+from groundwater_timenet import metrics
 from groundwater_timenet import utils
-from groundwater_timenet.learn.generator import ConvCombinerGenerator
+from groundwater_timenet.learn.generator import (
+    ConvCombinerGenerator, CompactCombinerGenerator)
+from groundwater_timenet.learn.shards import ShardWriter
 from groundwater_timenet.learn.settings import *
 
 
@@ -23,6 +32,8 @@ DEFAULT_SELECTION = (
     '(days > (365 * 2))'
 )
 FIRST_DATESTAMP = datetime.date(1965, 1, 1)
+# Lists the series hashes of every shard the Combiner wrote in a part.
+MANIFEST = "manifest.json"
 
 
 class Combiner(object):
@@ -38,6 +49,7 @@ class Combiner(object):
         'halfmonthly': ("SM", datetime.timedelta(days=15)),
         '15day': ("15D", datetime.timedelta(days=15)),
     }
+    output_root = os.path.join("var", "data", "neuralnet")
     data_sources = (
         DinoData,
         WeatherStationData,
@@ -53,12 +65,34 @@ class Combiner(object):
     def __init__(
             self, timestep="halfmonthly", resample_method='first',
             first_datestamp=FIRST_DATESTAMP, chunk_size=1000,
-            selection=DEFAULT_SELECTION, *args, **kwargs):
+            selection=DEFAULT_SELECTION, dtype=None, shard=None,
+            shard_by="window", feature_cache=FEATURE_CACHE, tile_order=False,
+            profiler=None, *args, **kwargs):
+        """
+        :param shard: (i, n) to only combine the wells of shard i of n.
+        :param shard_by: keep the wells of a "window" cell of the DINO
+            harvest or of a "tile" of the KNMI grids together in a shard.
+        :param feature_cache: SQLite database the metadata vectors per
+            location are cached in, or None to only cache them in memory.
+        :param tile_order: combine the wells tile by tile of the KNMI grids,
+            so the tile cache of the KNMI sources reads every tile once.
+        :param profiler: a memory.MemoryProfiler to profile the stages of
+            combine with.
+        """
         self.chunk_size = chunk_size
+        self.shard = shard
+        self.profiler = profiler or memory.NullProfiler()
+        self.dtype = utils.DTYPE if dtype is None else dtype
+        self.resample_method = resample_method
+        self.first_datestamp = first_datestamp
+        kwargs['dtype'] = self.dtype
         self.timestep = self.timedeltas.get(timestep, timestep)[0]
         self.temporal_shift = self.timedeltas.get(timestep, timestep)[1]
         self._meta_data = [metadata(*args, **kwargs) for metadata in
                            self._filter_source(Data.DataType.METADATA)]
+        self.feature_cache = FeatureCache(
+            feature_cache,
+            FeatureCache.version_of(self._meta_data, self.dtype), self.dtype)
         self._temporal_data = [
             temporal(
                 timedelta=self.timestep, resample_method=resample_method,
@@ -68,7 +102,8 @@ class Combiner(object):
         self._base_data = self._filter_source(Data.DataType.BASE)[0](
             timedelta=self.timestep, resample_method=resample_method,
             selection=selection, first_timestamp=first_datestamp,
-            *args, **kwargs
+            shard=shard, cells=self._cells(shard_by),
+            order=self._cells("tile") if tile_order else None, *args, **kwargs
         )
         self.dataset_name = tuple(
             name + "_" + str(i) for name in ("base", "temporal", "meta")
@@ -79,9 +114,43 @@ class Combiner(object):
         return tuple(
             filter(lambda ds: ds.type == data_type, self.data_sources))
 
+    def _cells(self, shard_by):
+        if shard_by == "window":
+            return sharding.window_cells
+        if shard_by == "tile":
+            return sharding.tile_cells(next(
+                data for data in self._temporal_data
+                if isinstance(data, KnmiData)))
+        raise ValueError("Unknown shard_by {!r}".format(shard_by))
+
+    @classmethod
+    def part_directory(cls, part, shard=None):
+        """:return: the directory a part, or a shard of it, is written to."""
+        directory = os.path.join(cls.output_root, part)
+        if shard is not None:
+            directory = os.path.join(
+                directory, sharding.directory_name(*shard))
+        return directory
+
+    def build_lookups(self, part="all"):
+        """Fills the grid lookup tables of the KNMI sources for the wells."""
+        metadata = self._base_data.part_metadata(part)
+        for data in self._temporal_data:
+            if isinstance(data, KnmiData):
+                data.build_lookup(metadata.x.values, metadata.y.values)
+
+    def save_lookups(self):
+        for data in self._temporal_data:
+            if isinstance(data, KnmiData):
+                data.save_lookup()
+
+    def _meta_features(self, x, y, z):
+        return np.concatenate(
+            [metadata.data(x, y, z) for metadata in self._meta_data])
+
     def meta_data(self, base, x, y, z):
         return np.concatenate(
-            [base] + [metadata.data(x, y, z) for metadata in self._meta_data])
+            [base, self.feature_cache.get(x, y, z, self._meta_features)])
 
     def temporal_data(self, base, x, y, start, end):
         start += self.temporal_shift
@@ -93,48 +162,190 @@ class Combiner(object):
         ]
         return np.hstack(temporal_data)
 
-    def combine(self, part):
-        temporal = []
-        meta = []
-        base = []
-        for i, params in enumerate(self._base_data(part)):
-            x, y, z, start, end, base_metadata, base_data = params
-            base.append(base_data[1:])
-            temporal.append(
-                self.temporal_data(base_data, x, y, start, end))
-            meta.append(self.meta_data(base_metadata, x, y, z))
-            if not (i + 1) % self.chunk_size and i != 0:
-                filepath = os.path.join(
-                    "var", "data", "neuralnet", part, str(i + 1) + ".h5")
-                utils.store_h5(
-                    data=base + temporal + meta,
-                    dataset_name=self.dataset_name,
-                    target_h5=filepath,
+    def fingerprint(self):
+        """
+        Hash of the settings of the combiner and the versions of the
+        temporal and metadata sources. The DINO series are hashed one by
+        one in series_hash.
+        """
+        return hashlib.sha256(json.dumps({
+            'timestep': self.timestep,
+            'temporal_shift': str(self.temporal_shift),
+            'resample_method': self.resample_method,
+            'first_datestamp': str(self.first_datestamp),
+            'dtype': np.dtype(self.dtype).name,
+            'sources': [
+                [type(data).__name__, data.version()] for data in
+                self._temporal_data + self._meta_data
+            ]
+        }, sort_keys=True).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def series_hash(fingerprint, x, y, z, start, end, base_metadata,
+                    base_data):
+        """
+        Content hash of the inputs of a combined series. The end is the date
+        of the last measurement, so a series that got new measurements is
+        combined again.
+        """
+        digest = hashlib.sha256(fingerprint.encode('utf8'))
+        digest.update(repr((
+            float(x), float(y), float(z), str(start), str(end))
+        ).encode('utf8'))
+        digest.update(np.ascontiguousarray(base_metadata).tobytes())
+        digest.update(np.ascontiguousarray(base_data).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _read_manifest(directory):
+        try:
+            with open(os.path.join(directory, MANIFEST)) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_manifest(directory, manifest):
+        filepath = os.path.join(directory, MANIFEST)
+        utils.mkdirs(filepath)
+        with open(filepath + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(filepath + '.tmp', filepath)
+
+    def _combined_series(self, params):
+        x, y, z, start, end, base_metadata, base_data = params
+        with self.profiler.stage("temporal"):
+            temporal = self.temporal_data(base_data, x, y, start, end)
+        with self.profiler.stage("meta"):
+            meta = self.meta_data(base_metadata, x, y, z)
+        return base_data[1:], temporal, meta
+
+    def _combine_shard(self, directory, filename, shard, written):
+        """
+        Writes the series of a shard to a temporary file next to it.
+        Series that were combined before are copied from the shard they
+        were written to.
+
+        :return: the path of the temporary file.
+        """
+        base, temporal, meta = [], [], []
+        reused = 0
+        for series_hash, params in shard:
+            try:
+                source, k = written[series_hash]
+            except KeyError:
+                series = self._combined_series(params)
+            else:
+                series = utils.read_h5(
+                    filepath=os.path.join(directory, source),
+                    dataset_name=[
+                        name + "_" + str(k)
+                        for name in ("base", "temporal", "meta")],
                     many=True
                 )
-                logger.info(
-                    "Combined %d series in total. Wrote %d to file %s.",
-                    i + 1, self.chunk_size, filepath)
-                temporal = []
-                meta = []
-                base = []
+                reused += 1
+            base.append(series[0])
+            temporal.append(series[1])
+            meta.append(series[2])
+        metrics.count("reused_series", value=reused)
+        metrics.count("combined_series", value=len(shard) - reused)
+        filepath = os.path.join(directory, filename)
+        with self.profiler.stage("store"):
+            utils.store_h5(
+                data=base + temporal + meta,
+                dataset_name=self.dataset_name,
+                target_h5=filepath + '.tmp',
+                many=True,
+                dtype=self.dtype
+            )
+        logger.info(
+            "Wrote %s, combined %d and reused %d series.", filepath,
+            len(shard) - reused, reused)
+        return filepath + '.tmp'
+
+    def combine(self, part, incremental=False):
+        """
+        Combines the sources of the series of part into shards of
+        chunk_size series.
+
+        :param incremental: skip the shards whose series have the same
+            inputs as when they were written, and copy the unchanged series
+            of the other shards instead of combining them again.
+        """
+        directory = self.part_directory(part, self.shard)
+        self.build_lookups(part)
+        fingerprint = self.fingerprint()
+        previous = self._read_manifest(directory) if incremental else {}
+        # hash -> (shard, position) of the series combined before.
+        written = {
+            series_hash: (filename, k)
+            for filename, hashes in previous.items()
+            for k, series_hash in enumerate(hashes)
+            if os.path.exists(os.path.join(directory, filename))
+        }
+        manifest = {}
+        # shards that are read from are only replaced after the run.
+        pending = []
+        shard = []
+        series = memory.profiled(self.profiler, "base", self._base_data(part))
+        for i, params in enumerate(series):
+            metrics.export_periodically()
+            self.profiler.sample(i, part=part)
+            shard.append((self.series_hash(fingerprint, *params), params))
+            if not (i + 1) % self.chunk_size and i != 0:
+                filename = str(i + 1) + ".h5"
+                hashes = [series_hash for series_hash, _ in shard]
+                manifest[filename] = hashes
+                if previous.get(filename) == hashes and os.path.exists(
+                        os.path.join(directory, filename)):
+                    metrics.count("skipped_shards")
+                    logger.info("Skipped unchanged %s", filename)
+                else:
+                    tmp_filepath = self._combine_shard(
+                        directory, filename, shard, written)
+                    if written:
+                        pending.append(tmp_filepath)
+                    else:
+                        os.replace(tmp_filepath, tmp_filepath[:-4])
+                logger.info("Combined %d series in total.", i + 1)
+                shard = []
+        for tmp_filepath in pending:
+            os.replace(tmp_filepath, tmp_filepath[:-4])
+        for filename in set(previous) - set(manifest):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+        self._write_manifest(directory, manifest)
+        self.save_lookups()
+        self.feature_cache.close()
+        metrics.export()
 
 
 class UncompressedCombiner(Combiner):
+    generator_class = ConvCombinerGenerator
+    output_root = "neuralnet"
 
     def __init__(
             self, timestep="halfmonthly", resample_method='first',
             first_datestamp=FIRST_DATESTAMP, chunk_size=CHUNK_SIZE,
             selection=DEFAULT_SELECTION, base="neuralnet", data_type="train",
             batch_size=BATCH_SIZE, meta_size=META_SIZE, temporal_size=TEMPORAL_SIZE,
-            input_size=INPUT_SIZE, output_size=OUTPUT_SIZE, *args, **kwargs):
+            input_size=INPUT_SIZE, output_size=OUTPUT_SIZE, profiler=None,
+            shard_format="h5", *args, **kwargs):
+        """
+        :param shard_format: "h5" for an HDF5 file per chunk of batches or
+            "npy" for the memory-mapped shards of learn.shards.
+        """
         super().__init__(
             timestep="halfmonthly", resample_method='first',
             first_datestamp=FIRST_DATESTAMP, chunk_size=chunk_size,
-            selection=DEFAULT_SELECTION, *args, **kwargs)
-        self.generator = ConvCombinerGenerator(
+            selection=DEFAULT_SELECTION, profiler=profiler, *args, **kwargs)
+        self.generator = self.generator_class(
             base, data_type, batch_size, chunk_size, meta_size, temporal_size,
-            input_size, output_size)
+            input_size, output_size, dtype=self.dtype)
+        self.shard_format = shard_format
+        self._shard_writers = {}
         self.dataset_name = tuple(
             name + "_" + str(i) for name in ("input", "output")
             for i in range(self.chunk_size)
@@ -147,38 +358,183 @@ class UncompressedCombiner(Combiner):
         )
         size_ = self.chunk_size * self.generator.batch_size / 100
         i = 0
-        total = 0
-        start_time = time.time()
-        for j, params in enumerate(self._base_data(part)):
+        progress = utils.Progress(logger)
+        directory = self.part_directory(part, self.shard)
+        self.build_lookups(part)
+        series = memory.profiled(self.profiler, "base", self._base_data(part))
+        for j, params in enumerate(series):
+            metrics.export_periodically()
+            self.profiler.sample(
+                j, part=part, rows=self.generator.input_data.shape[0])
             x, y, z, start, end, base_metadata, base = params
-            temporal = self.temporal_data(base, x, y, start, end)
-            meta = self.meta_data(base_metadata, x, y, z)
-            if not self.generator.generate_batch(base[1:], meta, temporal):
+            with self.profiler.stage("temporal"):
+                temporal = self.temporal_data(base, x, y, start, end)
+            with self.profiler.stage("meta"):
+                meta = self.meta_data(base_metadata, x, y, z)
+            metrics.count("series")
+            with self.profiler.stage("generate_batch"):
+                packed = self.generator.generate_batch(
+                    base[1:], meta, temporal)
+            if not packed:
                 logger.warn('Empty series at position %d', i)
+                metrics.count("empty_series")
                 continue
-            duration = time.time() - start_time
-            total = max(total, len(self._base_data))
-            time_left_seconds = (duration / (j + 1)) * (total - j)
-            time_left_hours = time_left_seconds // 3600
-            time_left_minutes = (time_left_seconds % 3600) // 60
-            logger.info(
-                "Packed series #%d. At: %d  |  ETA: %d:%d" % (
-                    j, round(self.generator.input_data.shape[0] / size_, 2),
-                    time_left_hours, time_left_minutes
-                )
-            )
-            for input_data, output_data in self.generator.unpack_batches(
+            if progress.due(j):
+                progress.log(
+                    j, "Packed series #%d. At: %.2f", j,
+                    self.generator.input_data.shape[0] / size_,
+                    total=len(self._base_data))
+            for batches in self.generator.unpack_batches(
                     chunk_size=self.chunk_size):
                 i += 1
-                filepath = os.path.join(
-                    # "var", "data", "neuralnet", part, str(i) + ".h5")
-                    "neuralnet", part, str(i + 1) + ".h5")
-                utils.store_h5(
-                    data=chain.from_iterable([input_data, output_data]),
-                    dataset_name=self.dataset_name,
-                    target_h5=filepath,
-                    many=True
-                )
+                filepath = os.path.join(directory, str(i + 1) + ".h5")
+                with self.profiler.stage("store"):
+                    self._store(filepath, *batches)
+                metrics.count("files")
                 logger.info(
                     "Combined %d series in total. Wrote %d to file %s.",
                     i + 1, self.chunk_size, filepath)
+        self.save_lookups()
+        self.feature_cache.close()
+        metrics.export()
+
+    def _store(self, filepath, input_data, output_data):
+        if self.shard_format == "npy":
+            directory, filename = os.path.split(filepath)
+            try:
+                writer = self._shard_writers[directory]
+            except KeyError:
+                writer = self._shard_writers[directory] = ShardWriter(
+                    directory, self.dtype)
+            writer.write(
+                os.path.splitext(filename)[0], input_data, output_data)
+            return
+        utils.store_h5(
+            data=chain.from_iterable([input_data, output_data]),
+            dataset_name=self.dataset_name,
+            target_h5=filepath,
+            many=True,
+            dtype=self.dtype
+        )
+
+
+class CompactCombiner(UncompressedCombiner):
+    """
+    Stores the metadata once per series in each file instead of repeating it
+    for every timestep of every window. Read the files with the
+    CompactConvolutionalAtrousGenerator.
+    """
+    generator_class = CompactCombinerGenerator
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.shard_format != "h5":
+            raise ValueError("The CompactCombiner only writes HDF5 files.")
+        self.dataset_name = tuple(
+            name + "_" + str(i)
+            for name in ("temporal", "output", "meta_index")
+            for i in range(self.chunk_size)
+        ) + ("meta", )
+
+    def _store(self, filepath, temporal, output_data, meta_index, meta):
+        utils.store_h5(
+            data=chain(temporal, output_data, meta_index, [meta]),
+            dataset_name=self.dataset_name,
+            target_h5=filepath,
+            many=True,
+            dtype=self.dtype
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Combines the sources into neural network input files.")
+    parser.add_argument(
+        "parts", nargs="*", default=["train", "validation", "test"])
+    parser.add_argument(
+        "--compact", action="store_true",
+        help="store the metadata once per series (CompactCombiner)")
+    parser.add_argument(
+        "--format", choices=("h5", "npy"), default="h5",
+        help="write HDF5 files or memory-mapped .npy shards with a manifest")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="write shards of series with the Combiner and only combine "
+             "the series whose inputs changed since the last run")
+    parser.add_argument(
+        "--shard", type=sharding.parse_shard, metavar="I/N",
+        help="only combine the wells of shard I of N (counting from 0), "
+             "in a compact region, into a shard directory of each part")
+    parser.add_argument(
+        "--shard-by", choices=("window", "tile"), default="window",
+        help="keep the wells of a 10 km cell of the DINO harvest or of a "
+             "KNMI grid tile together in a shard")
+    parser.add_argument(
+        "--merge", type=int, metavar="N",
+        help="merge the output of the N shards of each part instead of "
+             "combining")
+    parser.add_argument(
+        "--tile-order", action="store_true",
+        help="combine the wells tile by tile of the KNMI grids instead of "
+             "longest series first, to read every tile once")
+    parser.add_argument(
+        "--no-feature-cache", action="store_true",
+        help="don't read or write the metadata vectors per location in "
+             + FEATURE_CACHE)
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="record timings per source and stage and write them to FILE, "
+             "in the Prometheus text format when FILE ends with .prom")
+    parser.add_argument(
+        "--metrics-interval", type=float, default=60.0, metavar="SECONDS",
+        help="also write the metrics every SECONDS during the run")
+    parser.add_argument(
+        "--profile-memory", metavar="FILE",
+        help="trace memory per stage and write a timeline report to FILE")
+    parser.add_argument(
+        "--profile-every", type=int, default=100, metavar="N",
+        help="sample RSS and the top allocators every N series")
+    args = parser.parse_args(argv)
+    if args.incremental and args.compact:
+        parser.error("--incremental cannot be combined with --compact")
+    if args.format == "npy" and (args.incremental or args.compact):
+        parser.error("--format npy is only written by the default combiner")
+    if args.merge is not None and args.shard is not None:
+        parser.error("--merge cannot be combined with --shard")
+    if args.merge is not None:
+        combiner_class = Combiner if args.incremental else (
+            CompactCombiner if args.compact else UncompressedCombiner)
+        for part in args.parts:
+            sharding.merge(combiner_class.part_directory(part), args.merge)
+        return
+    if args.metrics:
+        metrics.enable(args.metrics, args.metrics_interval)
+    profiler = None
+    if args.profile_memory:
+        profiler = memory.MemoryProfiler(
+            args.profile_memory, every=args.profile_every).start()
+    feature_cache = None if args.no_feature_cache else FEATURE_CACHE
+    if args.incremental:
+        combiner = Combiner(
+            profiler=profiler, shard=args.shard, shard_by=args.shard_by,
+            feature_cache=feature_cache, tile_order=args.tile_order)
+    else:
+        combiner = (
+            CompactCombiner if args.compact else UncompressedCombiner)(
+            profiler=profiler, shard_format=args.format, shard=args.shard,
+            shard_by=args.shard_by, feature_cache=feature_cache,
+            tile_order=args.tile_order)
+    try:
+        for part in args.parts:
+            if args.incremental:
+                combiner.combine(part, incremental=True)
+            else:
+                combiner.combine(part)
+    finally:
+        metrics.export()
+        if profiler is not None:
+            profiler.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,22 @@ import datetime
 import os
 import random
 
-import h5py
 import numpy as np
-import pandas as pd
 
 from groundwater_timenet import utils
-from groundwater_timenet.collect import dino as collect
 from groundwater_timenet.parse.base import BaseData
 
+# the harvester imports the OWSLib and suds clients, only its paths are used.
+collect = utils.lazy_import('groundwater_timenet.collect.dino')
+h5py = utils.lazy_import('h5py')
+pd = utils.lazy_import('pandas')
+
 
 logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
 
 DATETIME_EPOCH = datetime.datetime(1970,1,1)
+# Shuffles the wells the same way on every node.
+SEED = 4177
 
 
 def filepaths():
@@ -23,7 +27,7 @@ def filepaths():
     )
 
 
-def _list_metadata(shuffled=False):
+def _list_metadata(shuffled=False, seed=SEED):
     base = os.path.join(utils.DATA, collect.FILENAME_BASE)
     logger.info("All y coordinates: %s", str(os.listdir(base)))
     total = set()
@@ -34,14 +38,19 @@ def _list_metadata(shuffled=False):
         for md in metadata:
             wellcode = md[0].decode('utf8')
             filtercode = md[1].decode('utf8')
-            dataset = h5_file.get(wellcode + filtercode)
+            # h5py only reads points in increasing order, read it at once.
+            dataset = h5_file.get(wellcode + filtercode)[()]
+            # updates append newer measurements after the newest first
+            # series of a full harvest.
             try:
-                s, e = dataset[[-1, 0], 0].astype('datetime64[D]')
-            except OSError:
-                logger.debug("Left out well %s.%s: only 1 record found",
+                s, e = np.array([
+                    dataset[:, 0].min(), dataset[:, 0].max()
+                ]).astype('datetime64[s]')
+            except (IndexError, ValueError):
+                logger.debug("Left out well %s.%s: no records found",
                              wellcode, filtercode)
                 continue
-            days = int((e - s) / 86400)
+            days = int((e - s).astype(int) / 86400)
             if days < (365 * 2):
                 logger.debug("Left out well %s.%s: only %d records found",
                              wellcode, filtercode, days)
@@ -51,11 +60,13 @@ def _list_metadata(shuffled=False):
             min_step = int(np.min(delta) / 86400)
             max_step = int(np.max(delta) / 86400)
             median_step = int(np.median(delta) / 86400)
+            # encode everything, HDF5 can't store an array of mixed objects.
             new_meta.add(
                 tuple([filepath.encode('utf8')] +
                       md.tolist() +
-                      [days, dataset.shape[0], density, s, e, min_step,
-                       median_step, max_step])
+                      [str(v).encode('utf8') for v in (
+                          days, dataset.shape[0], density, s, e, min_step,
+                          median_step, max_step)])
             )
         total = total.union(new_meta)
         length = len(new_meta)
@@ -68,15 +79,17 @@ def _list_metadata(shuffled=False):
     logger.info("Total records found: %d", len(total))
     total = sorted([list(x) for x in total])
     if shuffled:
-        random.shuffle(total)
+        random.Random(seed).shuffle(total)
     result = np.array(total)
     return result
 
 
 def list_metadata(shuffled=False):
+    # an update of the harvest appends measurements and adds wells.
     metadata = utils.cache_h5(
         _list_metadata,
         target_h5=os.path.join("var", "data", "cache", "dino_base_metadata"),
+        version=utils.files_version(filepaths()),
         shuffled=shuffled
     )
     metadata[metadata == b''] = np.nan
@@ -129,13 +142,18 @@ class DinoData(BaseData):
         'bottom_height_nap_down'
     )
 
+    def _is_source_file(self, filepath):
+        # leaves out the checkpoints of the harvest.
+        return filepath.endswith('hdf5')
+
     def _read_metadata(self):
         return list_metadata(shuffled=True)
 
     def _data(self, slice_):
         metadata_sorted = self.select(
-            self.selection, self._all_metadata[slice_]
+            self.selection, self._in_shard(self._all_metadata[slice_])
         ).copy().sort_values(by="days", ascending=False)
+        metadata_sorted = self._in_order(metadata_sorted)
         self._length = len(metadata_sorted)
         filtercodes = {
             s: i for i, s in enumerate(sorted(set(metadata_sorted.filtercode)))
@@ -147,7 +165,7 @@ class DinoData(BaseData):
             timeseries_code = row.wellcode + row.filtercode
             data = h5_file.get(timeseries_code, [])
             index = pd.DatetimeIndex(data[:, 0].astype('datetime64[s]'))
-            dataframe = pd.DataFrame(data[:, 1], index=index)
+            dataframe = pd.DataFrame(data[:, 1], index=index).sort_index()
             z = (
                 row.top_height_nap_up or
                 row.top_height_nap_down or
@@ -1,11 +1,13 @@
 import os
 
-from netCDF4 import Dataset
 import numpy as np
 
 from groundwater_timenet import utils
 from groundwater_timenet.parse.base import Data
 
+h5py = utils.lazy_import('h5py')
+netCDF4 = utils.lazy_import('netCDF4')
+
 
 logger = utils.setup_logging(__name__, utils.PARSE_LOG)
 
@@ -39,32 +41,153 @@ STRAT_CLASSES = {
 }
 
 
+SIDECAR_FILENAME = 'geotop_wells.h5'
+# The strat code of a voxel without data.
+STRAT_MISSING = -32767
+
+
+def _grid_index(x, y):
+    return int(round(x - 13600) / 100), int(round(y - 358000) / 100)
+
+
+def _fill_value(variable):
+    return getattr(variable, '_FillValue', GeotopData.nan)
+
+
+def _unmask(name, values, fill_value):
+    """
+    :return: the values of a column with its masked voxels, or those equal to
+        fill_value, as NaN. Masked strat voxels get the STRAT_MISSING code.
+    """
+    if not np.ma.isMaskedArray(values):
+        values = np.ma.masked_equal(values, fill_value)
+    if name == 'strat':
+        return np.ma.filled(values, STRAT_MISSING)
+    return np.ma.filled(values.astype(float), np.nan)
+
+
+def build_sidecar(filename='geotop.nc', sidecar=SIDECAR_FILENAME,
+                  coordinates=None):
+    """
+    Extracts the GeoTOP voxel columns under the DINO wells into a small
+    HDF5 sidecar that GeotopData reads instead of the national netCDF.
+
+    :param coordinates: iterable with (x, y) RD coordinates, defaults to the
+        locations of all DINO wells.
+    """
+    if coordinates is None:
+        from groundwater_timenet.parse.dino import list_metadata
+        metadata = list_metadata()
+        coordinates = zip(metadata.x, metadata.y)
+    indices = sorted({
+        (rd_x, rd_y) for rd_x, rd_y in
+        (_grid_index(x, y) for x, y in coordinates)
+        if rd_x >= 0 and rd_y >= 0
+    })
+    sidecar_filepath = os.path.join(utils.DATA, GeotopData.root, sidecar)
+    rootgrp = netCDF4.Dataset(
+        os.path.join(utils.DATA, GeotopData.root, filename), "r")
+    x_size, y_size = len(rootgrp['x']), len(rootgrp['y'])
+    indices = np.array(
+        [(rd_x, rd_y) for rd_x, rd_y in indices
+         if rd_x < x_size and rd_y < y_size],
+        dtype='int32'
+    ).reshape(-1, 2)
+    utils.mkdirs(sidecar_filepath)
+    with h5py.File(sidecar_filepath, "w", libver='latest') as h5_file:
+        h5_file.attrs['source'] = filename
+        h5_file.create_dataset('index', data=indices)
+        h5_file.create_dataset('x', data=rootgrp['x'][:][indices[:, 0]])
+        h5_file.create_dataset('y', data=rootgrp['y'][:][indices[:, 1]])
+        for name in RELEVANT_VARIABLES:
+            variable = rootgrp[name]
+            dataset = h5_file.create_dataset(
+                name, shape=(len(indices), variable.shape[2]),
+                dtype=variable.dtype)
+            fill_value = _fill_value(variable)
+            dataset.attrs['_FillValue'] = fill_value
+            for i, (rd_x, rd_y) in enumerate(indices):
+                dataset[i] = np.ma.filled(variable[rd_x, rd_y, :], fill_value)
+    rootgrp.close()
+    logger.info("Stored %d GeoTOP columns in %s", len(indices),
+                sidecar_filepath)
+
+
 class GeotopData(Data):
     root = "geotop"
     type = Data.DataType.METADATA
     nan = -127
     EMPTY = np.zeros(66)
 
-    def __init__(self, filename='geotop.nc', *args, **kwargs):
+    def __init__(self, filename='geotop.nc', sidecar=SIDECAR_FILENAME,
+                 *args, **kwargs):
         super(GeotopData, self).__init__(*args, **kwargs)
         self.filepath = os.path.join(utils.DATA, self.root, filename)
-        self.rootgrp = Dataset(self.filepath, "r")
+        self._rootgrp = None
+        self._columns = {}
+        if sidecar is not None:
+            self._read_sidecar(os.path.join(utils.DATA, self.root, sidecar))
+
+    @property
+    def source_paths(self):
+        # the sidecar is derived from the netCDF for the wells.
+        return (self.filepath, )
+
+    @property
+    def rootgrp(self):
+        # Only open the national netCDF when a column is not in the sidecar.
+        if self._rootgrp is None:
+            self._rootgrp = netCDF4.Dataset(self.filepath, "r")
+        return self._rootgrp
+
+    def _read_sidecar(self, sidecar_filepath):
+        if not os.path.exists(sidecar_filepath):
+            logger.info("No GeoTOP sidecar found at %s, reading from %s",
+                        sidecar_filepath, self.filepath)
+            return
+        with h5py.File(sidecar_filepath, "r", libver='latest') as h5_file:
+            variables = {
+                name: h5_file[name][()] for name in ('x', 'y')}
+            for name in RELEVANT_VARIABLES:
+                dataset = h5_file[name]
+                variables[name] = _unmask(
+                    name, dataset[()],
+                    dataset.attrs.get('_FillValue', self.nan))
+            for i, (rd_x, rd_y) in enumerate(h5_file['index'][()]):
+                self._columns[(int(rd_x), int(rd_y))] = {
+                    name: values[i] for name, values in variables.items()}
+        logger.info("Read %d GeoTOP columns from %s", len(self._columns),
+                    sidecar_filepath)
+
+    def _column(self, rd_x, rd_y):
+        try:
+            return self._columns[(rd_x, rd_y)]
+        except KeyError:
+            pass
+        column = {
+            'x': self.rootgrp['x'][rd_x],
+            'y': self.rootgrp['y'][rd_y]
+        }
+        for name in RELEVANT_VARIABLES:
+            variable = self.rootgrp[name]
+            column[name] = _unmask(
+                name, variable[rd_x, rd_y, :], _fill_value(variable))
+        return column
 
     def _data(self, x, y, z=0, *args, **kwargs):
-        rd_x = int(round(x - 13600) / 100)
-        rd_y = int(round(y - 358000) / 100)
+        rd_x, rd_y = _grid_index(x, y)
         if rd_x < 0 or rd_y < 0:
             return []
+        column = self._column(rd_x, rd_y)
         try:
-            assert self.rootgrp['x'][rd_x] == (x // 100 * 100)
-            assert self.rootgrp['y'][rd_y] == (y // 100 * 100)
+            assert column['x'] == (x // 100 * 100)
+            assert column['y'] == (y // 100 * 100)
         except AssertionError as e:
             logger.exception(
                 "Assertion Error, x and/or y do not match. "
                 "Expected x: %d, x location %d, rd x: %d. "
                 "Expected y: %d, y location: %d, rd y: %d. Error: %s.",
-                self.rootgrp['x'][rd_x], rd_x, x, self.rootgrp['y'][rd_y],
-                rd_y, y, e
+                column['x'], rd_x, x, column['y'], rd_y, y, e
             )
 
         if z != -9999 and not np.isnan(z):
@@ -72,25 +195,24 @@ class GeotopData(Data):
             if depth < 0:
                 return []
             return [
-                self.rootgrp[variable][rd_x, rd_y, depth]
-                for variable in RELEVANT_VARIABLES
+                column[variable][depth] for variable in RELEVANT_VARIABLES
             ]
         else:
             # We don't know the depth of the well: look for first value in the
             # z direction. This is the surface. We choose the depth as a meter
             # below the surface (= -2 * voxels of 0.5m high).
-            where = np.where(self.rootgrp['strat'][rd_x, rd_y, :] == '-32767')
+            where = np.where(column['strat'] == '-32767')
             if where[0]:
                 depth = where[0][0] - 2
                 return [
-                    self.rootgrp[variable][rd_x, rd_y, depth]
+                    column[variable][depth]
                     for variable in RELEVANT_VARIABLES
                 ]
         return []
 
     def _strat(self, code):
         zeros = np.zeros(56)
-        zeros[STRAT_CLASSES[str(code)]] = 1
+        zeros[STRAT_CLASSES.get(str(code), 0)] = 1
         return zeros[1:]
 
     def _normalize(self, data):
@@ -98,3 +220,7 @@ class GeotopData(Data):
             return self.EMPTY
         return np.concatenate(
             [self._strat(data[0]), np.array(data[1:]) / 100.0])
+
+
+if __name__ == "__main__":
+    build_sidecar()
@@ -2,14 +2,15 @@ import os
 import re
 from abc import ABCMeta, abstractmethod, abstractproperty
 
-import gdal
 import numpy as np
-import osr
-import pandas as pd
 
 import groundwater_timenet.geo_utils
+from groundwater_timenet import metrics
 from groundwater_timenet import utils
 from groundwater_timenet.parse.base import TemporalData
+from groundwater_timenet.parse.cache import LRU
+
+pd = utils.lazy_import('pandas')
 
 logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
 
@@ -17,6 +18,12 @@ logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
 FILENAME_BASE = "knmi"
 RAIN_NAN_VALUE = 65535
 ET_NAN_VALUE = -9999.0
+RAIN_PROJECTION = (
+    '+proj=stere +lat_0=90 +lon_0=0 +lat_ts=60 +a=6378.14 +b=6356.75 '
+    '+x_0=0 y_0=0'
+)
+# Bytes of decoded tiles every KNMI source keeps in memory.
+TILE_CACHE_BYTES = 2 ** 29
 
 
 class WeatherStationData(TemporalData):
@@ -92,6 +99,10 @@ class WeatherStationData(TemporalData):
         i = groundwater_timenet.geo_utils.closest_point(x, y, self.geoms)
         return self.STATION_META[i]
 
+    @property
+    def source_paths(self):
+        return (os.path.join('var', 'data', 'knmi', self.root + '.h5'), )
+
     def _dataframe(self, metadata):
         station_code, meta = metadata
         filepath = os.path.join('var', 'data', 'knmi', self.root + '.h5')
@@ -112,29 +123,178 @@ class WeatherStationData(TemporalData):
 
 
 class KnmiData(TemporalData, metaclass=ABCMeta):
+    """
+    Reads KNMI grids from the tiles made by collect.knmi.reshape_rasters.
+
+    RD coordinates are snapped to a grid of `snap` meters and mapped to
+    (tile x, tile y, row, column) with a lookup table that is memoized and
+    persisted next to the tiles. Only coordinates that are not in the table
+    yet are projected.
+
+    The data of whole tiles is kept in an LRU of at most tile_cache_bytes,
+    so the wells of a tile are read from memory after the first one. Read
+    the wells tile by tile to read every tile once.
+    """
     z = None
 
-    def __init__(self, grid_size=50, *args, **kwargs):
+    def __init__(
+            self, grid_size=50, snap=1, tile_cache_bytes=TILE_CACHE_BYTES,
+            *args, **kwargs):
         super(KnmiData, self).__init__(*args, **kwargs)
         self.grid_size = grid_size
+        self.snap = snap
+        self._lookup = None
+        self._lookup_changed = False
+        self.tiles = LRU(
+            tile_cache_bytes,
+            weigh=lambda tile: tile[0].nbytes + tile[1].nbytes)
 
-    def _dataframe(self, x, y):
-        modulo_x = x % self.grid_size
-        rounded_x = x - modulo_x
-        modulo_y = y % self.grid_size
-        rounded_y = y - modulo_y
-        filepath = os.path.join(
-            'var', 'data', 'knmi', self.root, str(rounded_x),
-            str(rounded_y) + '.h5'
+    @abstractmethod
+    def transform_many(self, xs, ys):
+        """Grid pixel coordinates of arrays of RD x and y coordinates."""
+        return np.array([]), np.array([])
+
+    @property
+    def lookup_filepath(self):
+        return os.path.join(
+            'var', 'data', 'knmi', self.root,
+            'lookup_{}_{}.h5'.format(self.grid_size, self.snap)
         )
-        data, timestamps = utils.read_h5(
-            filepath=filepath,
-            dataset_name=("data", "timestamps"),
-            index=((modulo_y, modulo_x), ()),
+
+    @property
+    def source_paths(self):
+        return (os.path.join('var', 'data', 'knmi', self.root), )
+
+    def _is_source_file(self, filepath):
+        # the lookup tables grow with the wells, the tiles stay the same.
+        return not os.path.basename(filepath).startswith('lookup_')
+
+    def _read_lookup(self):
+        try:
+            coordinates, tiles = utils.read_h5(
+                filepath=self.lookup_filepath,
+                dataset_name=("coordinates", "tiles"),
+                many=True
+            )
+        except OSError:
+            coordinates, tiles = [], []
+        return {
+            tuple(c): tuple(t) for c, t in
+            zip(np.asarray(coordinates).tolist(), np.asarray(tiles).tolist())
+        }
+
+    @property
+    def lookup(self):
+        if self._lookup is None:
+            self._lookup = self._read_lookup()
+        return self._lookup
+
+    def _snap(self, xs, ys):
+        return (
+            np.round(np.asarray(xs, dtype=float) / self.snap).astype(
+                np.int64) * self.snap,
+            np.round(np.asarray(ys, dtype=float) / self.snap).astype(
+                np.int64) * self.snap
+        )
+
+    def _tiles(self, xs, ys):
+        """Tile x, tile y, row and column for arrays of snapped RD x and y."""
+        pixel_xs, pixel_ys = self.transform_many(xs, ys)
+        return np.column_stack([
+            pixel_xs - pixel_xs % self.grid_size,
+            pixel_ys - pixel_ys % self.grid_size,
+            pixel_ys % self.grid_size,
+            pixel_xs % self.grid_size
+        ])
+
+    def build_lookup(self, xs, ys):
+        """
+        Adds all coordinates that are missing from the lookup table at once
+        and persists the table.
+        """
+        lookup = self.lookup
+        coordinates = np.unique(np.column_stack(self._snap(xs, ys)), axis=0)
+        missing = np.array([
+            c for c in coordinates.tolist() if tuple(c) not in lookup
+        ], dtype=np.int64).reshape(-1, 2)
+        if len(missing):
+            tiles = self._tiles(missing[:, 0], missing[:, 1])
+            lookup.update(zip(
+                map(tuple, missing.tolist()), map(tuple, tiles.tolist())))
+            self._lookup_changed = True
+            logger.info("Added %d coordinates to %s", len(missing),
+                        self.lookup_filepath)
+        self.save_lookup()
+
+    def save_lookup(self):
+        """
+        Merges the lookup table with the table on disk, which other shards
+        of a combine may have added to since it was read, and replaces it.
+        """
+        if not self._lookup_changed:
+            return
+        for coordinate, tile in self._read_lookup().items():
+            self.lookup.setdefault(coordinate, tile)
+        coordinates = np.array(
+            list(self.lookup.keys()), dtype=np.int64).reshape(-1, 2)
+        tiles = np.array(
+            list(self.lookup.values()), dtype=np.int64).reshape(-1, 4)
+        tmp_filepath = utils.tmp_filepath(self.lookup_filepath)
+        utils.store_h5(
+            data=[coordinates, tiles],
+            dataset_name=["coordinates", "tiles"],
+            target_h5=tmp_filepath,
             many=True
         )
-        index = pd.DatetimeIndex(
-            pd.Timestamp(y, m, d) for y, m, d in timestamps)
+        os.replace(tmp_filepath, self.lookup_filepath)
+        self._lookup_changed = False
+
+    def tile(self, x, y):
+        key = tuple(int(c[0]) for c in self._snap([x], [y]))
+        try:
+            return self.lookup[key]
+        except KeyError:
+            tile = tuple(self._tiles([key[0]], [key[1]])[0].tolist())
+            self.lookup[key] = tile
+            self._lookup_changed = True
+            return tile
+
+    @staticmethod
+    def _index(timestamps):
+        return pd.DatetimeIndex(pd.to_datetime(pd.DataFrame(
+            np.asarray(timestamps).reshape(-1, 3),
+            columns=["year", "month", "day"]
+        )))
+
+    def _read_tile(self, tile_x, tile_y, row, column):
+        """
+        :return: the data and index of a tile, or only the data of the pixel
+            at row and column of a tile that doesn't fit in the cache.
+        """
+        key = (tile_x, tile_y)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            metrics.count("tile_cache_hits", source=type(self).__name__)
+            return tile
+        metrics.count("tile_cache_misses", source=type(self).__name__)
+        filepath = os.path.join(
+            'var', 'data', 'knmi', self.root, str(tile_x),
+            str(tile_y) + '.h5'
+        )
+        with utils.h5py.File(filepath, 'r', libver='latest') as h5_file:
+            dataset = h5_file["data"]
+            index = self._index(h5_file["timestamps"][()])
+            if dataset.size * dataset.dtype.itemsize > self.tiles.maxweight:
+                return dataset[row, column], index
+            tile = (dataset[()], index)
+        self.tiles.put(key, tile)
+        return tile
+
+    def _dataframe(self, x, y):
+        tile_x, tile_y, row, column = self.tile(x, y)
+        data, index = self._read_tile(tile_x, tile_y, row, column)
+        if data.ndim > 1:
+            data = data[row, column]
         return pd.DataFrame(self._nan_to_num(data), index=index)
 
     def _data(self, x, y, start=None, end=None, *args, **kwargs):
@@ -145,19 +305,19 @@ class RainData(KnmiData):
     root = 'rain'
     resample_method = 'sum'
     affine = (0.0, 1.0, 0, -3649.98, 0, -1.0)
+    projection = RAIN_PROJECTION
     nan = 65535
 
-    def __init__(self, *args, **kwargs):
-        super(RainData, self).__init__(*args, **kwargs)
-        rain_proj = osr.SpatialReference(osr.GetUserInputAsWKT(
-            '+proj=stere +lat_0=90 +lon_0=0 +lat_ts=60 +a=6378.14 +b=6356.75 '
-            '+x_0=0 y_0=0'))
-        rd_proj = osr.SpatialReference(osr.GetUserInputAsWKT('epsg:28992'))
-        self.coord_transform = osr.CoordinateTransformation(rd_proj, rain_proj)
-
-    def _transform(self, x, y):
-        return [round(f) for f in gdal.ApplyGeoTransform(
-            self.affine, *self.coord_transform.TransformPoint(x, y)[:2])]
+    def transform_many(self, xs, ys):
+        pixel_xs, pixel_ys = groundwater_timenet.geo_utils.apply_geo_transform(
+            self.affine,
+            *groundwater_timenet.geo_utils.transform_many(
+                xs, ys, 28992, self.projection)
+        )
+        return (
+            np.round(pixel_xs).astype(np.int64),
+            np.round(pixel_ys).astype(np.int64)
+        )
 
     def _normalize(self, data):
         return data / 100
@@ -169,8 +329,11 @@ class EvapoTranspirationData(KnmiData):
     resample_method = 'mean'
     nan = -9999
 
-    def _transform(self, x, y):
-        return int((y - 290500) / 1000), int((x - 500) / 1000)
+    def transform_many(self, xs, ys):
+        return (
+            ((np.asarray(ys) - 290500) / 1000).astype(np.int64),
+            ((np.asarray(xs) - 500) / 1000).astype(np.int64)
+        )
 
     def _normalize(self, data):
         return data / 100
@@ -0,0 +1,172 @@
+"""
+Geography-aware sharding of the wells over the nodes of a combine run.
+
+The wells are grouped in cells, either the 10 km cells of the sliding
+window of the DINO harvest or the tiles of a KNMI grid. The cells are put
+in Z-order and split in N runs with about the same number of wells, so
+every shard covers a compact region and touches few KNMI tiles and GeoTOP
+columns. Run the shards on separate machines and merge their output:
+
+    python -m groundwater_timenet.parse.combine --shard 0/4 train
+    ...
+    python -m groundwater_timenet.parse.combine --shard 3/4 train
+    python -m groundwater_timenet.parse.combine --merge 4 train
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from groundwater_timenet import utils
+
+
+logger = utils.setup_logging(__name__, utils.PARSE_LOG, "INFO")
+
+# Cell size of the sliding window of the DINO harvest.
+WINDOW_SIZE = 10000
+MANIFEST = "manifest.json"
+
+
+def parse_shard(text):
+    """:return: (i, n) of a shard given as "i/n", with 0 <= i < n."""
+    try:
+        i, n = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError("Shard {!r} is not of the form i/N".format(text))
+    if not 0 <= i < n:
+        raise ValueError("Shard {} is not in 0..{}".format(i, n - 1))
+    return i, n
+
+
+def directory_name(i, n):
+    return "shard-{}-of-{}".format(i, n)
+
+
+def window_cells(xs, ys, size=WINDOW_SIZE):
+    """:return: array with the (column, row) of the cell of every well."""
+    return np.column_stack([
+        np.floor_divide(np.asarray(xs, dtype=float), size),
+        np.floor_divide(np.asarray(ys, dtype=float), size)
+    ]).astype(np.int64)
+
+
+def tile_cells(knmi_data):
+    """:return: function that maps wells to the tiles of a KNMI grid."""
+    def cells(xs, ys):
+        knmi_data.build_lookup(xs, ys)
+        return np.array(
+            [knmi_data.tile(x, y)[:2] for x, y in zip(xs, ys)],
+            dtype=np.int64
+        ).reshape(-1, 2)
+    return cells
+
+
+def z_order(cells):
+    """:return: the Morton code of every (column, row) cell."""
+    cells = np.asarray(cells, dtype=np.int64)
+    cells = (cells - cells.min(axis=0)).astype(np.uint64)
+    codes = np.zeros(len(cells), dtype=np.uint64)
+    for bit in range(32):
+        for axis in range(2):
+            codes |= ((cells[:, axis] >> np.uint64(bit)) & np.uint64(1)) << \
+                np.uint64(2 * bit + axis)
+    return codes
+
+
+def cell_order(cells):
+    """:return: the indices that put the wells in Z-order of their cells."""
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 2)
+    if not len(cells):
+        return np.zeros(0, dtype=np.int64)
+    return np.argsort(z_order(cells), kind='stable')
+
+
+def assign(cells, shards):
+    """
+    Splits the cells in Z-order in `shards` runs with about the same number
+    of wells. A cell is never split over shards.
+
+    :param cells: array with the (column, row) cell of every well.
+    :return: array with the shard of every well.
+    """
+    cells = np.asarray(cells, dtype=np.int64).reshape(-1, 2)
+    if not len(cells):
+        return np.zeros(0, dtype=np.int64)
+    unique, inverse, counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True)
+    order = np.argsort(z_order(unique), kind='stable')
+    before = np.cumsum(counts[order]) - counts[order]
+    shard_of_cell = np.empty(len(unique), dtype=np.int64)
+    shard_of_cell[order] = np.minimum(
+        before * shards // len(cells), shards - 1)
+    return shard_of_cell[inverse.ravel()]
+
+
+def _link(source, target):
+    """Hard links source to target, or copies it on another filesystem."""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _merge_manifest(merged, manifest, prefix):
+    if "shards" in manifest and "version" in manifest:
+        # the manifest of the .npy shards of learn.shards
+        shards = [
+            dict(shard, **{
+                key: prefix + shard[key] for key in ("name", "input", "output")
+            }) for shard in manifest["shards"]
+        ]
+        if not merged:
+            merged.update(manifest, shards=[])
+        elif (merged["input_shape"], merged["output_shape"]) != (
+                manifest["input_shape"], manifest["output_shape"]):
+            raise ValueError("Shards with different shapes can't be merged.")
+        merged["shards"] += shards
+    else:
+        # the series hashes per file of the Combiner
+        merged.update(
+            {prefix + filename: hashes for filename, hashes in
+             manifest.items()})
+
+
+def merge(directory, shards):
+    """
+    Links the files of the `shards` shard directories under directory into
+    directory, prefixed with their shard, and merges their manifests. The
+    shard directories are kept, so a shard can be combined incrementally
+    and merged again.
+    """
+    missing = [
+        i for i in range(shards) if not os.path.isdir(
+            os.path.join(directory, directory_name(i, shards)))
+    ]
+    if missing:
+        raise FileNotFoundError("Shards {} of {} are missing in {}".format(
+            ", ".join(map(str, missing)), shards, directory))
+    for filename in os.listdir(directory):
+        if filename.split('-')[0].isdigit():
+            os.remove(os.path.join(directory, filename))
+    merged = {}
+    count = 0
+    for i in range(shards):
+        prefix = "{}-".format(i)
+        shard_directory = os.path.join(directory, directory_name(i, shards))
+        for filename in sorted(os.listdir(shard_directory)):
+            filepath = os.path.join(shard_directory, filename)
+            if filename == MANIFEST:
+                with open(filepath) as manifest_file:
+                    _merge_manifest(merged, json.load(manifest_file), prefix)
+            elif not filename.endswith('.tmp'):
+                _link(filepath, os.path.join(directory, prefix + filename))
+                count += 1
+    if merged:
+        filepath = os.path.join(directory, MANIFEST)
+        with open(filepath + '.tmp', 'w') as manifest_file:
+            json.dump(merged, manifest_file, indent=4)
+        os.replace(filepath + '.tmp', filepath)
+    logger.info("Merged %d files of %d shards in %s", count, shards,
+                directory)
+    return count
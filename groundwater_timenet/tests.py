@@ -1,10 +1,42 @@
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import types
 import unittest
 import random
+import zipfile
 
 import numpy as np
+import requests
 
+from . import benchmark
+from . import fixtures
+from . import geo_utils
+from . import http_utils
+from . import memory
+from . import metrics
+from . import utils
+from .collect import dino as collect_dino
+from .collect import geotop as collect_geotop
+from .collect import knmi as collect_knmi
+from .explore import distributions
+from .explore import shapes
 from .parse.combine import Combiner, UncompressedCombiner
-from .learn.generator import CompressedConvolutionalAtrousGenerator
+from .parse import cache
+from .parse import combine
+from .parse import dino
+from .parse import geotop
+from .parse import knmi
+from .parse import sharding
+from .learn import shards
+from .learn.generator import CompactCombinerGenerator
+from .learn.sequence import (
+    CompressedConvolutionalAtrousGenerator, ConvolutionalAtrousGenerator)
 
 # TODO: write more tests.
 
@@ -173,6 +205,1234 @@ class GeneratorTestCase(unittest.TestCase):
         print(expected_output.shape, output.shape)
         self.assertTrue((expected_output == output).all())
 
+    def test_compact_pack(self):
+        compact = CompactCombinerGenerator(
+            input_size=5,
+            output_size=1,
+            temporal_size=2,
+            meta_size=3,
+            batch_size=2,
+            chunk_size=4
+        )
+        for i in range(3):
+            self.gen.pack(self.base, self.meta + i, self.temporal)
+            compact.pack(self.base, self.meta + i, self.temporal)
+        self.assertEqual((3, 3), compact.meta_table.shape)
+        self.assertEqual((30, 5, 2), compact.input_data.shape)
+        expected = list(self.gen.unpack_batches(chunk_size=4))
+        unpacked = list(compact.unpack_batches(chunk_size=4))
+        self.assertEqual(len(expected), len(unpacked))
+        for (input, output), (temporal, c_output, meta_index, meta) in zip(
+                expected, unpacked):
+            for j in range(4):
+                assembled = compact.assemble(temporal[j], meta[meta_index[j]])
+                self.assertTrue((input[j] == assembled).all())
+                self.assertTrue((output[j] == c_output[j]).all())
+        remaining = compact.assemble(
+            compact.input_data, compact.meta_table[compact.meta_index])
+        self.assertTrue((self.gen.input_data == remaining).all())
+
+
+class DtypeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.RandomState(4177)
+        self.temporal = self.random.normal(size=(10, 5, 2))
+        self.base = self.random.normal(size=(10, 5, 1))
+        self.meta = self.random.normal(size=3)
+
+    def generator(self, dtype=None):
+        return CompressedConvolutionalAtrousGenerator(
+            input_size=5,
+            output_size=1,
+            temporal_size=2,
+            meta_size=3,
+            batch_size=2,
+            chunk_size=4,
+            dtype=dtype
+        )
+
+    def test_default_dtype(self):
+        gen = self.generator()
+        gen.pack(self.base, self.meta, self.temporal)
+        self.assertEqual(np.float32, gen.input_data.dtype)
+        self.assertEqual(np.float32, gen.output_data.dtype)
+
+    def test_parity(self):
+        single = self.generator(np.float32)
+        double = self.generator(np.float64)
+        for gen in (single, double):
+            gen.pack(self.base, self.meta, self.temporal)
+        self.assertEqual(np.float64, double.input_data.dtype)
+        self.assertTrue(np.allclose(
+            single.input_data, double.input_data, rtol=1e-6, atol=1e-6))
+        self.assertTrue(np.allclose(
+            single.output_data, double.output_data, rtol=1e-6, atol=1e-6))
+
+    def test_store_h5(self):
+        timestamps = np.arange(10, dtype='int64')
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'dtype.h5')
+            utils.store_h5(
+                data=[self.temporal, timestamps],
+                dataset_name=['data', 'timestamps'],
+                target_h5=filepath,
+                many=True,
+                dtype=utils.DTYPE
+            )
+            data, stored_timestamps = utils.read_h5(
+                filepath, ('data', 'timestamps'), many=True)
+        self.assertEqual(np.float32, data.dtype)
+        self.assertEqual(np.int64, stored_timestamps.dtype)
+        self.assertTrue(np.allclose(self.temporal, data, rtol=1e-6))
+
+    def test_set_dtype(self):
+        try:
+            utils.set_dtype('float64')
+            self.assertEqual(np.float64, self.generator().dtype)
+            self.assertRaises(ValueError, utils.set_dtype, 'int32')
+        finally:
+            utils.set_dtype('float32')
+
+
+class GeotopSidecarTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        filepath = os.path.join(utils.DATA, 'geotop', 'geotop.nc')
+        utils.mkdirs(filepath)
+        rootgrp = geotop.netCDF4.Dataset(filepath, 'w')
+        for name, size in (('x', 6), ('y', 5), ('z', 20)):
+            rootgrp.createDimension(name, size)
+        rootgrp.createVariable('x', 'f8', ('x', ))[:] = (
+            13600 + 100 * np.arange(6))
+        rootgrp.createVariable('y', 'f8', ('y', ))[:] = (
+            358000 + 100 * np.arange(5))
+        values = np.random.RandomState(4177).randint(0, 100, (6, 5, 20))
+        for name in geotop.RELEVANT_VARIABLES:
+            # a strat variable without a _FillValue attribute
+            variable = rootgrp.createVariable(
+                name, 'i2', ('x', 'y', 'z'),
+                fill_value=-127 if name != 'strat' else None)
+            variable[:] = values if name != 'strat' else 1000
+        rootgrp['kans_1'][1, 1, 2] = np.ma.masked
+        rootgrp['strat'][1, 1, 3] = np.ma.masked
+        rootgrp.close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_sidecar(self):
+        wells = ((13750, 358150, -49.0), (14000, 358300, -45.0))
+        geotop.build_sidecar(coordinates=[w[:2] for w in wells])
+        self.assertEqual(
+            (2, 20), utils.read_h5(
+                os.path.join(utils.DATA, 'geotop', geotop.SIDECAR_FILENAME),
+                'kans_1').shape
+        )
+        sidecar = geotop.GeotopData()
+        netcdf = geotop.GeotopData(sidecar=None)
+        for x, y, z in wells:
+            self.assertTrue(
+                (netcdf.data(x, y, z) == sidecar.data(x, y, z)).all())
+        self.assertIsNone(sidecar._rootgrp)
+        self.assertTrue((
+            netcdf.data(14100, 358400, -45.0) ==
+            sidecar.data(14100, 358400, -45.0)).all())
+
+    def test_masked(self):
+        geotop.build_sidecar(coordinates=[(13750, 358150)])
+        kans_1 = geotop.RELEVANT_VARIABLES.index('kans_1')
+        for data in geotop.GeotopData(), geotop.GeotopData(sidecar=None):
+            column = data._data(13750, 358150, -49.0)
+            self.assertTrue(np.isnan(column[kans_1]))
+            strat = data._data(13750, 358150, -48.5)[0]
+            self.assertEqual(geotop.STRAT_MISSING, strat)
+            self.assertEqual(0, data._strat(strat).sum())
+            self.assertEqual(0, data.data(13750, 358150, -49.0)[55])
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    @staticmethod
+    def unique_counts(datasets):
+        """The counts of Counts before the histograms, with np.unique."""
+        unique_counts = {}
+        for dataset in datasets:
+            values, counts = np.unique(dataset, return_counts=True)
+            for value, count in zip(values, counts):
+                unique_counts[str(value)] = unique_counts.get(
+                    str(value), 0) + count
+        return unique_counts
+
+    def test_negative(self):
+        histogram = distributions.Histogram.of([-3, -1, -3])
+        self.assertEqual(-3, histogram.offset)
+        self.assertEqual([2, 0, 1], histogram.counts.tolist())
+        self.assertEqual({'-3': 2, '-1': 1}, histogram.to_dict())
+
+    def test_masked(self):
+        histogram = distributions.Histogram.of(
+            np.ma.masked_array([1, 2], mask=[True, True]))
+        self.assertEqual(0, histogram.counts.size)
+        self.assertEqual({'--': 2}, histogram.to_dict())
+
+    def test_add(self):
+        empty = distributions.Histogram()
+        histogram = distributions.Histogram.of([4, 5, 5])
+        for total in (empty + histogram, histogram + empty):
+            self.assertEqual({'4': 1, '5': 2}, total.to_dict())
+        total = distributions.Histogram.of([0, 1]) + histogram
+        self.assertEqual(0, total.offset)
+        self.assertEqual([1, 1, 0, 0, 1, 2], total.counts.tolist())
+        self.assertEqual(
+            total.to_dict(), (histogram + distributions.Histogram.of(
+                [0, 1])).to_dict())
+
+    def test_unique_counts(self):
+        random_state = np.random.RandomState(4177)
+        datasets = [
+            np.ma.masked_array(
+                random_state.randint(low, low + 20, (10, 10)),
+                mask=random_state.rand(10, 10) < 0.2)
+            for low in (-30, -5, 100)
+        ]
+        histogram = sum(
+            (distributions.Histogram.of(dataset) for dataset in datasets),
+            distributions.Histogram()
+        )
+        self.assertEqual(
+            self.unique_counts(datasets), histogram.to_dict())
+        self.assertEqual(
+            histogram.to_dict(), distributions.Histogram.from_json(
+                json.loads(json.dumps(histogram.to_json()))).to_dict())
+
+
+class StandInCounts(distributions.Counts):
+    """
+    Counts slab n as n values n. A slab fails while a file fail-n exists,
+    and every slab read leaves a file read-n.
+    """
+    json_filename = "stand_in.json"
+    dataset_names = ("values", )
+    workers = 2
+    version = ""
+
+    def dataset_generator(self, key):
+        return []
+
+    def slabs(self, key):
+        return [1, 2, 3]
+
+    def slab_version(self, key, slab):
+        return repr(slab) + self.version
+
+    @classmethod
+    def read_slab(cls, key, slab):
+        if os.path.exists("fail-{}".format(slab)):
+            raise IOError("Can't read slab {}".format(slab))
+        open("read-{}".format(slab), "w").close()
+        return np.full(slab, slab)
+
+
+class CountsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        StandInCounts.version = ""
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def read(self):
+        """:return: the slabs read since the last call."""
+        read = sorted(
+            int(filename[5:]) for filename in os.listdir('.')
+            if filename.startswith('read-'))
+        for slab in read:
+            os.remove("read-{}".format(slab))
+        return read
+
+    def fail(self, counts, slab):
+        open("fail-{}".format(slab), "w").close()
+        self.assertRaises(IOError, counts.count)
+        os.remove("fail-{}".format(slab))
+
+    def test_resume(self):
+        counts = StandInCounts(use_cache=False)
+        self.fail(counts, 2)
+        self.assertEqual([1, 3], self.read())
+        self.assertTrue(os.path.exists(counts.checkpoint_filepath))
+        counts.count()
+        self.assertEqual([2], self.read())
+        self.assertEqual({'1': 1, '2': 2, '3': 3}, counts['values'])
+        self.assertFalse(os.path.exists(counts.checkpoint_filepath))
+
+    def test_changed_slabs(self):
+        counts = StandInCounts(use_cache=False)
+        self.fail(counts, 2)
+        self.read()
+        StandInCounts.version = "changed"
+        counts.count()
+        self.assertEqual([1, 2, 3], self.read())
+        self.assertEqual({'1': 1, '2': 2, '3': 3}, counts['values'])
+
+
+class TransformTestCase(unittest.TestCase):
+
+    def test_transform_many(self):
+        lons = np.array([[3.4, 4.9], [5.2, 7.1]])
+        lats = np.array([[51.3, 52.1], [52.4, 53.4]])
+        xs, ys = geo_utils.transform_many(lons, lats)
+        self.assertEqual(lons.shape, xs.shape)
+        for lon, lat, x, y in zip(
+                lons.ravel(), lats.ravel(), xs.ravel(), ys.ravel()):
+            p = geo_utils.point(lon, lat)
+            geo_utils.transform(p)
+            self.assertAlmostEqual(p.GetX(), x)
+            self.assertAlmostEqual(p.GetY(), y)
+        self.assertIs(
+            geo_utils.coordinate_transformation(4326, 28992),
+            geo_utils.coordinate_transformation(4326, 28992)
+        )
+
+
+class KnmiLookupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_lookup(self):
+        xs = np.array([120000, 155000, 155000, 230499])
+        ys = np.array([480000, 463000, 463000, 560000])
+        et = knmi.EvapoTranspirationData()
+        et.build_lookup(xs, ys)
+        self.assertEqual(3, len(et.lookup))
+        self.assertTrue(os.path.exists(et.lookup_filepath))
+        row, column = int((463000 - 290500) / 1000), int((155000 - 500) / 1000)
+        expected = (
+            row - row % 50, column - column % 50, column % 50, row % 50)
+        self.assertEqual(expected, et.tile(155000, 463000))
+        persisted = knmi.EvapoTranspirationData()
+        persisted.transform_many = None  # no projections for known wells
+        for x, y in zip(xs, ys):
+            self.assertEqual(et.tile(x, y), persisted.tile(x, y))
+
+    def test_shards(self):
+        # two shards that read the lookup table before either saved it
+        first, second = knmi.EvapoTranspirationData(), \
+            knmi.EvapoTranspirationData()
+        self.assertEqual({}, first.lookup)
+        self.assertEqual({}, second.lookup)
+        first.build_lookup(np.array([120000]), np.array([480000]))
+        second.build_lookup(np.array([155000]), np.array([463000]))
+        merged = knmi.EvapoTranspirationData()
+        self.assertEqual(2, len(merged.lookup))
+        self.assertEqual(
+            [os.path.basename(merged.lookup_filepath)],
+            os.listdir(os.path.dirname(merged.lookup_filepath)))
+        snapped = knmi.EvapoTranspirationData(snap=1000)
+        self.assertEqual(
+            snapped.tile(155000, 463000), snapped.tile(155400, 462600))
+
+    def test_tile_cache(self):
+        et = knmi.EvapoTranspirationData()
+        tile_x, tile_y, _, _ = et.tile(155000, 463000)
+        data = np.arange(50 * 50 * 3, dtype='float32').reshape(50, 50, 3)
+        timestamps = np.array([[2000, 1, 1], [2000, 1, 2], [2000, 1, 3]])
+        filepath = os.path.join(
+            'var', 'data', 'knmi', et.root, str(tile_x), str(tile_y) + '.h5')
+        utils.store_h5(
+            data=[data, timestamps], dataset_name=["data", "timestamps"],
+            target_h5=filepath, many=True)
+        for x, y in ((155000, 463000), (156000, 464000)):
+            _, _, row, column = et.tile(x, y)
+            dataframe = et._dataframe(x, y)
+            self.assertEqual(data[row, column].tolist(),
+                             dataframe[0].tolist())
+        self.assertEqual(1, len(et.tiles))
+        self.assertEqual("2000-01-03", str(dataframe.index[-1].date()))
+        os.remove(filepath)  # served from memory
+        et._dataframe(156000, 463000)
+        small = knmi.EvapoTranspirationData(tile_cache_bytes=1000)
+        utils.store_h5(
+            data=[data, timestamps], dataset_name=["data", "timestamps"],
+            target_h5=filepath, many=True)
+        self.assertEqual(3, len(small._dataframe(155000, 463000)))
+        self.assertEqual(0, len(small.tiles))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_compare(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filepaths = []
+            for name, median, peak in (
+                    ('old', 1.0, 100), ('new', 1.05, 200)):
+                filepath = os.path.join(directory, name + '.json')
+                with open(filepath, 'w') as results_file:
+                    json.dump({'results': {'Suite.time_': {
+                        'median': median, 'peak_memory': peak}}},
+                        results_file)
+                filepaths.append(filepath)
+            self.assertEqual(
+                [('Suite.time_', 'peak_memory', 100, 200)],
+                benchmark.compare(*filepaths)
+            )
+
+    def test_combine_imports_no_heavy_modules(self):
+        self.assertEqual(
+            [], benchmark.heavy_imports("groundwater_timenet.parse.combine"))
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = CompactCombinerGenerator(
+            input_size=5, output_size=1, temporal_size=2, meta_size=3,
+            batch_size=2, chunk_size=4, directory=tempfile.gettempdir())
+        self.arguments = (
+            np.zeros((10, 5, 1)), np.arange(3.0), np.ones((10, 5, 2)))
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.REGISTRY.reset()
+
+    def test_disabled(self):
+        self.generator.pack(*self.arguments)
+        metrics.count("series")
+        self.assertEqual({}, metrics.REGISTRY.histograms)
+        self.assertEqual({}, dict(metrics.REGISTRY.counters))
+
+    def test_export(self):
+        metrics.enable()
+        for _ in range(3):
+            self.generator.pack(*self.arguments)
+        metrics.count("series", value=3)
+        histogram = metrics.REGISTRY.histograms[
+            ("pack", "CompactCombinerGenerator")]
+        self.assertEqual(3, histogram.count)
+        self.assertEqual(
+            3, histogram.to_dict()['buckets']['+Inf'])
+        prometheus = metrics.REGISTRY.to_prometheus()
+        self.assertIn(
+            'groundwater_timenet_stage_seconds_count{'
+            'source="CompactCombinerGenerator",stage="pack"} 3', prometheus)
+        self.assertIn("groundwater_timenet_series_total{} 3", prometheus)
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'metrics.json')
+            metrics.export(filepath)
+            with open(filepath) as metrics_file:
+                exported = json.load(metrics_file)
+        self.assertEqual(
+            [{'name': 'series', 'source': None, 'value': 3}],
+            exported['counters'])
+
+
+class MemoryProfilerTestCase(unittest.TestCase):
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'memory.json')
+            profiler = memory.MemoryProfiler(filepath, every=2).start()
+            kept = []
+            for step in memory.profiled(profiler, "base", range(5)):
+                profiler.sample(step, rows=len(kept))
+                with profiler.stage("grow"):
+                    kept.append(np.ones(2 ** 17))
+            report = profiler.stop()
+            with open(filepath) as report_file:
+                self.assertEqual(report, json.load(report_file))
+        self.assertEqual([0, 2, 4], [s['step'] for s in report['timeline']])
+        self.assertEqual(4, report['timeline'][-1]['rows'])
+        self.assertEqual(5, report['stages']['grow']['calls'])
+        self.assertEqual(6, report['stages']['base']['calls'])
+        self.assertGreaterEqual(
+            report['stages']['grow']['retained'], 5 * 2 ** 20)
+
+
+class FeatureCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        lru = cache.LRU(10, weigh=len)
+        lru.put('a', 'x' * 4)
+        lru.put('b', 'x' * 4)
+        lru.get('a')
+        lru.put('c', 'x' * 4)
+        self.assertNotIn('b', lru)
+        self.assertEqual(8, lru.weight)
+        lru.put('d', 'x' * 11)
+        self.assertEqual(2, len(lru))
+
+    def test_cache(self):
+        calls = []
+
+        def compute(x, y, z):
+            calls.append((x, y, z))
+            return np.array([x, y, z])
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'features.db')
+            features = cache.FeatureCache(filepath, "1", dtype='float64')
+            for _ in range(3):
+                vector = features.get(10, 20, -5, compute)
+            features.get(10, 20, -7, compute)
+            features.close()
+            self.assertEqual([10, 20, -5], vector.tolist())
+            self.assertEqual(
+                {'memory': 2, 'disk': 0, 'misses': 2}, features.stats)
+            self.assertEqual(0.5, features.hit_rate())
+            again = cache.FeatureCache(filepath, "1", dtype='float64')
+            self.assertEqual(
+                [10, 20, -7], again.get(10, 20, -7, compute).tolist())
+            self.assertEqual(1, again.stats['disk'])
+            again.close()
+            cache.FeatureCache(filepath, "2", dtype='float64').get(
+                10, 20, -7, compute)
+        self.assertEqual(3, len(calls))
+
+    def test_missing_z(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'features.db')
+            for _ in range(2):
+                features = cache.FeatureCache(filepath, "1", dtype='float64')
+                for _ in range(2):
+                    features.get(10, 20, np.nan, lambda x, y, z: np.ones(2))
+                features.close()
+            self.assertEqual(
+                {'memory': 1, 'disk': 1, 'misses': 0}, features.stats)
+            self.assertEqual(1, features.connection.execute(
+                "SELECT COUNT(*) FROM features").fetchone()[0])
+            features.close()
+
+
+class ShardsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        random = np.random.RandomState(4177)
+        self.inputs = [random.rand(3, 4, 5, 2), random.rand(2, 4, 5, 2)]
+        self.outputs = [random.rand(3, 4, 1, 5), random.rand(2, 4, 1, 5)]
+        writer = shards.ShardWriter(self.directory.name, dtype='float64')
+        for name, inputs, outputs in zip(
+                ("2", "10"), self.inputs, self.outputs):
+            writer.write(name, inputs, outputs)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_batches(self):
+        batches = shards.Shards(self.directory.name)
+        self.assertEqual(5, len(batches))
+        inputs, outputs = batches.batch(3)
+        self.assertIsInstance(inputs, np.memmap)
+        self.assertTrue((self.inputs[1][0] == inputs).all())
+        self.assertTrue((self.outputs[1][0] == outputs).all())
+        self.assertRaises(IndexError, batches.batch, 5)
+
+    def test_shapes(self):
+        writer = shards.ShardWriter(self.directory.name)
+        writer.write("1", self.inputs[0], self.outputs[0])
+        self.assertRaises(
+            ValueError, writer.write, "2", self.inputs[0][:, :2],
+            self.outputs[0][:, :2])
+
+    def test_generator(self):
+        generator = ConvolutionalAtrousGenerator(
+            directory=self.directory.name)
+        self.assertEqual(5, len(generator))
+        self.assertTrue((self.inputs[0][2] == generator[2][0]).all())
+
+
+class ShapesTestCase(unittest.TestCase):
+
+    def test_make_shape(self):
+        xs = np.arange(5, dtype=float) * 1000 + 100000.5
+        ys = np.arange(5, dtype=float) * 2000 + 400000.25
+        for driver_name, extension in shapes.SHAPE_DRIVERS.items():
+            with self.subTest(driver_name=driver_name), \
+                    tempfile.TemporaryDirectory() as directory:
+                filepath = os.path.join(directory, 'points')
+                shapes.make_shape(
+                    filepath, [("row", shapes.ogr.OFTInteger)],
+                    zip(geo_utils.points(xs, ys), ((i, ) for i in range(5))),
+                    shapes.ogr.wkbPoint, "points", driver_name=driver_name,
+                    batch_size=2
+                )
+                data_source = shapes.ogr.Open(filepath + extension)
+                layer = data_source.GetLayerByName("points")
+                self.assertEqual(5, layer.GetFeatureCount())
+                self.assertEqual(
+                    [(i, xs[i], ys[i]) for i in range(5)],
+                    [(feature.GetField("row"),
+                      feature.GetGeometryRef().GetX(),
+                      feature.GetGeometryRef().GetY()) for feature in layer]
+                )
+                data_source = None
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(4177)
+        self.xs = random.randint(0, 280000, 500)
+        self.ys = random.randint(300000, 620000, 500)
+
+    def test_assign(self):
+        cells = sharding.window_cells(self.xs, self.ys)
+        assigned = sharding.assign(cells, 4)
+        self.assertTrue((assigned == sharding.assign(cells, 4)).all())
+        counts = np.bincount(assigned, minlength=4)
+        self.assertEqual(4, len(counts))
+        self.assertLess(counts.max() - counts.min(), 50)
+        # a cell is never split over shards.
+        for cell in np.unique(cells, axis=0):
+            in_cell = (cells == cell).all(axis=1)
+            self.assertEqual(1, len(set(assigned[in_cell])))
+
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for i, inputs in enumerate((np.ones((2, 4, 3)), np.zeros(
+                    (1, 4, 3)))):
+                shards.ShardWriter(
+                    os.path.join(directory, sharding.directory_name(i, 2)),
+                    dtype='float64'
+                ).write("1", inputs, inputs[:, :, :1])
+            self.assertEqual(4, sharding.merge(directory, 2))
+            batches = shards.Shards(directory)
+            self.assertEqual(3, len(batches))
+            self.assertTrue((batches.batch(2)[0] == 0).all())
+            self.assertRaises(FileNotFoundError, sharding.merge, directory, 3)
+
+    def test_parse_shard(self):
+        self.assertEqual((2, 4), sharding.parse_shard("2/4"))
+        self.assertRaises(ValueError, sharding.parse_shard, "4/4")
+        self.assertRaises(ValueError, sharding.parse_shard, "2")
+
+
+class LoggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.directory.name, 'log', 'test.log')
+        self.logger = utils.setup_logging(
+            'groundwater_timenet.tests.logging', self.filepath, "INFO")
+
+    def tearDown(self):
+        utils.stop_logging()
+        self.directory.cleanup()
+
+    def lines(self):
+        utils.stop_logging()
+        with open(self.filepath) as log_file:
+            return [line.split(' - ')[-1].strip() for line in log_file]
+
+    def test_no_duplicate_handlers(self):
+        logger = utils.setup_logging(
+            'groundwater_timenet.tests.logging', self.filepath, "INFO")
+        self.assertEqual(1, len(logger.handlers))
+        logger.info("once %d", 1)
+        logger.debug("below the level")
+        self.assertEqual(["once 1"], self.lines())
+
+    def test_restart(self):
+        self.logger.info("first")
+        utils.stop_logging()
+        utils.stop_logging()
+        self.logger.info("second")
+        self.assertIsNotNone(utils._listener)
+        self.assertEqual(["first", "second"], self.lines())
+        self.assertIsNone(utils._listener)
+
+    def test_progress(self):
+        progress = utils.Progress(self.logger, interval=None, every=2)
+        logged = [
+            progress.log(step, "step %d", step, total=5) for step in range(5)]
+        self.assertEqual([True, False, True, False, True], logged)
+        self.assertEqual(
+            ["step 0  |  ETA: 0:00", "step 2  |  ETA: 0:00",
+             "step 4  |  ETA: 0:00"],
+            self.lines())
+
+    def test_worker_logging(self):
+        with utils.worker_logging() as logging_kwargs, ProcessPoolExecutor(
+                max_workers=2, **logging_kwargs) as executor:
+            list(executor.map(
+                log_in_worker, [self.filepath] * 3, range(3)))
+        self.assertEqual(
+            ["worker 0", "worker 1", "worker 2"], sorted(self.lines()))
+
+
+class FixturesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_dino(self):
+        locations = fixtures.well_locations(4)
+        fixtures.write_dino(locations, fixtures.days(3))
+        metadata = dino.list_metadata()
+        self.assertEqual(
+            sorted(locations[:, 0].astype(int)), sorted(metadata.x))
+        self.assertTrue((metadata.median_step == fixtures.DINO_STEP).all())
+        self.assertTrue((metadata.days > 365 * 2).all())
+        self.assertEqual(
+            np.datetime64(fixtures.END), metadata.end.max().to_datetime64())
+
+    def test_incremental_combine(self):
+        fixtures.write_fixtures(wells=8, years=3)
+        metrics.enable()
+        try:
+            Combiner(chunk_size=2).combine('train', incremental=True)
+            combined = metrics.REGISTRY.counters[('combined_series', None)]
+            metrics.REGISTRY.reset()
+            Combiner(chunk_size=2).combine('train', incremental=True)
+            counters = dict(metrics.REGISTRY.counters)
+        finally:
+            metrics.disable()
+            metrics.REGISTRY.reset()
+        self.assertGreater(combined, 0)
+        self.assertNotIn(('combined_series', None), counters)
+        self.assertEqual(
+            combined // 2, counters[('skipped_shards', None)])
+
+    def test_incremental_combine_changed_series(self):
+        fixtures.write_fixtures(wells=8, years=3)
+        metrics.enable()
+        try:
+            Combiner(chunk_size=2).combine('train', incremental=True)
+            combined = metrics.REGISTRY.counters[('combined_series', None)]
+            metrics.REGISTRY.reset()
+            row = dino.list_metadata(shuffled=True).iloc[0]
+            with utils.h5py.File(row.filepath, 'a') as h5_file:
+                h5_file[row.wellcode + row.filtercode][:, 1] += 1.0
+            Combiner(chunk_size=2).combine('train', incremental=True)
+            counters = dict(metrics.REGISTRY.counters)
+        finally:
+            metrics.disable()
+            metrics.REGISTRY.reset()
+        self.assertEqual(1, counters[('combined_series', None)])
+        self.assertEqual(1, counters[('reused_series', None)])
+        self.assertEqual(
+            combined // 2 - 1, counters[('skipped_shards', None)])
+
+    def test_incremental_main(self):
+        fixtures.write_fixtures(wells=8, years=3)
+        try:
+            combine.main([
+                '--incremental', '--metrics', 'metrics.json',
+                '--profile-memory', 'memory.json', '--profile-every', '1',
+                'train'])
+        finally:
+            metrics.disable()
+            metrics.REGISTRY.reset()
+        with open('metrics.json') as metrics_file:
+            counters = {
+                counter['name']: counter['value']
+                for counter in json.load(metrics_file)['counters']}
+        self.assertGreater(counters['combined_series'], 0)
+        with open('memory.json') as memory_file:
+            report = json.load(memory_file)
+        self.assertTrue(report['timeline'])
+        self.assertIn('temporal', report['stages'])
+
+
+class StandInServer(HTTPServer):
+    """Local stand-in for remote HTTP servers, serves `files` by path."""
+
+    def __init__(self, files, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.files = files
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(hash(content))
+        if self.headers.get('If-None-Match') == etag:
+            self.server.requests.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.requests.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class UnavailableHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.send_error(503)
+
+
+class KnmiDownloadTestCase(unittest.TestCase):
+
+    @staticmethod
+    def station_zip(code):
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as zf:
+            zf.writestr(
+                'etmgeg_{}.txt'.format(code),
+                collect_knmi.HEADER + '{}, 20170101, 1\n'.format(code))
+        return content.getvalue()
+
+    def test_conditional_download(self):
+        codes = ('210', '215', '235')
+        files = {
+            '/etmgeg_{}.zip'.format(code): self.station_zip(code)
+            for code in codes
+        }
+        with StandInServer(files, ETagHandler) as server, \
+                tempfile.TemporaryDirectory() as directory:
+            kwargs = dict(
+                target_dir=directory,
+                workers=2,
+                station_codes=codes,
+                station_url=server.url + '/etmgeg_{code}.zip'
+            )
+            collect_knmi.load_knmi_measurement_data(**kwargs)
+            for code in codes:
+                self.assertTrue(os.path.exists(
+                    os.path.join(directory, 'etmgeg_{}.txt'.format(code))))
+            collect_knmi.load_knmi_measurement_data(**kwargs)
+        self.assertEqual(3, sum(1 for _, s in server.requests if s == 200))
+        self.assertEqual(3, sum(1 for _, s in server.requests if s == 304))
+
+
+    def test_retries(self):
+        with StandInServer({}, UnavailableHandler) as server, \
+                tempfile.TemporaryDirectory() as directory:
+            self.assertRaises(
+                Exception, collect_knmi.load_knmi_measurement_data,
+                target_dir=directory, station_codes=('210', ),
+                station_url=server.url + '/etmgeg_{code}.zip', attempts=2)
+        self.assertEqual(['/etmgeg_210.zip'] * 2, server.requests)
+
+
+class KnmiStationParseTestCase(unittest.TestCase):
+
+    lines = (
+        '  210,19510101,  200,   41,   41,   72,   23,   21,    3,  '
+        '128,   23,  -16,  -33,    1,  -11,   11,     ,     ,     ,     ,'
+        '     ,     ,   -1,   -1,    6,     ,     ,     ,     ,     ,    3,'
+        '    1,   41,   18,    6,   94,   99,    4,   86,   14,     \n',
+        '  210,19510102,  220,   46,   51,   82,    4,   31,   22,  '
+        '154,    3,   -2,  -22,   22,   10,    5,     ,     ,     ,     ,'
+        '     ,     ,   12,    6,    7,     ,     ,     ,     ,     ,   36,'
+        '   21,   50,   15,    8,   89,   98,    9,   77,   17,    3\n',
+    )
+
+    def test_parse_etmgeg(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'etmgeg_210.txt')
+            with open(path, 'w') as f:
+                f.write('BRON: KONINKLIJK NEDERLANDS METEOROLOGISCH INSTITUUT'
+                        '\n\n' + collect_knmi.HEADER + '\n')
+                f.writelines(self.lines)
+            values, mask = collect_knmi.parse_etmgeg(path)
+        expected = np.array([
+            [utils.int_or_nan(v) for v in line.split(',')]
+            for line in self.lines
+        ])
+        self.assertEqual(np.int32, values.dtype)
+        self.assertEqual(expected.shape, values.shape)
+        self.assertTrue((np.isnan(expected) == mask).all())
+        self.assertTrue((expected[~mask] == values[~mask]).all())
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves byte ranges, ranges starting in server.failing fail."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        content = self.server.files[self.path]
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"{}"'.format(hash(content)))
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+    def do_GET(self):
+        content = self.server.files[self.path]
+        start, end = (
+            int(b) for b in
+            self.headers['Range'].replace('bytes=', '').split('-'))
+        self.server.requests.append(start)
+        if start in getattr(self.server, 'failing', ()):
+            self.send_error(500)
+            return
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+            start, end, len(content)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(content[start:end + 1])
+
+
+class IgnoringRangeHandler(RangeHandler):
+    """Serves the whole file, also for range requests."""
+
+    def do_GET(self):
+        content = self.server.files[self.path]
+        self.server.requests.append(self.headers['Range'])
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class GeotopDownloadTestCase(unittest.TestCase):
+
+    content = bytes(random.Random(4177).getrandbits(8) for _ in range(10000))
+
+    def download(self, server, filepath, **kwargs):
+        collect_geotop.download_large_file(
+            server.url + '/geotop.nc', filepath, workers=3,
+            segment_size=1000, http_session=http_utils.session(retries=0),
+            attempts=1, **kwargs)
+
+    def test_resume(self):
+        with StandInServer({'/geotop.nc': self.content}, RangeHandler) as \
+                server, tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'geotop.nc')
+            server.failing = (3000, 7000)
+            self.assertRaises(Exception, self.download, server, filepath)
+            self.assertFalse(os.path.exists(filepath))
+            self.assertTrue(os.path.exists(filepath + '.journal'))
+            server.failing = ()
+            server.requests = []
+            self.download(server, filepath, checksum=(
+                'sha256', hashlib.sha256(self.content).hexdigest()))
+            self.assertEqual([3000, 7000], sorted(server.requests))
+            with open(filepath, 'rb') as f:
+                self.assertEqual(self.content, f.read())
+            self.assertFalse(os.path.exists(filepath + '.journal'))
+
+    def test_ranges_ignored(self):
+        with StandInServer({'/geotop.nc': self.content},
+                           IgnoringRangeHandler) as server, \
+                tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'geotop.nc')
+            self.download(server, filepath, checksum=(
+                'sha256', hashlib.sha256(self.content).hexdigest()))
+            self.assertEqual(['bytes=0-999', None], server.requests)
+            with open(filepath, 'rb') as f:
+                self.assertEqual(self.content, f.read())
+            self.assertFalse(os.path.exists(filepath + '.journal'))
+
+    def test_checksum(self):
+        with StandInServer({'/geotop.nc': self.content}, RangeHandler) as \
+                server, tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'geotop.nc')
+            self.assertRaises(
+                IOError, self.download, server, filepath,
+                checksum=('sha256', '0' * 64))
+            self.assertFalse(os.path.exists(filepath))
+
+
+def log_in_worker(filepath, i):
+    utils.setup_logging(
+        'groundwater_timenet.tests.logging', filepath, "INFO"
+    ).info("worker %d", i)
+
+
+def dino_gml(wells):
+    """GML like the response of the BRO groundwater WFS for wells."""
+    members = ''.join(
+        '<wfs:member><gdn:Grondwateronderzoek gml:id="g.{i}">'
+        '<gdn:dino_nr>{well}</gdn:dino_nr>'
+        '<gdn:x_rd_crd>{x}</gdn:x_rd_crd>'
+        '<gdn:y_rd_crd>{y}</gdn:y_rd_crd>'
+        '<gdn:top_depth_mv>1.5</gdn:top_depth_mv>'
+        '<gdn:top_depth_mv>2.5</gdn:top_depth_mv>'
+        '<gdn:Grondwaterstand>'
+        '<gdn:start_date>1990-01-01</gdn:start_date>'
+        '<gdn:end_date>2000-01-01</gdn:end_date>'
+        '</gdn:Grondwaterstand>'
+        '</gdn:Grondwateronderzoek></wfs:member>'.format(
+            i=i, well=well, x=x, y=y)
+        for i, (well, x, y) in enumerate(wells)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<wfs:FeatureCollection '
+        'xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+        'xmlns:gml="http://www.opengis.net/gml/3.2" '
+        'xmlns:gdn="http://www.broinspireservices.nl/gdn">'
+        '{}</wfs:FeatureCollection>'.format(members)
+    ).encode('utf8')
+
+
+class StandInResponse(object):
+    """Like the ResponseWrapper of OWSLib, its read takes no size."""
+
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+class StandInWFS(object):
+    """Local stand-in for the BRO groundwater WFS."""
+
+    def __init__(self, wells):
+        self.wells = wells
+
+    def gml(self, bbox):
+        minx, miny, maxx, maxy = bbox
+        return dino_gml(
+            (well, x, y) for well, x, y in self.wells
+            if minx <= x < maxx and miny <= y < maxy
+        )
+
+    def getfeature(self, typename, bbox):
+        return StandInResponse(self.gml(bbox))
+
+
+class FlakyWFS(StandInWFS):
+    """
+    Stand-in WFS that fails the first request of a cell and truncates the
+    GML of the second.
+    """
+
+    def __init__(self, wells, requests):
+        super().__init__(wells)
+        self.requests = requests
+
+    def getfeature(self, typename, bbox):
+        self.requests.append(bbox)
+        if self.requests.count(bbox) == 1:
+            raise requests.ConnectionError("Service unavailable")
+        gml = self.gml(bbox)
+        if self.requests.count(bbox) == 2:
+            gml = gml[:len(gml) // 2]
+        return StandInResponse(gml)
+
+
+class StandInStreamingWFS(StandInWFS):
+    """Stand-in WFS with the GetFeature URLs of a StandInServer."""
+
+    def __init__(self, wells, url):
+        super().__init__(wells)
+        self.url = url
+
+    @staticmethod
+    def path(bbox):
+        return '/wfs/' + '_'.join(str(c) for c in bbox)
+
+    def getGETGetFeatureRequest(self, typename, bbox):
+        return self.url + self.path(bbox)
+
+    def getfeature(self, typename, bbox):
+        raise AssertionError("GetFeature responses are streamed")
+
+
+class StandInSoapClient(object):
+    """Local stand-in for the DINO SOAP service."""
+
+    def __init__(self, levels, failing=()):
+        self.levels = levels
+        self.failing = failing
+        self.requested = []
+        self.start_dates = {}
+        self.service = self
+
+    def findMeetreeks(self, WELL_NITG_NR, START_DATE, END_DATE, UNIT):
+        self.requested.append(WELL_NITG_NR)
+        self.start_dates[WELL_NITG_NR] = START_DATE
+        if WELL_NITG_NR in self.failing:
+            raise Exception("Service unavailable")
+        return [types.SimpleNamespace(
+            WELL_NITG_NR=WELL_NITG_NR,
+            WELL_TUBE_NR=1,
+            LEVELS=[
+                types.SimpleNamespace(DATE=date, LEVEL=level, REMARK=None)
+                for date, level in self.levels
+            ]
+        )]
+
+
+class DinoHarvestTestCase(unittest.TestCase):
+
+    wells = (('B1', 500, 500), ('B2', 600, 700), ('B3', 10500, 500))
+    cells = ((0, 0, 10000, 10000), (10000, 0, 20000, 10000))
+    levels = (('2000-01-01', 1.0), ('2000-01-15', 1.5))
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def harvest(self, soap_client, update=False):
+        collect_dino.download_hdf5(
+            wfs_factory=lambda: StandInWFS(self.wells),
+            soap_factory=lambda: soap_client,
+            sliding_window=self.cells,
+            soap_workers=2,
+            update=update,
+            attempts=2,
+            sleep=lambda delay: None
+        )
+
+    def test_resume(self):
+        failing = StandInSoapClient(self.levels, failing=('B2', ))
+        self.assertRaises(Exception, self.harvest, failing)
+        healthy = StandInSoapClient(self.levels)
+        self.harvest(healthy)
+        self.assertEqual(['B2', 'B3'], sorted(healthy.requested))
+        cell = utils.read_h5(
+            utils.parse_filepath(0, 0), ('B11', 'B21', 'metadata'), many=True)
+        self.assertEqual((2, 2), cell[0].shape)
+        self.assertEqual((2, 2), cell[1].shape)
+        self.assertEqual(2, cell[2].shape[0])
+        healthy.requested = []
+        self.harvest(healthy)
+        self.assertEqual([], healthy.requested)
+
+    def test_update(self):
+        self.harvest(StandInSoapClient(self.levels))
+        updated = StandInSoapClient(
+            self.levels + (('2001-03-01', 2.0), ('2001-03-15', 2.5)))
+        self.harvest(updated, update=True)
+        self.assertEqual(
+            ['B1', 'B2', 'B3'], sorted(updated.requested))
+        self.assertEqual('2000-01-01', updated.start_dates['B1'])
+        well, metadata = utils.read_h5(
+            utils.parse_filepath(0, 0), ('B11', 'metadata'), many=True)
+        self.assertEqual([1.0, 1.5, 2.0, 2.5], well[:, 1].tolist())
+        self.assertEqual(2, metadata.shape[0])
+
+    def test_update_parse(self):
+        levels = (('1997-01-01', 1.0), ('2000-01-15', 1.5))
+        self.harvest(StandInSoapClient(levels))
+        before = dino.list_metadata()
+        self.assertEqual(['B1', 'B2', 'B3'], sorted(before.wellcode))
+        self.wells += (('B4', 700, 800), )
+        self.harvest(StandInSoapClient(
+            levels + (('2001-03-15', 2.0), )), update=True)
+        after = dino.list_metadata()
+        self.assertEqual(['B1', 'B2', 'B3', 'B4'], sorted(after.wellcode))
+        self.assertEqual(
+            {np.datetime64('2001-03-15')},
+            set(after.end.values.astype('datetime64[D]')))
+
+    def test_parse_gml_features(self):
+        gml = dino_gml(self.wells).replace(
+            b'<wfs:member>',
+            b'<wfs:boundedBy><gml:Envelope><gml:lowerCorner>0 0'
+            b'</gml:lowerCorner></gml:Envelope></wfs:boundedBy><wfs:member>',
+            1
+        )
+        features = list(collect_dino.parse_gml_features(io.BytesIO(gml)))
+        self.assertEqual(3, len(features))
+        self.assertEqual('B1', features[0].GetField('dino_nr'))
+        self.assertEqual(500, features[0].GetField('x_rd_crd'))
+        self.assertEqual([1.5, 2.5], features[0].GetField('top_depth_mv'))
+        self.assertEqual(
+            '1990-01-01', features[0].GetField('Grondwaterstand|start_date'))
+        self.assertEqual(
+            ['', ''], collect_dino.try_get_field(
+                features[0], 'bottom_depth_mv', 2))
+        wfs = StandInWFS(self.wells)
+        self.assertEqual(
+            [('B1', 500, 500, '1990-01-01', '2000-01-01', [1.5, 2.5],
+              ['', ''], ['', ''], ['', '']),
+             ('B2', 600, 700, '1990-01-01', '2000-01-01', [1.5, 2.5],
+              ['', ''], ['', ''], ['', ''])],
+            list(collect_dino.get_features(wfs, '', *self.cells[0]))
+        )
+
+    def test_stream_features(self):
+        wfs = StandInWFS(self.wells)
+        files = {StandInStreamingWFS.path(self.cells[0]): wfs.gml(
+            self.cells[0])}
+        with StandInServer(files, ETagHandler) as server:
+            streaming = StandInStreamingWFS(self.wells, server.url)
+            self.assertEqual(
+                list(collect_dino.get_features(wfs, '', *self.cells[0])),
+                list(collect_dino.get_features(
+                    streaming, '', *self.cells[0],
+                    http_session=http_utils.session()))
+            )
+        self.assertEqual(1, len(server.requests))
+
+    def test_wfs_retry(self):
+        wfs_requests = []
+        collect_dino.download_hdf5(
+            wfs_factory=lambda: FlakyWFS(self.wells, wfs_requests),
+            soap_factory=lambda: StandInSoapClient(self.levels),
+            sliding_window=self.cells,
+            sleep=lambda delay: None
+        )
+        self.assertEqual(
+            sorted(self.cells * 3), sorted(map(tuple, wfs_requests)))
+        self.assertEqual(
+            2, len(utils.read_h5(
+                utils.parse_filepath(0, 0), 'metadata')))
+
+    def test_backoff(self):
+        delays = []
+        soap_client = StandInSoapClient(self.levels, failing=('B1', ))
+        self.assertRaises(
+            Exception, collect_dino.load_station_data, 'B1', soap_client,
+            attempts=4, sleep=delays.append, backoff_base=1.0)
+        self.assertEqual(3, len(delays))
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= 2 ** attempt)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,17 +2,64 @@
 Library with common functions.
 """
 
+from contextlib import contextmanager
+import atexit
+import hashlib
+import importlib
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import sys
+import threading
+import time
+import types
+import uuid
 
-import h5py
 import numpy as np
 
+from groundwater_timenet import metrics
+
 LEARN_LOG = os.path.join('var', 'log', 'learn.log')
 PARSE_LOG = os.path.join('var', 'log', 'parse.log')
 HARVEST_LOG = os.path.join('var', 'log', 'harvest.log')
 DATA = os.path.join('var', 'data')
 
+# Floating point type used from the parsed sources up to the neural network.
+# float32 is precise enough for the model; use set_dtype("float64") to opt in
+# to double precision.
+DTYPE = np.float32
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported when one of its attributes is
+    first used, so importing a package does not load GDAL, netCDF4, h5py or
+    pandas for code paths that never touch them.
+    """
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name__)
+        # later lookups find the attributes without calling __getattr__.
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    """
+    :param name: dotted name of the module, such as "osgeo.ogr".
+    :return: the module when it is already imported, otherwise a
+        LazyModule that imports it on first use.
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        return LazyModule(name)
+
+
+h5py = lazy_import('h5py')
+
 
 def mkdirs(path):
     """Create a directory for a path if it doesn't exist yet."""
@@ -23,30 +70,269 @@ def mkdirs(path):
         pass
 
 
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Seconds between two progress messages of a loop.
+PROGRESS_INTERVAL = 10.0
+
+
+class DelayedFileHandler(logging.FileHandler):
+    """
+    File handler that creates the log file, and its directory, when the
+    first record is written instead of when a module is imported.
+    """
+
+    def __init__(self, filename, mode='a', encoding=None):
+        super().__init__(filename, mode, encoding, delay=True)
+
+    def _open(self):
+        mkdirs(self.baseFilename)
+        return super()._open()
+
+
+class _Dispatcher(logging.Handler):
+    """
+    Writes the records taken off the log queue to the console and to the log
+    file of the module that logged them. Runs in the listener thread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.console = logging.StreamHandler()
+        self.files = {}
+
+    def emit(self, record):
+        filename = getattr(record, 'logfile', None)
+        if filename is not None:
+            try:
+                handler = self.files[filename]
+            except KeyError:
+                handler = self.files[filename] = DelayedFileHandler(filename)
+                handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            handler.handle(record)
+        self.console.handle(record)
+
+    def flush(self):
+        self.console.flush()
+        for handler in self.files.values():
+            handler.flush()
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        super().close()
+
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records of the loggers that log to filename on the central log
+    queue, so the logging thread never waits for the disk or the console.
+    In a worker process the records go to the queue of the parent instead.
+    """
+
+    def __init__(self, filename):
+        super().__init__(_LOG_QUEUE)
+        self.filename = filename
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.logfile = self.filename
+        return record
+
+    def enqueue(self, record):
+        if _worker_queue is not None:
+            _worker_queue.put_nowait(record)
+        else:
+            start_logging()
+            super().enqueue(record)
+
+
+_LOG_QUEUE = queue.SimpleQueue()
+_queue_handlers = {}
+_listener = None
+_listener_lock = threading.Lock()
+_stop_at_exit = False
+_worker_queue = None
+
+
+def start_logging():
+    """Starts the thread that writes the log queue, if it isn't running."""
+    global _listener, _stop_at_exit
+    if _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = logging.handlers.QueueListener(
+                _LOG_QUEUE, _Dispatcher())
+            _listener.start()
+            if not _stop_at_exit:
+                atexit.register(stop_logging)
+                _stop_at_exit = True
+
+
+def stop_logging():
+    """Writes the records that are still queued and stops the thread."""
+    global _listener
+    with _listener_lock:
+        listener = _listener
+        if listener is None:
+            return
+        try:
+            listener.stop()
+            for handler in listener.handlers:
+                try:
+                    handler.flush()
+                except ValueError:
+                    # the console stream may be closed at exit.
+                    pass
+                handler.close()
+        finally:
+            _listener = None
+
+
 def setup_logging(name, filename, level="DEBUG"):
-    mkdirs(filename)
-    logging.basicConfig(
-        filename=filename,
-        level=level,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    """
+    :return: the logger name, which logs to the console and to filename
+        through the central log queue. Calling it again for the same name
+        does not add handlers.
+    """
+    try:
+        handler = _queue_handlers[filename]
+    except KeyError:
+        handler = _queue_handlers[filename] = _LogQueueHandler(filename)
     logger = logging.getLogger(name)
-    ch = logging.StreamHandler()
-    ch.setLevel(level)
-    logger.addHandler(ch)
+    logger.setLevel(level)
+    for other in logger.handlers[:]:
+        if isinstance(other, _LogQueueHandler) and other is not handler:
+            logger.removeHandler(other)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
     return logger
 
 
+class _Forwarder(logging.Handler):
+    """Puts the records of worker processes on the central log queue; the
+    workers already filtered them and named their log file."""
+
+    def emit(self, record):
+        start_logging()
+        _LOG_QUEUE.put_nowait(record)
+
+
+def _init_worker_logging(worker_queue):
+    global _worker_queue
+    _worker_queue = worker_queue
+
+
+@contextmanager
+def worker_logging():
+    """
+    Forwards the records of worker processes to the log files and console
+    of this process. Yields the keyword arguments for the pool:
+
+        with utils.worker_logging() as kwargs:
+            with ProcessPoolExecutor(max_workers=4, **kwargs) as executor:
+                ...
+    """
+    worker_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(worker_queue, _Forwarder())
+    listener.start()
+    try:
+        yield dict(initializer=_init_worker_logging, initargs=(worker_queue, ))
+    finally:
+        listener.stop()
+        worker_queue.close()
+
+
+class Progress(object):
+    """
+    Logs the progress of a loop at most once every interval seconds or once
+    every `every` steps, with an estimate of the time left. The message is
+    only formatted when it is logged.
+    """
+
+    def __init__(self, logger, interval=PROGRESS_INTERVAL, every=None,
+                 level=logging.INFO):
+        """
+        :param interval: minimum number of seconds between two messages, or
+            None to only log every `every` steps.
+        :param every: log every `every` steps, regardless of the interval.
+        """
+        self.logger = logger
+        self.interval = interval
+        self.every = every
+        self.level = level
+        self.start_time = time.time()
+        self._last = None
+
+    def due(self, step):
+        if self.every is not None and not step % self.every:
+            return True
+        if self.interval is None:
+            return False
+        return (self._last is None or
+                time.time() - self._last >= self.interval)
+
+    def eta(self, step, total):
+        """:return: the time left to do total steps as hours:minutes."""
+        seconds = (time.time() - self.start_time) / (step + 1) * max(
+            total - step - 1, 0)
+        return "{:d}:{:02d}".format(
+            int(seconds // 3600), int(seconds % 3600 // 60))
+
+    def log(self, step, message, *args, total=None):
+        """
+        Logs message % args when due, followed by the ETA when the total
+        number of steps is known.
+
+        :return: whether the message was logged.
+        """
+        if not self.due(step) or not self.logger.isEnabledFor(self.level):
+            return False
+        self._last = time.time()
+        if total is not None:
+            message += "  |  ETA: %s"
+            args += (self.eta(step, total), )
+        self.logger.log(self.level, message, *args)
+        return True
+
+
 logger = setup_logging(__name__, PARSE_LOG, level="DEBUG")
 
 
+def set_dtype(dtype):
+    """Set the global floating point type, either float32 or float64."""
+    global DTYPE
+    dtype = np.dtype(dtype)
+    if dtype not in (np.dtype(np.float32), np.dtype(np.float64)):
+        raise ValueError(
+            "Unsupported dtype {}, use float32 or float64.".format(dtype))
+    DTYPE = dtype.type
+
+
+def as_dtype(array, dtype=None):
+    """Cast array to the global floating point type, without copying when it
+    already is of that type."""
+    return np.asarray(array, dtype=DTYPE if dtype is None else dtype)
+
+
+@metrics.timed("store_h5")
 def store_h5(
-        data, dataset_name, target_h5=os.path.join("var", "data", "cache", "cache.h5"), many=False):
+        data, dataset_name, target_h5=os.path.join("var", "data", "cache", "cache.h5"), many=False,
+        dtype=None):
+    """
+    Stores one or many arrays in a new HDF5 file.
+
+    When dtype is given, floating point arrays are stored with that dtype.
+    Other arrays (such as integer timestamps) are stored as they are.
+    """
     if not many:
         data = [data]
         dataset_name = [dataset_name]
     mkdirs(target_h5)
     with h5py.File(target_h5, "w", libver='latest') as h5_file:
         for i, dataset_data in enumerate(data):
+            if dtype is not None and dataset_data.dtype.kind == 'f':
+                dataset_data = as_dtype(dataset_data, dtype)
             dataset = h5_file.create_dataset(
                 dataset_name[i],
                 dataset_data.shape,
@@ -54,6 +340,15 @@ def store_h5(
             dataset[...] = dataset_data
 
 
+def tmp_filepath(filepath):
+    """
+    :return: a temporary path next to filepath that no other process writes
+        to. Write to it and os.replace it over filepath, so concurrent
+        readers and writers never see half a file.
+    """
+    return "{}.{}.tmp".format(filepath, uuid.uuid4().hex)
+
+
 def read_h5(filepath, dataset_name, index=None, many=False):
     with h5py.File(filepath, 'r', libver='latest') as h5file:
         if not many:
@@ -69,19 +364,52 @@ def read_h5(filepath, dataset_name, index=None, many=False):
             )
 
 
+def files_version(filepaths):
+    """
+    Fingerprint of the path, size and modification time of filepaths, which
+    changes when a file is written again.
+    """
+    digest = hashlib.sha256()
+    for filepath in sorted(filepaths):
+        stat = os.stat(filepath)
+        digest.update("{}:{}:{}\n".format(
+            filepath, stat.st_size, stat.st_mtime_ns).encode('utf8'))
+    return digest.hexdigest()
+
+
+def _cached_version(target_h5, cache_dataset_name):
+    try:
+        with h5py.File(target_h5, "r", libver='latest') as target:
+            return target[cache_dataset_name].attrs.get("version")
+    except (OSError, KeyError):
+        return None
+
+
 def cache_h5(source_data_function, target_h5, cache_dataset_name=None,
-             decode=None, *source_data_function_args,
+             decode=None, *source_data_function_args, version=None,
              **source_data_function_kwargs
              ):
+    """
+    :param version: version of the source data, such as a files_version.
+        The cache is computed again when it was stored with another
+        version.
+    """
     cache_dataset_name = cache_dataset_name or os.path.basename(
         target_h5).strip('.h5')
-    if not os.path.exists(target_h5):
+    if not os.path.exists(target_h5) or (
+            version is not None and
+            _cached_version(target_h5, cache_dataset_name) != version):
         mkdirs(target_h5)
         data = source_data_function(
             *source_data_function_args,
             **source_data_function_kwargs
         )
-        store_h5(data, cache_dataset_name, target_h5)
+        tmp_h5 = tmp_filepath(target_h5)
+        store_h5(data, cache_dataset_name, tmp_h5)
+        if version is not None:
+            with h5py.File(tmp_h5, "a", libver='latest') as target:
+                target[cache_dataset_name].attrs["version"] = version
+        os.replace(tmp_h5, target_h5)
     with h5py.File(target_h5, "r", libver='latest') as target:
         return target[cache_dataset_name][()]
 